@@ -1,23 +1,119 @@
 from models import Admin
+from models import db
 from security import Security
 from errors import Err, LogLevel, log
+from sqlalchemy import event
+from threading import Lock
+import definitions
+import hashlib
+import os
+import time
+import uuid
+
+ADMIN_KEY_CACHE_TTL = int(os.getenv('ANEX_ADMIN_KEY_CACHE_TTL', 30))  # seconds, bounds staleness across processes
+
+
+class AdminKeyCache:
+    __digests = None
+    __loaded = 0
+    __lock = Lock()
+
+    @staticmethod
+    def digest(key):
+        """
+        Computes the digest an admin key is indexed by.
+
+        :param key: The `key` parameter is the admin key, as a UUID or string
+        :return: the sha256 digest of the key's 16 UUID bytes.
+        """
+        return hashlib.sha256(uuid.UUID(str(key)).bytes).digest()
+
+    @staticmethod
+    def digests():
+        """
+        Returns the digests of every active admin key, decrypting the `Admin` rows only when the cache is
+        empty, was invalidated, or is older than `ADMIN_KEY_CACHE_TTL`.
+
+        :return: a frozenset of key digests.
+        """
+        with AdminKeyCache.__lock:
+            if AdminKeyCache.__digests is not None and time.monotonic() - AdminKeyCache.__loaded < ADMIN_KEY_CACHE_TTL:
+                return AdminKeyCache.__digests
+
+        digests = frozenset(AdminKeyCache.digest(Security.fernet_uuid_decrypt(admin_row.id))
+                            for admin_row in Admin.query.filter_by(status=definitions.STATUS_ACTIVE).all())
+
+        with AdminKeyCache.__lock:
+            AdminKeyCache.__digests = digests
+            AdminKeyCache.__loaded = time.monotonic()
+        return digests
+
+    @staticmethod
+    def contains(key):
+        """
+        Checks if a key is an active admin key.
+
+        :param key: The `key` parameter is the key to check, as a UUID or string
+        :return: True if it is an active admin key, False otherwise.
+        """
+        # the set lookup is the check: it is keyed by a SHA-256 of the key, so its timing says nothing
+        # about the admin keys, and no constant-time comparison is needed
+        return AdminKeyCache.digest(key) in AdminKeyCache.digests()
+
+    @staticmethod
+    def invalidate(*args):
+        """
+        Drops the cached digests, so the next key check reloads them from the `Admin` table.
+        """
+        with AdminKeyCache.__lock:
+            AdminKeyCache.__digests = None
+
+
+# any change to an Admin row through the ORM invalidates the cached digests
+for admin_event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Admin, admin_event, AdminKeyCache.invalidate)
 
 
 class AdminLookup:
     @staticmethod
     def match_key(key):
         """
-        Checks if the key matches the admin key and returns True if it does,
-        False otherwise.
+        Checks if the key matches an active admin key and returns True if it does,
+        False otherwise. Keys are checked against the cached digests, so the database and Fernet are only
+        used when the cache is (re)loaded.
 
         :param key: The `key` parameter is the admin key provided on db initisiation that is being compared to db encrypted key
         :return: The function `match_key` returns a boolean value. If the `admin_key` does not match the
         provided `key`, it returns `False`. Otherwise, it returns `True`.
         """
-        admin_row = Admin.query.first()
-        admin_key = Security.fernet_uuid_decrypt(admin_row.id)
-        log("Admin key match requested", LogLevel.INFO)
-        if admin_key != key:
+        log("Admin key match requested", LogLevel.INFO, sampled=True)
+
+        if not AdminKeyCache.contains(key):
             Err.client_return("Invalid Admin Key", LogLevel.ERROR)
             return False
         return True
+
+
+class AdminManage:
+    @staticmethod
+    def create():
+        """
+        Generates a new admin key and stores it encrypted. Any number of admin keys may be active at once.
+
+        :return: the new admin key, as a UUID.
+        """
+        key = uuid.uuid4()
+
+        try:
+            admin = Admin(
+                id=Security.fernet_uuid_encrypt(key),
+                status=definitions.STATUS_ACTIVE,
+            )
+            db.session.add(admin)
+
+        except Exception as e:
+            log("Failed to create admin key: ", LogLevel.ERROR, str(e))
+            return Err.database_return()
+
+        db.session.commit()
+        return key
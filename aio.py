@@ -0,0 +1,180 @@
+from datetime import datetime
+from sqlalchemy import event, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from models import Data, Session
+from security import Security
+from session import SessionCache
+from data import DataCipher, DataLookup, DataManage, DocumentCache, DATA_RETENTION
+from database import DatabaseConfig
+from exts import db
+import asyncio
+import definitions
+import time
+
+# async drivers used for the sync URI's backend when ANEX_ASYNC_DATABASE_URI is not set
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+OFFLOAD_BYTES = 64 * 1024  # payloads larger than this are encrypted/compressed off the event loop
+
+
+async def offload(size, fn, *args):
+    """
+    Runs CPU bound work (encryption, compression) on a worker thread when the payload is large enough to
+    stall the event loop, and inline otherwise.
+
+    :param size: The `size` parameter is the payload size in bytes
+    :param fn: The `fn` parameter is the function to run
+    :return: the result of `fn(*args)`.
+    """
+    if size > OFFLOAD_BYTES:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+class AsyncDatabase:
+    engine = None
+    sessionmaker = None
+
+    @staticmethod
+    def init_app(app):
+        """
+        Creates the async engine for the app's database, using the async driver for the same backend (or
+        `ANEX_ASYNC_DATABASE_URI`), the same pool settings and, for SQLite, the same pragmas.
+
+        :param app: The `app` parameter is the Flask application, already set up by `DatabaseConfig`
+        """
+        uri = DatabaseConfig.setting(app, 'ANEX_ASYNC_DATABASE_URI')
+        if not uri:
+            with app.app_context():
+                url = db.engine.url     # Flask-SQLAlchemy has resolved relative SQLite paths here
+
+            if url.get_backend_name() not in ASYNC_DRIVERS:
+                raise RuntimeError(f"No async driver for '{url.get_backend_name()}', set ANEX_ASYNC_DATABASE_URI")
+            url = url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+        else:
+            url = make_url(uri)
+
+        AsyncDatabase.engine = create_async_engine(url, **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        AsyncDatabase.sessionmaker = async_sessionmaker(AsyncDatabase.engine, expire_on_commit=False)
+
+        if url.get_backend_name() == 'sqlite':
+            pragmas = DatabaseConfig.sqlite_pragmas(app)
+            event.listen(AsyncDatabase.engine.sync_engine, 'connect', lambda dbapi_connection, _: (
+                DatabaseConfig.apply_pragmas(dbapi_connection, pragmas)))
+
+    @staticmethod
+    def session():
+        """
+        Opens a new async database session.
+        :return: an `AsyncSession`, to be used as an async context manager.
+        """
+        return AsyncDatabase.sessionmaker()
+
+    @staticmethod
+    async def dispose():
+        """
+        Closes every pooled connection of the async engine.
+        """
+        if AsyncDatabase.engine is not None:
+            await AsyncDatabase.engine.dispose()
+
+
+class AsyncSessionLookup:
+    @staticmethod
+    async def record_by_skey(session, key):
+        """
+        Retrieves a session by its key, from the session cache when the session is hot.
+
+        :param session: The `session` parameter is the async database session
+        :param key: The `key` parameter is the session key
+        :return: a `SessionRecord`, or None if the session does not exist.
+        """
+        record = SessionCache.get(key)
+        if record is not None:
+            return record
+
+        read_at = int(time.time() * 1000)
+        ses_row = (await session.execute(select(Session).where(Session.id == str(key)))).scalar()
+        if ses_row is None:
+            return None
+        return SessionCache.put(ses_row, read_at)
+
+    @staticmethod
+    async def expired(session, record):
+        """
+        Checks if a session has expired and marks it inactive if necessary, as `SessionEntity.expired` does.
+
+        :param session: The `session` parameter is the async database session
+        :param record: The `record` parameter is the `SessionRecord` to check
+        :return: True if the session has expired, False otherwise.
+        """
+        if record.can_expire is True and datetime.now() > record.expires:
+            if record.status != definitions.STATUS_INACTIVE:
+                SessionCache.evict(record.id)
+                await session.execute(update(Session)
+                                      .where(Session.id == record.id)
+                                      .values(status=definitions.STATUS_INACTIVE))
+                await session.commit()
+            return True
+        return False
+
+
+class AsyncDataLookup:
+    @staticmethod
+    async def latest(session, user_id):
+        """
+        Retrieves the most recent data entry for a user.
+
+        :param session: The `session` parameter is the async database session
+        :param user_id: The `user_id` parameter is the id of the user
+        :return: the newest `Data` row, or None.
+        """
+        return (await session.execute(DataLookup.latest_select(user_id))).scalar()
+
+    @staticmethod
+    async def latest_etag(session, user_id):
+        """
+        Retrieves the etag of the most recent data entry for a user without reading its payload.
+
+        :param session: The `session` parameter is the async database session
+        :param user_id: The `user_id` parameter is the id of the user
+        :return: a tuple. The first element is True if the user has saved data, the second is the etag.
+        """
+        row = (await session.execute(DataLookup.latest_etag_select(user_id))).first()
+        if row is None:
+            return False, None
+        return True, row.etag
+
+
+class AsyncDataManage:
+    @staticmethod
+    async def save_document(session, user_id, document, keep=DATA_RETENTION):
+        """
+        Compresses, encrypts and stores a document for a user, pruning older versions in the same
+        transaction, as `DataManage.save_document` does.
+
+        :param session: The `session` parameter is the async database session
+        :param user_id: The `user_id` parameter is the id of the user the document belongs to
+        :param document: The `document` parameter is the document bytes
+        :param keep: The `keep` parameter is the number of most recent versions retained for the user
+        :return: the etag of the stored document.
+        """
+        blob, codec = await offload(len(document), DataCipher.encrypt, user_id, document)
+        etag = Security.document_etag(user_id, document)
+
+        try:
+            session.add(Data(user_id=str(user_id), userBlob=blob, codec=codec, etag=etag))
+            await session.flush()
+            await session.execute(DataManage.prune_delete(user_id, keep))
+            await session.commit()
+
+        except Exception:
+            await session.rollback()
+            raise
+
+        DocumentCache.put(user_id, etag, document)
+        return etag
@@ -1,47 +1,109 @@
+from contextlib import contextmanager
 from flask import Flask
 from waitress import serve
-import definitions
 from exts import db
-import uuid
+from database import DatabaseConfig
 from security import Security
+from logs import LogPipeline
+from metrics import Metrics
+import os
 
+try:
+    import fcntl  # Unix only, elsewhere bootstrapping is not coordinated between processes
+except ImportError:
+    fcntl = None
 
-def create_app():
+BOOTSTRAP_LOCK = os.getenv('ANEX_BOOTSTRAP_LOCK', 'anex.bootstrap.lock')    # serialises first boot and migrations
+
+
+@contextmanager
+def bootstrap_lock():
+    """
+    Holds an exclusive lock on the `BOOTSTRAP_LOCK` file, so when several processes start together only one
+    creates the tables, runs the migrations and generates the admin key, and the others find them done.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open(BOOTSTRAP_LOCK, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def create_app(background=True):
     """
-    Initialises a Flask application, configures a SQLite database, creates
+    Initialises a Flask application, configures the database (SQLite by default, see `database.py`), creates
     necessary tables, generates an admin key if it doesn't exist, and registers blueprints for routing.
+    Settings can be given in a config file named by the `ANEX_SETTINGS` environment variable.
+
+    :param background: The `background` parameter starts the background threads (see `start_background`)
+    when True; a process that forks workers passes False and starts them in each worker instead
     :return: The function `create_app` returns an instance of the Flask application.
     """
+    LogPipeline.init()     # anex.log and the console, written by a background thread (see logs.py)
     app = Flask(__name__)
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///anex.db"
-    db.init_app(app)
+    app.config.from_envvar('ANEX_SETTINGS', silent=True)
+    DatabaseConfig.init_app(app)
 
-    with app.app_context():
+    with app.app_context(), bootstrap_lock():
         print('Initiating server ...')
         from models import Admin
+        from admin import AdminManage
+        from migrations import Migrations
         db.create_all()
+        Migrations.run()    # evolves databases created by older versions
 
         if not Admin.query.first():
             print('No database found. First boot? Creating database and generating admin key ..')
-            encrypted_key = Security.fernet_uuid_encrypt(uuid.uuid4())  # Create new admin key
-            admin = Admin(
-                id=encrypted_key,
-                status=definitions.STATUS_ACTIVE,
-            )
-            db.session.add(admin)
-            db.session.commit()
-            print('Please keep private and safe! Admin Key:', Security.fernet_uuid_decrypt(admin.id))
+            admin_key = AdminManage.create()  # Create new admin key
+            print('Please keep private and safe! Admin Key:', admin_key)
 
         print('Database initialised')
         print('Server has started')
 
     from views import main as main_blueprint
+    from profiling import Profiler
+    Profiler.init(main_blueprint)   # opt-in, ANEX_PROFILE=1
     app.register_blueprint(main_blueprint)
+    app.after_request(LogPipeline.tag_response)
+    Metrics.init_app(app)
     Security.Network.init()
 
+    if background is True:
+        start_background(app)
+
     return app
 
 
+def start_background(app, singletons=True):
+    """
+    Starts the background threads. Threads do not survive a fork, so a worker process calls this after it
+    is forked.
+
+    :param app: The `app` parameter is the Flask application, whose context the threads run in
+    :param singletons: The `singletons` parameter starts the database-wide jobs (legacy data migration,
+    sweeper and key rotation) when True; with several workers only one of them runs these
+    """
+    from user import LoginAttemptBuffer
+    from data import DataMigrate
+    from ratelimit import LoginLimiter
+    from sweeper import Sweeper
+    from session import RevocationList
+    from rotation import KeyRotation
+    LoginAttemptBuffer.init(app)
+    LoginLimiter.init(app)
+    RevocationList.init(app)
+
+    if singletons is True:
+        DataMigrate.init(app)
+        Sweeper.init(app)
+        KeyRotation.init(app)
+
+
 if __name__ == '__main__':
     app = create_app()
     serve(app, host="localhost", port=8000)  # serve app on localhost only
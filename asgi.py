@@ -0,0 +1,298 @@
+# ASGI entry point, serving the same routes as views.main:
+#     uvicorn --factory asgi:create_asgi_app     (or: python asgi.py)
+# The user data endpoints run natively on async SQLAlchemy, every other route is served by the Flask app
+# on a worker thread. Needs asgiref, an async driver (aiosqlite or asyncpg) and an ASGI server (uvicorn).
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import BadRequest, HTTPException, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.http import parse_accept_header, parse_etags, parse_options_header, quote_etag
+from urllib.parse import parse_qs
+from app import create_app
+from aio import AsyncDatabase, AsyncDataLookup, AsyncDataManage, AsyncSessionLookup, offload
+from codec import Codec
+from data import DataCipher
+from errors import Err, LogLevel, log
+from jsonstream import JsonDocument, JsonStreamError
+from session import SessionAuth
+import asyncio
+import json
+import re
+import traceback
+import uuid
+
+SKEY_PATTERN = r'(?P<skey>[0-9A-Za-z_-]+)'     # session UUID or session token
+
+
+class AsgiRequest:
+    def __init__(self, scope, receive):
+        """
+        Wraps an ASGI http scope with the few request helpers the async views need.
+
+        :param scope: The `scope` parameter is the ASGI connection scope
+        :param receive: The `receive` parameter is the ASGI receive callable
+        """
+        self.method = scope['method']
+        self.path = scope['path']
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        self.args = {name: values[0] for name, values in query.items()}
+        self.headers = {}
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            self.headers[name] = f"{self.headers[name]}, {value}" if name in self.headers else value
+        self.__receive = receive
+
+    @property
+    def content_length(self):
+        value = self.headers.get('content-length')
+        if value is None:
+            return None
+        if not (value.strip().isascii() and value.strip().isdigit()):
+            raise BadRequest("Invalid Content-Length header")
+        return int(value)
+
+    @property
+    def mimetype(self):
+        return parse_options_header(self.headers.get('content-type', ''))[0].lower()
+
+    @property
+    def accept_encodings(self):
+        return parse_accept_header(self.headers.get('accept-encoding'))
+
+    @property
+    def if_none_match(self):
+        return parse_etags(self.headers.get('if-none-match'))
+
+    async def body(self, limit=None):
+        """
+        Reads the whole request body.
+
+        :param limit: The `limit` parameter is the maximum body size in bytes, None for no limit
+        :return: the body bytes.
+        """
+        length = self.content_length     # parsed even without a limit, so a malformed header is a 400
+        if limit is not None and (length or 0) > limit:
+            raise RequestEntityTooLarge()
+
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await self.__receive()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if limit is not None and size > limit:
+                raise RequestEntityTooLarge()
+            chunks.append(chunk)
+            more_body = message.get('more_body', False)
+        return b''.join(chunks)
+
+    async def json(self, limit=None):
+        """
+        Reads and parses a JSON request body, failing the same way Flask's `request.json` does.
+
+        :param limit: The `limit` parameter is the maximum body size in bytes, None for no limit
+        :return: the parsed JSON.
+        """
+        if not (self.mimetype == 'application/json' or
+                (self.mimetype.startswith('application/') and self.mimetype.endswith('+json'))):
+            raise UnsupportedMediaType("Did not attempt to load JSON data because the request Content-Type "
+                                       "was not 'application/json'.")
+        try:
+            return json.loads(await self.body(limit))
+        except ValueError:
+            raise BadRequest("Failed to decode JSON object")
+
+    async def document(self, limit=None):
+        """
+        Reads a JSON request body and checks it is valid as it arrives, without parsing it into objects.
+
+        :param limit: The `limit` parameter is the maximum body size in bytes, None for no limit
+        :return: the body bytes, exactly as received.
+        """
+        if not (self.mimetype == 'application/json' or
+                (self.mimetype.startswith('application/') and self.mimetype.endswith('+json'))):
+            Err.client_return(Err.ERROR_MESSAGES['MISSING_JSON_DATA'], LogLevel.INFO)
+        length = self.content_length     # parsed even without a limit, so a malformed header is a 400
+        if limit is not None and (length or 0) > limit:
+            raise RequestEntityTooLarge()
+
+        document = JsonDocument()
+        try:
+            more_body = True
+            while more_body:
+                message = await self.__receive()
+                chunk = message.get('body', b'')
+                if limit is not None and document.size + len(chunk) > limit:
+                    raise RequestEntityTooLarge()
+                await offload(len(chunk), document.feed, chunk)
+                more_body = message.get('more_body', False)
+            return await offload(document.size, document.close)
+
+        except JsonStreamError as e:
+            Err.client_return(Err.ERROR_MESSAGES['JSON_INVALID'], LogLevel.INFO, f": {e}")
+
+
+def json_response(obj, status=200, headers=None):
+    """
+    Serialises a response body the way Flask's default JSON provider does.
+
+    :param obj: The `obj` parameter is the object to send
+    :param status: The `status` parameter is the HTTP status code
+    :param headers: The `headers` parameter is an optional dictionary of extra headers
+    :return: a tuple of status, headers and body bytes.
+    """
+    body = (json.dumps(obj, separators=(',', ':'), sort_keys=True) + '\n').encode('utf-8')
+    return status, {'Content-Type': 'application/json', **(headers or {})}, body
+
+
+class AsgiApp:
+    def __init__(self, flask_app):
+        """
+        Initialises the ASGI application around an already created Flask application.
+
+        :param flask_app: The `flask_app` parameter is the app returned by `create_app`, used for every
+        route that is not served natively
+        """
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.routes = [
+            (re.compile(r'^/api/save_user_data/' + SKEY_PATTERN + '$'), 'POST', self.save_user_data),
+            (re.compile(r'^/api/load_user_data/' + SKEY_PATTERN + '$'), 'GET', self.load_user_data),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] == 'http':
+            for pattern, method, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match is not None and scope['method'] == method:
+                    return await self.dispatch(handler, AsgiRequest(scope, receive), send, match['skey'])
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await AsyncDatabase.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, handler, request, send, skey):
+        try:
+            async with AsyncDatabase.session() as session:
+                status, headers, body = await handler(session, request, skey)
+
+        except HTTPException as e:
+            response = e.get_response()
+            status, headers, body = response.status_code, dict(response.headers), response.get_data()
+
+        except Exception:
+            log("Exception on " + request.path + " [" + request.method + "]\n", LogLevel.ERROR,
+                traceback.format_exc())
+            status, headers, body = 500, {'Content-Type': 'text/plain'}, b'Internal Server Error'
+
+        streamed = not isinstance(body, bytes)    # a generator of chunks, sent without a Content-Length
+        if not streamed:
+            headers['Content-Length'] = str(len(body))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                        for name, value in headers.items()],
+        })
+
+        if not streamed:
+            await send({'type': 'http.response.body', 'body': body})
+            return
+        # the chunks are produced by CPU bound work (decompression), so each is made on a worker thread
+        chunks = iter(body)
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def valid_session(self, session, skey):
+        claims = SessionAuth.token_claims(skey)     # tokens need no database round trip
+        if claims is not None:
+            return claims.user_id
+
+        user_session = await AsyncSessionLookup.record_by_skey(session, uuid.UUID(skey))
+        if user_session is None:
+            Err.client_return(Err.ERROR_MESSAGES['INVALID_SESSION'], LogLevel.WARNING)
+
+        if await AsyncSessionLookup.expired(session, user_session) is True:
+            Err.client_return(Err.ERROR_MESSAGES['INVALID_SESSION'], LogLevel.WARNING)
+        return user_session.user_id     # the session's foreign key guarantees the user exists
+
+    async def save_user_data(self, session, request, skey):
+        """
+        Async version of `views.save_user_data`.
+        """
+        user_id = await self.valid_session(session, skey)
+        limit = self.flask_app.config.get('MAX_CONTENT_LENGTH')
+        if request.args.get('raw') == '1':
+            document = await request.document(limit)
+        else:
+            document = json.dumps(await request.json(limit)).encode('utf-8')
+
+        await AsyncDataManage.save_document(session, user_id, document)
+        return json_response({"message": "User Authenticated, saving data"})
+
+    async def load_user_data(self, session, request, skey):
+        """
+        Async version of `views.load_user_data`.
+        """
+        user_id = await self.valid_session(session, skey)
+
+        data_found, etag = await AsyncDataLookup.latest_etag(session, user_id)
+        if data_found is False:
+            return json_response({'message': 'No data found for user'}, 404)
+
+        raw = request.args.get('raw') == '1'
+        headers = {'Vary': 'Accept-Encoding'} if raw else {}
+        if etag is not None:
+            headers['ETag'] = quote_etag(etag, weak=True)
+            if request.if_none_match.contains_weak(etag):
+                return 304, headers, b''
+
+        user_data_rec = await AsyncDataLookup.latest(session, user_id)
+        if user_data_rec is None:
+            return json_response({'message': 'No data found for user'}, 404)
+
+        if user_data_rec.etag is not None:
+            headers['ETag'] = quote_etag(user_data_rec.etag, weak=True)
+
+        stored = user_data_rec.userBlob if user_data_rec.userBlob is not None else user_data_rec.userData
+        payload = await offload(len(stored), DataCipher.payload, user_data_rec)
+
+        if raw is True:
+            encoding = Codec.http_encoding(user_data_rec.codec)
+            if encoding is not None and request.accept_encodings.quality(encoding) > 0:
+                headers['Content-Encoding'] = encoding
+                return 200, {'Content-Type': 'application/json', **headers}, payload
+
+            return 200, {'Content-Type': 'application/json', **headers}, Codec.decompress_chunks(payload,
+                                                                                               user_data_rec.codec)
+
+        decrypted_data = (await offload(len(payload), Codec.decompress, payload, user_data_rec.codec)).decode('utf-8')
+        return json_response({"userData": str(decrypted_data)}, 200, headers)
+
+
+def create_asgi_app():
+    """
+    Creates the Flask application (see `create_app`) and the async engine, and wraps both in an ASGI
+    application.
+    :return: the ASGI application.
+    """
+    flask_app = create_app()
+    AsyncDatabase.init_app(flask_app)
+    return AsgiApp(flask_app)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(create_asgi_app, factory=True, host="localhost", port=8000)  # serve app on localhost only
@@ -0,0 +1,341 @@
+# Benchmark and load test for the main endpoints, against a throwaway SQLite database:
+#     python benchmark.py                                   full sweep, prints a table
+#     python benchmark.py --save-baseline bench.json        ... and stores the results as a baseline
+#     python benchmark.py --baseline bench.json             ... and fails (exit 1) on regressions against it
+# create_user and login are swept over concurrency, save_user_data and load_user_data over concurrency and
+# payload size. Every cell runs through the Flask test client and a real waitress server (--transports).
+import argparse
+import atexit
+import http.client
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SIZES = {'k': 1024, 'm': 1024 * 1024}
+PAYLOAD_BUDGET = 256 * 1024 * 1024   # bytes sent per save cell, caps the request count for large payloads
+
+
+def parse_size(text):
+    """
+    Parses a payload size such as "1k", "64k" or "50m".
+
+    :param text: The `text` parameter is the size, with an optional k or m suffix
+    :return: the size in bytes.
+    """
+    text = text.strip().lower()
+    if text[-1] in SIZES:
+        return int(float(text[:-1]) * SIZES[text[-1]])
+    return int(text)
+
+
+def prepare_environment(workdir, concurrency):
+    """
+    Points the server at a throwaway database and log file, lifts the login rate limits and makes the
+    password hash queue deep enough for every client, before any of its modules are imported.
+
+    :param workdir: The `workdir` parameter is the temporary directory the database is created in
+    :param concurrency: The `concurrency` parameter is the largest number of concurrent clients
+    """
+    if not os.getenv('ANEX_MASTER_KEY'):
+        from cryptography.fernet import Fernet
+        os.environ['ANEX_MASTER_KEY'] = Fernet.generate_key().decode()
+
+    os.environ['ANEX_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'anex.db')
+    os.environ['ANEX_LOG_FILE'] = os.path.join(workdir, 'anex.log')
+    os.environ['ANEX_BOOTSTRAP_LOCK'] = os.path.join(workdir, 'anex.bootstrap.lock')
+    os.environ['ANEX_LOG_CONSOLE'] = '0'
+    os.environ['ANEX_SWEEP_INTERVAL'] = '0'
+    os.environ['ANEX_LOGIN_ADDRESS_BURST'] = str(10 ** 9)
+    os.environ['ANEX_LOGIN_USERNAME_BURST'] = str(10 ** 9)
+    # the default depth scales with the CPUs, so on a small host concurrent logins would be refused (503)
+    os.environ.setdefault('ANEX_HASH_QUEUE_DEPTH', str(max(concurrency, (os.cpu_count() or 1) * 4)))
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        """
+        Counts the SQL statements run on an engine, by any thread.
+
+        :param engine: The `engine` parameter is the SQLAlchemy engine of the app
+        """
+        from sqlalchemy import event
+
+        self.count = 0
+        self.__lock = threading.Lock()
+        event.listen(engine, 'after_cursor_execute', self.__count)
+
+    def __count(self, *args):
+        with self.__lock:
+            self.count += 1
+
+
+class TestClientTransport:
+    name = 'testclient'
+
+    def __init__(self, app):
+        self.app = app
+        self.__local = threading.local()
+
+    def request(self, method, path, body=None):
+        client = getattr(self.__local, 'client', None)
+        if client is None:
+            client = self.__local.client = self.app.test_client()
+        response = client.open(path, method=method, data=body, content_type='application/json')
+        return response.status_code, response.get_data()
+
+    def close(self):
+        pass
+
+
+class WaitressTransport:
+    name = 'waitress'
+
+    def __init__(self, app, threads):
+        from waitress import create_server
+
+        self.server = create_server(app, host='127.0.0.1', port=0, threads=threads)
+        self.port = self.server.effective_port
+        self.__thread = threading.Thread(target=self.server.run, name='bench-waitress', daemon=True)
+        self.__thread.start()
+        self.__local = threading.local()
+        self.__connections = []
+        self.__lock = threading.Lock()
+
+    def request(self, method, path, body=None):
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = self.__local.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=300)
+            with self.__lock:
+                self.__connections.append(connection)
+        try:
+            connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            return response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self.__local.connection = None
+            raise
+
+    def close(self):
+        # the clients hang up first, so their channels close and the server loop has nothing left to poll
+        with self.__lock:
+            for connection in self.__connections:
+                connection.close()
+            self.__connections = []
+
+        # closed on the loop thread, which then returns, rather than under a loop still polling its sockets
+        self.server.trigger.pull_trigger(self.server.close)
+        self.__thread.join(timeout=30)
+        self.server.task_dispatcher.shutdown()
+
+
+class Benchmark:
+    def __init__(self, app, transport, counter, admin_key, access_key):
+        self.app = app
+        self.transport = transport
+        self.counter = counter
+        self.admin_key = admin_key
+        self.access_key = access_key
+        self.users = 0
+
+    def licenses(self, count):
+        status, body = self.transport.request('GET', f'/api/license/{self.admin_key}/30/{count}?format=ndjson')
+        records = [json.loads(line) for line in body.decode().splitlines()] if status == 200 else []
+        if status != 200 or any('error' in record for record in records):
+            raise RuntimeError(f"Could not create the benchmark licenses ({status}): {body[-200:]!r}")
+        return [record['key'] for record in records]
+
+    def session_key(self, login):
+        status, body = self.transport.request(*login)
+        if status != 200:
+            raise RuntimeError(f"Benchmark login failed ({status}): {body[:200]!r}; a 503 means the password "
+                               f"hash queue is full, raise ANEX_HASH_QUEUE_DEPTH")
+        return json.loads(body)['key']
+
+    def new_users(self, count):
+        names = [f'bench{self.transport.name}{self.users + i}' for i in range(count)]
+        self.users += count
+        return [{'email': f'{name}@bench.anex', 'password': 'benchpass1', 'username': name, 'key': key}
+                for name, key in zip(names, self.licenses(count))]
+
+    def run(self, label, concurrency, calls):
+        """
+        Runs calls on a pool of `concurrency` threads and measures them.
+
+        :param label: The `label` parameter names the result, e.g. "save_user_data"
+        :param concurrency: The `concurrency` parameter is the number of concurrent clients
+        :param calls: The `calls` parameter is a list of (method, path, body) requests
+        :return: a result dictionary with latency percentiles, throughput and queries per request.
+        """
+        def timed(call):
+            started = time.perf_counter()
+            try:
+                status, _ = self.transport.request(*call)
+            except Exception:
+                status = 0
+            return time.perf_counter() - started, status
+
+        queries = self.counter.count
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            measured = list(pool.map(timed, calls))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for latency, _ in measured)
+        return {
+            'endpoint': label,
+            'requests': len(calls),
+            'errors': sum(1 for _, status in measured if not 200 <= status < 300),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'rps': len(calls) / elapsed,
+            'queries': (self.counter.count - queries) / len(calls),
+        }
+
+    def sweep(self, concurrencies, payloads, requests):
+        results = []
+        for concurrency in concurrencies:
+            users = self.new_users(requests)
+            signups = [('POST', f'/api/create/user/{self.access_key}', json.dumps(user)) for user in users]
+            logins = [('POST', f'/api/login/{self.access_key}',
+                       json.dumps({'username': user['username'], 'password': user['password']})) for user in users]
+
+            for label, calls in (('create_user', signups), ('login', logins)):
+                result = self.run(label, concurrency, calls)
+                result.update(concurrency=concurrency, payload=0)
+                results.append(result)
+
+            # one session per client thread, so concurrent saves do not all hit the same user
+            skeys = [self.session_key(login) for login in logins[:concurrency]]
+
+            for payload in payloads:
+                count = max(3, min(requests, PAYLOAD_BUDGET // payload))
+                rng = random.Random(payload)
+                document = json.dumps({'blob': rng.randbytes(payload // 2).hex()})
+
+                for label, method, body in (('save_user_data', 'POST', document), ('load_user_data', 'GET', None)):
+                    result = self.run(label, concurrency, [(method, f'/api/{label}/{skeys[i % len(skeys)]}', body)
+                                                           for i in range(count)])
+                    result.update(concurrency=concurrency, payload=payload)
+                    results.append(result)
+
+        for result in results:
+            result['transport'] = self.transport.name
+        return results
+
+
+def percentile(ordered, pct):
+    """
+    Returns a percentile of sorted values, by the nearest rank method.
+
+    :param ordered: The `ordered` parameter is the sorted list of values
+    :param pct: The `pct` parameter is the percentile, 0 to 100
+    :return: the value at that percentile.
+    """
+    if not ordered:
+        return 0.0
+    return ordered[max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))]
+
+
+def result_key(result):
+    return f"{result['transport']}/{result['endpoint']}/c{result['concurrency']}/p{result['payload']}"
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with a baseline. A cell regresses when its p50 or p99 latency grows, or its
+    throughput drops, by more than `tolerance`, or when it issues more queries per request.
+
+    :param results: The `results` parameter is the list of result dictionaries
+    :param baseline: The `baseline` parameter is a dictionary of result key to a stored result
+    :param tolerance: The `tolerance` parameter is the allowed relative change, e.g. 0.2 for 20%
+    :return: a list of regression descriptions.
+    """
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        for metric in ('p50_ms', 'p99_ms'):
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{result_key(result)} {metric} {base[metric]:.2f} -> {result[metric]:.2f}")
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{result_key(result)} rps {base['rps']:.1f} -> {result['rps']:.1f}")
+        if result['queries'] > base['queries'] + 0.01:
+            regressions.append(f"{result_key(result)} queries {base['queries']:.2f} -> {result['queries']:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Anex endpoints against a temporary database.')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma separated client counts')
+    parser.add_argument('--payloads', default='1k,64k,1m,50m', help='comma separated save/load payload sizes')
+    parser.add_argument('--requests', type=int, default=100, help='requests per cell')
+    parser.add_argument('--transports', default='testclient,waitress', help='testclient, waitress or both')
+    parser.add_argument('--baseline', help='baseline JSON to compare against')
+    parser.add_argument('--save-baseline', help='write the results to this baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--output', help='write the raw results to this JSON file')
+    args = parser.parse_args()
+
+    concurrencies = [int(c) for c in args.concurrency.split(',')]
+    payloads = [parse_size(p) for p in args.payloads.split(',')]
+
+    workdir = tempfile.mkdtemp(prefix='anex-bench-')
+    # registered first so it runs last, after the server's own exit handlers have flushed to the database
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    prepare_environment(workdir, max(concurrencies))
+
+    from app import create_app
+    from exts import db
+    from models import Admin
+    from security import Security
+
+    app = create_app()
+    with app.app_context():
+        admin_key = Security.fernet_uuid_decrypt(Admin.query.first().id)
+        counter = QueryCounter(db.engine)
+
+    results = []
+    for name in args.transports.split(','):
+        transport = TestClientTransport(app) if name == 'testclient' else WaitressTransport(app, max(concurrencies))
+        try:
+            results += Benchmark(app, transport, counter, admin_key, Security.Network.access_key).sweep(
+                concurrencies, payloads, args.requests)
+        finally:
+            transport.close()
+
+    print(f"{'transport':<11}{'endpoint':<16}{'conc':>5}{'payload':>10}{'reqs':>6}{'errs':>6}"
+          f"{'p50 ms':>10}{'p99 ms':>10}{'req/s':>9}{'queries':>9}")
+    for r in results:
+        print(f"{r['transport']:<11}{r['endpoint']:<16}{r['concurrency']:>5}{r['payload']:>10}"
+              f"{r['requests']:>6}{r['errors']:>6}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['rps']:>9.1f}"
+              f"{r['queries']:>9.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=1)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as output:
+            json.dump({result_key(r): r for r in results}, output, indent=1, sort_keys=True)
+
+    failed = any(r['errors'] for r in results)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        failed = failed or bool(regressions)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
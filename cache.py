@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class LRUCache:
+    def __init__(self, max_size=1024, ttl=60, on_evict=None):
+        """
+        Initialises a bounded, thread safe least-recently-used cache where every entry also carries an
+        expiry time.
+
+        :param max_size: The `max_size` parameter is the maximum number of entries held before the least
+        recently used entry is evicted
+        :param ttl: The `ttl` parameter is the default number of seconds an entry stays valid for
+        :param on_evict: The `on_evict` parameter is an optional callable, called with `(key, value)`
+        whenever an entry is dropped because it expired or the cache was full
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key):
+        """
+        Retrieves an entry from the cache, dropping it if it has expired.
+
+        :param key: The `key` parameter is the key the entry was stored under
+        :return: the cached value, or None if the key is missing or has expired.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if time.monotonic() < expires:
+                self.__entries.move_to_end(key)
+                return value
+
+            del self.__entries[key]
+
+        self.__evicted([(key, value)])
+        return None
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores an entry in the cache, evicting the least recently used entry if the cache is full.
+
+        :param key: The `key` parameter is the key the entry is stored under
+        :param value: The `value` parameter is the object to cache
+        :param ttl: The `ttl` parameter optionally overrides the default lifetime (in seconds) of the entry
+        """
+        if ttl is None:
+            ttl = self.ttl
+
+        if ttl <= 0:
+            self.pop(key)
+            return
+
+        evicted = []
+        with self.__lock:
+            self.__entries[key] = (value, time.monotonic() + ttl)
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.max_size:
+                old_key, (old_value, _) = self.__entries.popitem(last=False)
+                evicted.append((old_key, old_value))
+
+        self.__evicted(evicted)
+
+    def pop(self, key):
+        """
+        Removes an entry from the cache.
+
+        :param key: The `key` parameter is the key of the entry to remove
+        :return: the removed value, or None if the key was not cached.
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+        return entry[0] if entry is not None else None
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def __evicted(self, entries):
+        # callbacks run outside the cache lock, so they may safely take locks of their own
+        if self.on_evict is None:
+            return
+
+        for key, value in entries:
+            self.on_evict(key, value)
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
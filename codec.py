@@ -0,0 +1,122 @@
+import io
+import os
+import zlib
+
+try:
+    import zstandard  # optional, zstd is used when the package is installed
+except ImportError:
+    zstandard = None
+
+CODEC_IDENTITY = 'identity'
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+STREAM_CHUNK_SIZE = int(os.getenv('ANEX_STREAM_CHUNK_SIZE', 64 * 1024))   # bytes per streamed response chunk
+
+# HTTP content codings that carry each codec's bytes unchanged (zlib streams are HTTP "deflate")
+HTTP_ENCODINGS = {
+    CODEC_ZLIB: 'deflate',
+    CODEC_ZSTD: 'zstd',
+}
+
+
+class Codec:
+    @staticmethod
+    def available(codec):
+        """
+        Checks if a codec can be used in this environment.
+
+        :param codec: The `codec` parameter is the codec tag, e.g. `zlib`
+        :return: True if data can be compressed and decompressed with the codec, False otherwise.
+        """
+        if codec == CODEC_ZSTD:
+            return zstandard is not None
+        return codec in (CODEC_IDENTITY, CODEC_ZLIB)
+
+    @staticmethod
+    def default():
+        """
+        Returns the codec new data is stored with: `ANEX_DATA_CODEC` if set and available, otherwise zstd
+        when installed, otherwise zlib.
+        :return: a codec tag.
+        """
+        codec = os.getenv('ANEX_DATA_CODEC')
+        if codec is not None and Codec.available(codec):
+            return codec
+        return CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+    @staticmethod
+    def compress(data, codec):
+        """
+        Compresses data with the given codec.
+
+        :param data: The `data` parameter is the bytes to compress
+        :param codec: The `codec` parameter is the codec tag to compress with
+        :return: the compressed bytes.
+        """
+        if codec == CODEC_ZLIB:
+            return zlib.compress(data, ZLIB_LEVEL)
+        if codec == CODEC_ZSTD:
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+        if codec == CODEC_IDENTITY:
+            return data
+        raise ValueError(f"Unknown codec '{codec}'")
+
+    @staticmethod
+    def decompress(data, codec):
+        """
+        Decompresses data that was compressed with the given codec.
+
+        :param data: The `data` parameter is the compressed bytes
+        :param codec: The `codec` parameter is the codec tag stored alongside the data
+        :return: the decompressed bytes.
+        """
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(data)
+        if codec == CODEC_ZSTD:
+            return zstandard.ZstdDecompressor().decompress(data)
+        if codec == CODEC_IDENTITY or codec is None:
+            return data
+        raise ValueError(f"Unknown codec '{codec}'")
+
+    @staticmethod
+    def decompress_chunks(data, codec, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Decompresses data incrementally, so the whole decompressed document is never held in memory.
+
+        :param data: The `data` parameter is the compressed bytes
+        :param codec: The `codec` parameter is the codec tag stored alongside the data
+        :param chunk_size: The `chunk_size` parameter is the most decompressed bytes yielded at a time
+        :return: a generator of decompressed byte chunks.
+        """
+        if codec == CODEC_ZLIB:
+            decompressor = zlib.decompressobj()
+            pending = data
+            while pending:
+                chunk = decompressor.decompress(pending, chunk_size)
+                pending = decompressor.unconsumed_tail
+                if chunk:
+                    yield chunk
+            tail = decompressor.flush()
+            if tail:
+                yield tail
+        elif codec == CODEC_ZSTD:
+            yield from zstandard.ZstdDecompressor().read_to_iter(io.BytesIO(data), write_size=chunk_size)
+        elif codec == CODEC_IDENTITY or codec is None:
+            view = memoryview(data)
+            for start in range(0, len(view), chunk_size):
+                yield view[start:start + chunk_size]
+        else:
+            raise ValueError(f"Unknown codec '{codec}'")
+
+    @staticmethod
+    def http_encoding(codec):
+        """
+        Returns the HTTP `Content-Encoding` that the codec's bytes can be served as without recompression.
+
+        :param codec: The `codec` parameter is the codec tag
+        :return: the content coding name, or None if the codec has no HTTP equivalent.
+        """
+        return HTTP_ENCODINGS.get(codec)
@@ -0,0 +1,378 @@
+from models import db
+from models import Data, User
+from sqlalchemy import delete, select, update
+from threading import Event, Thread
+from errors import Err, LogLevel, log
+from codec import Codec, CODEC_IDENTITY
+from security import Security
+from cache import LRUCache
+import atexit
+import os
+
+DATA_RETENTION = max(1, int(os.getenv('ANEX_DATA_RETENTION', 1)))  # versions kept per user
+MIGRATE_BATCH_SIZE = int(os.getenv('ANEX_DATA_MIGRATE_BATCH', 100))          # rows per transaction
+MIGRATE_INTERVAL = float(os.getenv('ANEX_DATA_MIGRATE_INTERVAL', 1))          # seconds between batches
+MIGRATE_ENABLED = os.getenv('ANEX_DATA_MIGRATE', '1') == '1'
+DOCUMENT_CACHE_SIZE = int(os.getenv('ANEX_DOCUMENT_CACHE_SIZE', 128))                  # entries
+DOCUMENT_CACHE_TTL = int(os.getenv('ANEX_DOCUMENT_CACHE_TTL', 300))                    # seconds
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv('ANEX_DOCUMENT_CACHE_MAX_BYTES', 1024 * 1024))  # per document
+
+# marks an unconditional save, as None is a valid (legacy) etag
+ANY_VERSION = object()
+
+
+class DocumentCache:
+    __cache = LRUCache(DOCUMENT_CACHE_SIZE, DOCUMENT_CACHE_TTL)
+
+    @staticmethod
+    def get(user_id, etag):
+        """
+        Retrieves a user's decrypted document if the cached copy is still the given version.
+
+        :param user_id: The `user_id` parameter is the id of the user the document belongs to
+        :param etag: The `etag` parameter is the version of the document currently stored
+        :return: the document bytes, or None if they are not cached for that version.
+        """
+        entry = DocumentCache.__cache.get(str(user_id))
+        if entry is None or entry[0] != etag:
+            return None
+        return entry[1]
+
+    @staticmethod
+    def put(user_id, etag, document):
+        """
+        Caches a user's decrypted document. Documents without an etag or larger than
+        `DOCUMENT_CACHE_MAX_BYTES` are not cached.
+
+        :param user_id: The `user_id` parameter is the id of the user the document belongs to
+        :param etag: The `etag` parameter is the version of the document
+        :param document: The `document` parameter is the document bytes
+        """
+        if etag is None or len(document) > DOCUMENT_CACHE_MAX_BYTES:
+            DocumentCache.__cache.pop(str(user_id))
+            return
+        DocumentCache.__cache.set(str(user_id), (etag, document))
+
+
+class DataCipher:
+    @staticmethod
+    def encrypt(user_id, document):
+        """
+        Compresses a document with the default codec and encrypts it into an AES-GCM envelope bound to
+        the user.
+
+        :param user_id: The `user_id` parameter is the id of the user the document belongs to
+        :param document: The `document` parameter is the document bytes
+        :return: a tuple of the envelope bytes and the codec tag.
+        """
+        codec = Codec.default()
+        compressed = Codec.compress(document, codec)
+        return Security.aes_encrypt(compressed, str(user_id).encode('utf-8')), codec
+
+    @staticmethod
+    def payload(data_row):
+        """
+        Decrypts a data entry in either storage format (AES-GCM envelope or legacy Fernet token) without
+        decompressing it.
+
+        :param data_row: The `data_row` parameter is a `Data` row
+        :return: the stored bytes, still compressed with `data_row.codec`.
+        """
+        if data_row.userBlob is not None:
+            return Security.aes_decrypt(data_row.userBlob, str(data_row.user_id).encode('utf-8'))
+        return Security.fernet_decrypt_bytes(data_row.userData)
+
+    @staticmethod
+    def decrypt(data_row):
+        """
+        Decrypts and decompresses a data entry.
+
+        :param data_row: The `data_row` parameter is a `Data` row
+        :return: the document bytes.
+        """
+        return Codec.decompress(DataCipher.payload(data_row), data_row.codec)
+
+
+class DataLookup:
+    @staticmethod
+    def latest(user_id):
+        """
+        Retrieves the most recent data entry for a user.
+
+        :param user_id: The `user_id` parameter is the id of the user whose data is requested
+        :return: the newest `Data` row for the user, or None if the user has not saved anything.
+        """
+        return db.session.execute(DataLookup.latest_select(user_id)).scalar()
+
+    @staticmethod
+    def latest_select(user_id):
+        """
+        Builds the query for a user's most recent data entry, shared by the WSGI and ASGI paths.
+
+        :param user_id: The `user_id` parameter is the id of the user whose data is requested
+        :return: a `select` statement.
+        """
+        return select(Data).where(Data.user_id == str(user_id)).order_by(Data.id.desc()).limit(1)
+
+    @staticmethod
+    def latest_etag_select(user_id):
+        """
+        Builds the query for the etag of a user's most recent data entry, which never reads the payload.
+
+        :param user_id: The `user_id` parameter is the id of the user whose data is requested
+        :return: a `select` statement.
+        """
+        return select(Data.etag).where(Data.user_id == str(user_id)).order_by(Data.id.desc()).limit(1)
+
+    @staticmethod
+    def latest_etag(user_id):
+        """
+        Retrieves the content hash of the most recent data entry for a user without reading its payload.
+
+        :param user_id: The `user_id` parameter is the id of the user whose data is requested
+        :return: a tuple. The first element is True if the user has saved data, the second is the entry's
+        etag, or None for entries saved before etags were recorded.
+        """
+        row = db.session.execute(DataLookup.latest_etag_select(user_id)).first()
+
+        if row is None:
+            return False, None
+        return True, row.etag
+
+    @staticmethod
+    def document(user_id):
+        """
+        Retrieves a user's current document, from the document cache when the cached copy is still the
+        latest version, otherwise by decrypting the latest data entry.
+
+        :param user_id: The `user_id` parameter is the id of the user whose document is requested
+        :return: a tuple of the document's etag and its bytes, or (None, None) if the user has no data.
+        """
+        data_found, etag = DataLookup.latest_etag(user_id)
+        if data_found is False:
+            return None, None
+
+        document = DocumentCache.get(user_id, etag)
+        if document is not None:
+            return etag, document
+
+        data_row = DataLookup.latest(user_id)
+        if data_row is None:
+            return None, None
+
+        document = DataCipher.decrypt(data_row)
+        DocumentCache.put(user_id, data_row.etag, document)
+        return data_row.etag, document
+
+
+class DataManage:
+    @staticmethod
+    def save(user_id, user_data=None, codec=CODEC_IDENTITY, keep=DATA_RETENTION, user_blob=None, etag=None,
+             if_etag=ANY_VERSION):
+        """
+        Stores a new data entry for a user and prunes older versions in the same transaction. Pruning is a
+        single bulk DELETE on the row ids, so old payloads are never loaded.
+
+        :param user_id: The `user_id` parameter is the id of the user the data belongs to
+        :param user_data: The `user_data` parameter is a legacy Fernet token to store
+        :param codec: The `codec` parameter is the tag of the codec the data was compressed with before
+        encryption, defaults to `identity` (optional)
+        :param keep: The `keep` parameter is the number of most recent versions retained for the user,
+        defaults to `DATA_RETENTION` (optional)
+        :param user_blob: The `user_blob` parameter is an AES-GCM envelope to store instead of `user_data`
+        :param etag: The `etag` parameter is the content hash of the document, served as its ETag
+        :param if_etag: The `if_etag` parameter makes the save conditional: it is only committed if the
+        previous entry has this etag (optional)
+        :return: the id of the new data entry, or None if `if_etag` did not match.
+        """
+        keep = max(1, keep)
+
+        try:
+            if if_etag is not ANY_VERSION:
+                # the user's row lock serialises conditional saves, so two of them cannot both see the same
+                # previous version on databases with row locks (PostgreSQL); SQLite already has one writer
+                db.session.execute(select(User.id).where(User.id == str(user_id)).with_for_update())
+
+            data = Data(
+                user_id=str(user_id),
+                userData=user_data,
+                userBlob=user_blob,
+                codec=codec,
+                etag=etag,
+            )
+            db.session.add(data)
+            db.session.flush()
+            data_id = data.id   # read before the commit expires the row, which would reload it
+
+            if if_etag is not ANY_VERSION:
+                # checked after the insert, so the write transaction is already holding the database
+                previous = db.session.execute(DataManage.previous_etag_select(user_id, data_id)).first()
+
+                if previous is None or previous.etag != if_etag:
+                    db.session.rollback()
+                    return None
+
+            db.session.execute(DataManage.prune_delete(user_id, keep))
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            log("Failed to save user data: ", LogLevel.ERROR, str(e))
+            return Err.database_return()
+
+        return data_id
+
+    @staticmethod
+    def previous_etag_select(user_id, data_id):
+        """
+        Builds the query for the etag of the entry saved before `data_id`.
+
+        :param user_id: The `user_id` parameter is the id of the user the data belongs to
+        :param data_id: The `data_id` parameter is the id of the entry being saved
+        :return: a `select` statement.
+        """
+        return (select(Data.etag)
+                .where(Data.user_id == str(user_id))
+                .where(Data.id < data_id)
+                .order_by(Data.id.desc())
+                .limit(1))
+
+    @staticmethod
+    def prune_delete(user_id, keep=DATA_RETENTION):
+        """
+        Builds the bulk DELETE that removes all but the `keep` most recent entries of a user.
+
+        :param user_id: The `user_id` parameter is the id of the user the data belongs to
+        :param keep: The `keep` parameter is the number of most recent versions retained
+        :return: a `delete` statement.
+        """
+        # id of the oldest version still kept, NULL (nothing to prune) while there are fewer than `keep`
+        oldest_kept = (select(Data.id)
+                       .where(Data.user_id == str(user_id))
+                       .order_by(Data.id.desc())
+                       .limit(1)
+                       .offset(max(1, keep) - 1)
+                       .scalar_subquery())
+
+        return (delete(Data)
+                .where(Data.user_id == str(user_id))
+                .where(Data.id < oldest_kept)
+                .execution_options(synchronize_session=False))
+
+    @staticmethod
+    def save_document(user_id, document, keep=DATA_RETENTION, if_etag=ANY_VERSION):
+        """
+        Compresses, encrypts (AES-GCM) and stores a document for a user.
+
+        :param user_id: The `user_id` parameter is the id of the user the document belongs to
+        :param document: The `document` parameter is the document bytes
+        :param keep: The `keep` parameter is the number of most recent versions retained for the user
+        :param if_etag: The `if_etag` parameter makes the save conditional on the current version (optional)
+        :return: the etag of the stored document, or None if `if_etag` did not match.
+        """
+        blob, codec = DataCipher.encrypt(user_id, document)
+        etag = Security.document_etag(user_id, document)
+
+        if DataManage.save(user_id, codec=codec, keep=keep, user_blob=blob, etag=etag, if_etag=if_etag) is None:
+            return None
+
+        DocumentCache.put(user_id, etag, document)
+        return etag
+
+
+class DataMigrate:
+    __stop = Event()
+    __thread = None
+
+    @staticmethod
+    def init(app):
+        """
+        Starts the background thread that converts legacy Fernet rows to the AES-GCM format, a batch at a
+        time, until none are left. Disabled by setting `ANEX_DATA_MIGRATE=0`.
+
+        :param app: The `app` parameter is the Flask application, whose context the migration runs in
+        """
+        if MIGRATE_ENABLED is False or DataMigrate.__thread is not None:
+            return
+
+        def migrate_loop():
+            after = 0
+            converted = skipped = 0
+            while not DataMigrate.__stop.wait(MIGRATE_INTERVAL):
+                try:
+                    with app.app_context():
+                        batch_converted, batch_skipped, after = DataMigrate.run_batch(after=after)
+                except Exception as e:
+                    log(f"Legacy user data migration failed after {converted} rows, it resumes on restart: ",
+                        LogLevel.ERROR, str(e))
+                    return
+
+                if batch_converted + batch_skipped == 0:
+                    break
+                converted += batch_converted
+                skipped += batch_skipped
+
+            if DataMigrate.__stop.is_set():
+                return
+            if skipped > 0:
+                log(f"Legacy user data migration finished: {converted} rows converted, {skipped} rows could not "
+                    f"be decrypted and were left as they are", LogLevel.ERROR)
+            else:
+                log(f"Legacy user data migration finished: {converted} rows converted", LogLevel.INFO)
+
+        DataMigrate.__thread = Thread(target=migrate_loop, name='anex-data-migrate', daemon=True)
+        DataMigrate.__thread.start()
+        atexit.register(DataMigrate.__stop.set)
+
+    @staticmethod
+    def run_batch(batch_size=MIGRATE_BATCH_SIZE, after=0):
+        """
+        Converts the next `batch_size` legacy Fernet rows after the id `after` to AES-GCM envelopes in one
+        transaction. The codec tag is unchanged, as only the encryption layer is replaced. A row that cannot
+        be decrypted (corrupt, or under a key no longer configured) is logged and skipped, so it does not
+        stop the rows after it. Must be called inside an application context.
+
+        :param batch_size: The `batch_size` parameter is the maximum number of rows read
+        :param after: The `after` parameter is the id the previous batch ended at, 0 for the first batch
+        :raises Exception: if the batch could not be written; it is rolled back
+        :return: a tuple of the number of rows converted, the number of rows skipped, and the id the batch
+        ended at, to pass as `after` to the next batch. No rows converted or skipped means none are left.
+        """
+        rows = db.session.execute(
+            select(Data.id, Data.user_id, Data.userData)
+            .where(Data.id > after)
+            .where(Data.userBlob.is_(None))
+            .where(Data.userData.is_not(None))
+            .order_by(Data.id)
+            .limit(batch_size)
+        ).all()
+        db.session.commit()
+
+        if not rows:
+            return 0, 0, after
+
+        converted = []
+        skipped = 0
+        for row in rows:
+            try:
+                plain = Security.fernet_decrypt_bytes(row.userData)
+            except Exception as e:
+                log(f"Legacy user data row {row.id} could not be decrypted and was skipped: ", LogLevel.ERROR,
+                    repr(e))
+                skipped += 1
+                continue
+            converted.append({
+                'id': row.id,
+                'userBlob': Security.aes_encrypt(plain, str(row.user_id).encode('utf-8')),
+                'userData': None,
+            })
+
+        if converted:
+            try:
+                db.session.execute(update(Data), converted)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+        return len(converted), skipped, rows[-1].id
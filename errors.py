@@ -4,16 +4,6 @@ from enum import Enum
 
 DEFAULT_LOGGING_LEVEL = logging.INFO
 
-logging.basicConfig(
-    filename='anex.log',
-    format='%(asctime)s %(levelname)s %(message)s',
-    level=DEFAULT_LOGGING_LEVEL,
-    datefmt='%Y-%m-%d %H:%M:%S')
-
-root_logger = logging.getLogger()
-handler = logging.StreamHandler()
-root_logger.addHandler(handler)
-
 
 class LogLevel(Enum):
     ERROR = 0
@@ -22,15 +12,17 @@ class LogLevel(Enum):
     INFO = 3
 
 
-def log(text, level=LogLevel.ERROR, optional=""):
+def log(text, level=LogLevel.ERROR, optional="", sampled=False):
+    # sampled records come from noisy paths and are thinned out per level by ANEX_LOG_SAMPLE
+    extra = {'sampled': sampled}
     if level == LogLevel.ERROR:
-        logging.error(text + optional)
+        logging.error(text + optional, extra=extra)
     elif level == LogLevel.WARNING:
-        logging.warning(text + optional)
+        logging.warning(text + optional, extra=extra)
     elif level == LogLevel.INFO:
-        logging.info(text + optional)
+        logging.info(text + optional, extra=extra)
     elif level == LogLevel.DEBUG:
-        logging.debug(text + optional)
+        logging.debug(text + optional, extra=extra)
 
 
 class Err:
@@ -60,19 +52,18 @@ class Err:
         'INVALID_ACCOUNT_STATE': 'User Account Requires Activation',
         'LOGIN_ATTEMPTS': 'Too Many Login Requests.',
         'INVALID_LICENSE': 'Invalid license key',
-        'INVALID_SESSION': 'Invalid session key'
+        'INVALID_SESSION': 'Invalid session key',
+        'PATCH_TYPE': 'Patch must be application/json-patch+json or application/merge-patch+json',
+        'PATCH_INVALID': 'Patch could not be applied',
+        'JSON_INVALID': 'Body is not a valid JSON document',
+        'IMPORT_FORMAT': 'Import format must be csv or ndjson',
+        'IMPORT_HEADER': 'CSV header must name the username, email, password and key columns',
+        'IMPORT_CONFLICT': 'Row conflicted with a concurrent change, retry it',
+        'EXPORT_FORMAT': 'Export format must be csv or ndjson',
+        'SERVER_BUSY': 'Server is busy, please try again shortly'
 
     }
 
-    logging.basicConfig(
-        filename='anex.log',
-        format='%(asctime)s %(levelname)s %(message)s',
-        level=logging.INFO,
-        datefmt='%Y-%m-%d %H:%M:%S')
-
-    root_logger = logging.getLogger()
-    root_logger.addHandler(handler)
-
     @staticmethod
     def disable():
         logging.disable(logging.NOTSET)
@@ -90,6 +81,11 @@ class Err:
         else:
             abort(400)
 
+    @staticmethod
+    def busy_return(text, level=LogLevel.WARNING):
+        log("{503} " + text, level)
+        abort(503, text)
+
     @staticmethod
     def database_return():
         return abort(500)
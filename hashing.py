@@ -0,0 +1,131 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+from werkzeug.security import check_password_hash, generate_password_hash
+from errors import Err, LogLevel, log
+from metrics import Metrics
+import multiprocessing
+import os
+
+HASH_WORKERS = int(os.getenv('ANEX_HASH_WORKERS', os.cpu_count() or 1))  # 0 hashes on the request thread
+HASH_QUEUE_DEPTH = int(os.getenv('ANEX_HASH_QUEUE_DEPTH', max(1, HASH_WORKERS) * 4))  # queued + running
+HASH_TIMEOUT = float(os.getenv('ANEX_HASH_TIMEOUT', 10))  # seconds
+
+
+class HashPool:
+    __executor = None
+    __lock = Lock()
+    __slots = BoundedSemaphore(HASH_QUEUE_DEPTH)
+
+    @staticmethod
+    @Metrics.timed('anex_password_hash_seconds', 'generate')
+    def generate(password):
+        """
+        Hashes a password on the hashing process pool.
+
+        :param password: The `password` parameter is the plain text password to hash
+        :return: the password hash.
+        """
+        return HashPool.__run(generate_password_hash, password)
+
+    @staticmethod
+    @Metrics.timed('anex_password_hash_seconds', 'compare')
+    def compare(hashed, regular):
+        """
+        Compares a hashed password with a plain text password on the hashing process pool.
+
+        :param hashed: The hashed parameter is the hashed version of the password.
+        :param regular: The regular parameter is the plain text password that you want to compare with the
+        hashed password
+        :return: True if they match, and False otherwise.
+        """
+        return HashPool.__run(check_password_hash, hashed, regular)
+
+    @staticmethod
+    def generate_many(passwords):
+        """
+        Hashes many passwords in parallel on the hashing process pool, for bulk imports. At most
+        `HASH_WORKERS` of them are queued at a time, so logins hashed meanwhile wait behind one round of
+        import hashes rather than the whole batch. Each of them holds a queue slot like a login hash does,
+        waiting for one rather than being rejected when the queue is full.
+
+        :param passwords: The `passwords` parameter is the list of plain text passwords to hash
+        :raises TimeoutError: if a hash, or the wait for its slot, takes longer than `HASH_TIMEOUT`
+        :raises BrokenProcessPool: if the pool failed, it is restarted on the next hash
+        :return: the list of password hashes, in the same order.
+        """
+        if HASH_WORKERS == 0:
+            return [generate_password_hash(password) for password in passwords]
+
+        hashes = []
+        pending = deque()
+        try:
+            for password in passwords:
+                if len(pending) >= HASH_WORKERS:
+                    hashes.append(pending.popleft().result(timeout=HASH_TIMEOUT))
+                if not HashPool.__slots.acquire(timeout=HASH_TIMEOUT):
+                    raise TimeoutError("No hashing slot free")
+                pending.append(HashPool.__submit(generate_password_hash, password))
+            hashes.extend(future.result(timeout=HASH_TIMEOUT) for future in pending)
+
+        except BrokenProcessPool as e:
+            log("Hashing pool failed, restarting: ", LogLevel.ERROR, str(e))
+            HashPool.shutdown()
+            raise
+
+        finally:
+            for future in pending:
+                future.cancel()
+        return hashes
+
+    @staticmethod
+    def shutdown():
+        """
+        Stops the worker processes. The pool is started again on the next hash.
+        """
+        with HashPool.__lock:
+            if HashPool.__executor is not None:
+                HashPool.__executor.shutdown(wait=False, cancel_futures=True)
+                HashPool.__executor = None
+
+    @staticmethod
+    def __pool():
+        # started lazily, so it is created in the process that serves requests
+        with HashPool.__lock:
+            if HashPool.__executor is None:
+                HashPool.__executor = ProcessPoolExecutor(max_workers=HASH_WORKERS,
+                                                          mp_context=multiprocessing.get_context('spawn'))
+            return HashPool.__executor
+
+    @staticmethod
+    def __submit(fn, *args):
+        # the caller holds a slot; it is given back when the hash is done, not when the caller stops waiting
+        # for it, so a hash that timed out keeps its slot while a worker is still busy with it
+        try:
+            future = HashPool.__pool().submit(fn, *args)
+        except BaseException:
+            HashPool.__slots.release()
+            raise
+        future.add_done_callback(lambda _: HashPool.__slots.release())
+        return future
+
+    @staticmethod
+    def __run(fn, *args):
+        if HASH_WORKERS == 0:
+            return fn(*args)
+
+        # reject straight away rather than queue behind a burst that would time out anyway
+        if not HashPool.__slots.acquire(blocking=False):
+            Err.busy_return(Err.ERROR_MESSAGES['SERVER_BUSY'], LogLevel.WARNING)
+
+        try:
+            return HashPool.__submit(fn, *args).result(timeout=HASH_TIMEOUT)
+
+        except TimeoutError:
+            Err.busy_return(Err.ERROR_MESSAGES['SERVER_BUSY'], LogLevel.WARNING)
+
+        except BrokenProcessPool as e:
+            log("Hashing pool failed, restarting: ", LogLevel.ERROR, str(e))
+            HashPool.shutdown()
+            Err.busy_return(Err.ERROR_MESSAGES['SERVER_BUSY'], LogLevel.WARNING)
@@ -0,0 +1,242 @@
+import codecs
+import json
+import os
+import re
+
+JSON_MAX_DEPTH = int(os.getenv('ANEX_JSON_MAX_DEPTH', 512))    # nesting depth accepted by the validator
+JSON_STREAM_THRESHOLD = int(os.getenv('ANEX_JSON_STREAM_THRESHOLD', 1024 * 1024))  # smaller bodies use json.loads
+READ_CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+TOKEN = re.compile(r'[ \t\n\r]*(?:(")|([{\[])|([}\]])|(:)|(,)|'
+                   r'(-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?)|(true|false|null))')
+STRING_BODY = re.compile(r'(?:[^"\\\x00-\x1f]+|\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4}))*')
+NUMBER_CHARS = re.compile(r'[-+0-9.eE]*')
+LITERALS = ('true', 'false', 'null')
+
+# TOKEN groups
+TOKEN_STRING, TOKEN_OPEN, TOKEN_CLOSE, TOKEN_COLON, TOKEN_COMMA, TOKEN_NUMBER, TOKEN_LITERAL = range(1, 8)
+
+# what the validator expects next; the order matters, values come first, then strings
+EXPECT_VALUE = 0
+EXPECT_FIRST_ITEM = 1   # a value or ']'
+EXPECT_FIRST_KEY = 2    # a key or '}'
+EXPECT_KEY = 3
+EXPECT_COLON = 4
+EXPECT_COMMA = 5        # ',' or the end of the current container
+EXPECT_END = 6
+
+
+class JsonStreamError(ValueError):
+    pass
+
+
+class JsonValidator:
+    def __init__(self, max_depth=JSON_MAX_DEPTH):
+        """
+        Initialises a streaming JSON (RFC 8259) validator. Bytes are fed in chunks of any size and checked
+        as they arrive, without building any Python objects, so memory stays flat however large the
+        document is.
+
+        :param max_depth: The `max_depth` parameter is the deepest nesting of objects and arrays accepted
+        """
+        self.max_depth = max_depth
+        self.__decoder = codecs.getincrementaldecoder('utf-8')()
+        self.__buffer = ''
+        self.__stack = []
+        self.__expect = EXPECT_VALUE
+        self.__in_string = False
+        self.__offset = 0
+
+    def feed(self, chunk):
+        """
+        Validates the next chunk of the document.
+
+        :param chunk: The `chunk` parameter is the next bytes of the document
+        :raises JsonStreamError: if the document is already known to be invalid
+        """
+        try:
+            text = self.__decoder.decode(chunk)
+        except UnicodeDecodeError as e:
+            raise JsonStreamError(f"Invalid UTF-8: {e.reason}")
+        self.__scan(text, False)
+
+    def close(self):
+        """
+        Ends the document and checks it was complete.
+
+        :raises JsonStreamError: if the document is invalid or incomplete
+        """
+        try:
+            text = self.__decoder.decode(b'', True)
+        except UnicodeDecodeError as e:
+            raise JsonStreamError(f"Invalid UTF-8: {e.reason}")
+        self.__scan(text, True)
+
+        if self.__expect != EXPECT_END or self.__in_string:
+            raise JsonStreamError(f"Unexpected end of document at character {self.__offset}")
+
+    def __scan(self, text, final):
+        buffer = self.__buffer + text if self.__buffer else text
+        pos = 0
+        end = len(buffer)
+        expect = self.__expect
+        stack = self.__stack
+        in_string = self.__in_string
+
+        try:
+            while pos < end:
+                if in_string:
+                    pos = STRING_BODY.match(buffer, pos).end()
+                    if pos == end:
+                        break
+                    if buffer[pos] != '"':
+                        if buffer[pos] == '\\' and end - pos < 6 and not final:
+                            break       # escape sequence split across chunks
+                        raise JsonStreamError(f"Invalid character in string at character {self.__offset + pos}")
+                    pos += 1
+                    in_string = False
+                    if expect == EXPECT_FIRST_KEY or expect == EXPECT_KEY:
+                        expect = EXPECT_COLON
+                    else:
+                        expect = EXPECT_COMMA if stack else EXPECT_END
+                    continue
+
+                match = TOKEN.match(buffer, pos)
+                if match is None:
+                    pos = WHITESPACE.match(buffer, pos).end()
+                    if pos == end:
+                        break
+                    if not final and (buffer[pos] == '-' and pos + 1 == end or
+                                      any(literal.startswith(buffer[pos:]) for literal in LITERALS)):
+                        break   # a number or literal that may continue in the next chunk
+                    raise JsonStreamError(f"Unexpected '{buffer[pos]}' at character {self.__offset + pos}")
+
+                kind = match.lastindex
+                if kind == TOKEN_STRING:
+                    if expect > EXPECT_KEY:
+                        raise JsonStreamError(f"Unexpected string at character {self.__offset + match.start(kind)}")
+                    in_string = True
+
+                elif kind == TOKEN_OPEN:
+                    if expect > EXPECT_FIRST_ITEM:
+                        raise JsonStreamError(f"Unexpected '{match[kind]}' at character "
+                                              f"{self.__offset + match.start(kind)}")
+                    if len(stack) >= self.max_depth:
+                        raise JsonStreamError(f"Document nested too deeply at character "
+                                              f"{self.__offset + match.start(kind)}")
+                    stack.append(match[kind])
+                    expect = EXPECT_FIRST_KEY if match[kind] == '{' else EXPECT_FIRST_ITEM
+
+                elif kind == TOKEN_CLOSE:
+                    opener, first = ('{', EXPECT_FIRST_KEY) if match[kind] == '}' else ('[', EXPECT_FIRST_ITEM)
+                    if not stack or stack[-1] != opener or (expect != first and expect != EXPECT_COMMA):
+                        raise JsonStreamError(f"Unexpected '{match[kind]}' at character "
+                                              f"{self.__offset + match.start(kind)}")
+                    stack.pop()
+                    expect = EXPECT_COMMA if stack else EXPECT_END
+
+                elif kind == TOKEN_COLON:
+                    if expect != EXPECT_COLON:
+                        raise JsonStreamError(f"Unexpected ':' at character {self.__offset + match.start(kind)}")
+                    expect = EXPECT_VALUE
+
+                elif kind == TOKEN_COMMA:
+                    if expect != EXPECT_COMMA:
+                        raise JsonStreamError(f"Unexpected ',' at character {self.__offset + match.start(kind)}")
+                    expect = EXPECT_KEY if stack[-1] == '{' else EXPECT_VALUE
+
+                else:   # number or literal
+                    if kind == TOKEN_NUMBER and not final and NUMBER_CHARS.match(buffer, match.start(kind)).end() == end:
+                        pos = match.start(kind)
+                        break   # the number may continue in the next chunk
+                    if expect > EXPECT_FIRST_ITEM:
+                        raise JsonStreamError(f"Unexpected '{match[kind]}' at character "
+                                              f"{self.__offset + match.start(kind)}")
+                    expect = EXPECT_COMMA if stack else EXPECT_END
+
+                pos = match.end()
+
+        finally:
+            self.__expect = expect
+            self.__in_string = in_string
+
+        self.__offset += pos
+        self.__buffer = buffer[pos:]
+
+
+def reject_constant(name):
+    raise ValueError(f"{name} is not valid JSON")
+
+
+class JsonDocument:
+    def __init__(self, threshold=JSON_STREAM_THRESHOLD):
+        """
+        Collects a JSON document's bytes as they arrive and checks they form valid JSON, keeping the bytes
+        exactly as sent. Documents up to `threshold` bytes are checked by `json.loads` once complete, which
+        is faster for small bodies; past it, the chunks are checked by a `JsonValidator` as they arrive, so
+        no Python objects are built for the document.
+
+        :param threshold: The `threshold` parameter is the size in bytes past which chunks are validated
+        as they arrive
+        """
+        self.threshold = threshold
+        self.size = 0
+        self.__chunks = []
+        self.__validator = None
+
+    def feed(self, chunk):
+        """
+        Adds the next chunk of the document.
+
+        :param chunk: The `chunk` parameter is the next bytes of the document
+        :raises JsonStreamError: if the document is already known to be invalid
+        """
+        self.__chunks.append(chunk)
+        self.size += len(chunk)
+
+        if self.__validator is not None:
+            self.__validator.feed(chunk)
+        elif self.size > self.threshold:
+            self.__validator = JsonValidator()
+            for pending in self.__chunks:
+                self.__validator.feed(pending)
+
+    def close(self):
+        """
+        Ends the document and checks it is complete and valid.
+
+        :raises JsonStreamError: if the document is not valid JSON
+        :return: the document bytes, exactly as received.
+        """
+        document = b''.join(self.__chunks)
+        self.__chunks = []
+
+        if self.__validator is not None:
+            self.__validator.close()
+            return document
+
+        try:
+            json.loads(document.decode('utf-8'), parse_constant=reject_constant)
+        except UnicodeDecodeError as e:
+            raise JsonStreamError(f"Invalid UTF-8: {e.reason}")
+        except ValueError as e:
+            raise JsonStreamError(str(e))
+        except RecursionError:
+            raise JsonStreamError("Document nested too deeply")
+        return document
+
+    @staticmethod
+    def read(stream, chunk_size=READ_CHUNK_SIZE):
+        """
+        Reads a whole JSON document from a binary stream, such as `request.stream`.
+
+        :param stream: The `stream` parameter is a file-like object with a `read` method
+        :param chunk_size: The `chunk_size` parameter is the number of bytes read at a time
+        :raises JsonStreamError: if the document is not valid JSON
+        :return: the document bytes, exactly as received.
+        """
+        document = JsonDocument()
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            document.feed(chunk)
+        return document.close()
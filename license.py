@@ -1,8 +1,13 @@
 from models import db
 from models import License
 from datetime import timedelta, datetime
+from sqlalchemy import insert, update
 from errors import Err, LogLevel, log
 import definitions
+import uuid
+import os
+
+LICENSE_BATCH_CHUNK = int(os.getenv('ANEX_LICENSE_BATCH_CHUNK', 5000))  # licenses per transaction
 
 
 class LicenseLookUp:
@@ -18,6 +23,45 @@ class LicenseLookUp:
         """
         return License.query.get(str(key))
 
+    @staticmethod
+    def by_license_keys(keys):
+        """
+        Retrieves many licenses at once, by primary key.
+
+        :param keys: The `keys` parameter is a collection of license keys
+        :return: a dictionary of license key to `License` row, for the keys that exist.
+        """
+        if not keys:
+            return {}
+        return {lic_row.id: lic_row for lic_row in License.query.filter(License.id.in_([str(key) for key in keys]))}
+
+    @staticmethod
+    def claimable(lic_row):
+        """
+        Checks whether a license can be claimed by a new user: it exists, is active, unclaimed and, if it can
+        expire, not yet expired.
+
+        :param lic_row: The `lic_row` parameter is the `License` row, or None if the key does not exist
+        :return: True if the license can be claimed, False otherwise.
+        """
+        if lic_row is None or lic_row.claimed is True or lic_row.status != definitions.STATUS_ACTIVE:
+            return False
+        return not (lic_row.can_expire is True and lic_row.expires < datetime.now())
+
+    @staticmethod
+    def usable(lic_row):
+        """
+        Checks whether a license allows its user to log in: it is claimed, active and, if it can expire, not
+        yet expired. Expired licenses are marked inactive by the sweeper, not here, so the check never writes.
+
+        :param lic_row: The `lic_row` parameter is the license (a `License` row or `LoginLicense`), or None if
+        the user has no license
+        :return: True if the license is usable, False otherwise.
+        """
+        if lic_row is None or lic_row.claimed is False or lic_row.status != definitions.STATUS_ACTIVE:
+            return False
+        return not (lic_row.can_expire is True and lic_row.expires < datetime.now())
+
 
 class LicenseManage:
     @staticmethod
@@ -31,7 +75,7 @@ class LicenseManage:
         the value of "days" is 0, it means the license key does not expire
         :return: the value of the variable `ret_id`.
         """
-        log("New license key requested", LogLevel.INFO)
+        log("New license key requested", LogLevel.INFO, sampled=True)
 
         can_expire = True
         if days == 0:
@@ -55,6 +99,64 @@ class LicenseManage:
         db.session.commit()
         return ret_id
 
+    @staticmethod
+    def create_batch(count, days, chunk_size=LICENSE_BATCH_CHUNK):
+        """
+        Creates license keys in bulk, inserting them in chunks with one executemany INSERT and one commit
+        per chunk. Only one chunk is held in memory at a time.
+
+        :param count: The `count` parameter is the number of license keys to create
+        :param days: The "days" parameter represents the number of days until the license keys expire. If
+        the value of "days" is 0, the license keys do not expire
+        :param chunk_size: The `chunk_size` parameter is the number of licenses inserted per transaction
+        :return: a generator yielding, after each chunk is committed, the list of license rows (as dicts)
+        that were created. If a chunk fails, it is rolled back and the error is raised; the chunks yielded
+        before it stay committed.
+        """
+        log(f"{count} new license keys requested", LogLevel.INFO)
+
+        can_expire = days != 0
+        expiration_date = datetime.now() + timedelta(days=days)
+
+        remaining = count
+        while remaining > 0:
+            chunk = [{
+                'id': str(uuid.uuid4()),
+                'status': definitions.STATUS_ACTIVE,
+                'can_expire': can_expire,
+                'expires': expiration_date,
+                'claimed': False,
+            } for _ in range(min(chunk_size, remaining))]
+
+            try:
+                db.session.execute(insert(License), chunk)
+                db.session.commit()
+
+            except Exception as e:
+                db.session.rollback()
+                log(f"Failed to create license batch after {count - remaining} of {count} keys: ",
+                    LogLevel.ERROR, str(e))
+                raise
+
+            remaining -= len(chunk)
+            yield chunk
+
+    @staticmethod
+    def claim(key):
+        """
+        Marks a license as claimed if it is still unclaimed, without committing, so the claim is committed
+        together with the user that claims it.
+
+        :param key: The `key` parameter is the license key to claim
+        :return: True if the license was claimed, False if it was claimed meanwhile or does not exist.
+        """
+        claimed = db.session.execute(update(License)
+                                     .where(License.id == str(key))
+                                     .where(License.claimed.is_(False))
+                                     .values(claimed=True)
+                                     .execution_options(synchronize_session=False)).rowcount
+        return claimed == 1
+
 
 class LicenseEntity:
     def __init__(self, key):
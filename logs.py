@@ -0,0 +1,179 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from datetime import datetime
+from flask import g, has_request_context, request
+from metrics import Metrics
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import uuid
+
+LOG_FILE = os.getenv('ANEX_LOG_FILE', 'anex.log')
+LOG_MAX_BYTES = int(os.getenv('ANEX_LOG_MAX_BYTES', 10 * 1024 * 1024))   # rotate anex.log at this size
+LOG_BACKUPS = int(os.getenv('ANEX_LOG_BACKUPS', 5))                      # rotated files kept
+LOG_FORMAT = os.getenv('ANEX_LOG_FORMAT', 'json')                        # 'json' or 'text', for anex.log
+LOG_CONSOLE = os.getenv('ANEX_LOG_CONSOLE', '1') == '1'
+LOG_QUEUE_SIZE = int(os.getenv('ANEX_LOG_QUEUE_SIZE', 10000))            # records; when full, new ones are dropped
+LOG_SAMPLE = os.getenv('ANEX_LOG_SAMPLE', 'INFO=0.1')                    # share of sampled records kept, per level
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def sample_rates(setting):
+    """
+    Parses a sampling setting such as "INFO=0.1,DEBUG=0".
+
+    :param setting: The `setting` parameter is the comma separated list of level=rate pairs
+    :return: a dictionary of logging level number to the share of sampled records kept.
+    """
+    rates = {}
+    for pair in filter(None, setting.split(',')):
+        level, rate = pair.split('=')
+        rates[logging.getLevelName(level.strip().upper())] = float(rate)
+    return rates
+
+
+class RequestFilter(logging.Filter):
+    def filter(self, record):
+        """
+        Tags a record with the request id and endpoint of the request it was logged from, and drops sampled
+        records (logged with `sampled=True`) according to `LOG_SAMPLE`. Runs on the thread that logs the
+        record (a request thread, so the request context is available), before the record is queued.
+        """
+        if getattr(record, 'sampled', False) and random.random() >= LogPipeline.rates.get(record.levelno, 1.0):
+            return False
+
+        if has_request_context():
+            record.request_id = LogPipeline.request_id()
+            record.endpoint = request.endpoint
+        else:
+            record.request_id = None
+            record.endpoint = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        """
+        Formats a record as a single line JSON object.
+        """
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'endpoint': getattr(record, 'endpoint', None),
+            'thread': record.threadName,
+        }
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class DroppingQueueHandler(QueueHandler):
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1     # never block a request on a backed up log writer
+
+    def prepare(self, record):
+        # message and traceback are rendered here, so the writer thread never touches request state
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogPipeline:
+    rates = sample_rates(LOG_SAMPLE)
+    __listener = None
+    __handler = None
+    __exit_registered = False
+
+    @staticmethod
+    def init(log_file=LOG_FILE):
+        """
+        Routes the root logger through a bounded queue to a single writer thread, which writes JSON lines to
+        a size-rotated log file and plain text to the console. Logging calls on request threads only
+        render the message and enqueue it. Calling it again has no effect until `stop` is called.
+
+        :param log_file: The `log_file` parameter is the file written and rotated, `LOG_FILE` by default
+        """
+        if LogPipeline.__listener is not None:
+            return
+
+        file_handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+        file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else
+                                  logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+        handlers = [file_handler]
+
+        if LOG_CONSOLE is True:
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(logging.Formatter('%(message)s'))
+            handlers.append(console_handler)
+
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        LogPipeline.__handler = DroppingQueueHandler(log_queue)
+        LogPipeline.__handler.addFilter(RequestFilter())
+
+        root_logger = logging.getLogger()
+        root_logger.setLevel(logging.INFO)
+        root_logger.addHandler(LogPipeline.__handler)
+
+        LogPipeline.__listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        LogPipeline.__listener.start()
+        if LogPipeline.__exit_registered is False:
+            atexit.register(LogPipeline.stop)
+            LogPipeline.__exit_registered = True
+
+    @staticmethod
+    def stop():
+        """
+        Writes out the queued records and stops the writer thread. The process must not fork while the
+        writer thread runs, see `server.py`.
+        """
+        if LogPipeline.__listener is None:
+            return
+
+        logging.getLogger().removeHandler(LogPipeline.__handler)
+        LogPipeline.__listener.stop()
+        for handler in LogPipeline.__listener.handlers:
+            handler.close()
+        LogPipeline.__listener = None
+
+    @staticmethod
+    def request_id():
+        """
+        Returns the id of the current request: the client's `X-Request-ID` header if it sent one, otherwise
+        a generated id. Must be called inside a request context.
+        :return: the request id string.
+        """
+        if 'request_id' not in g:
+            g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex
+        return g.request_id
+
+    @staticmethod
+    def tag_response(response):
+        """
+        Echoes the request id in the `X-Request-ID` response header, so clients can quote it. Registered as
+        an `after_request` hook.
+
+        :param response: The `response` parameter is the outgoing response
+        :return: the response.
+        """
+        response.headers['X-Request-ID'] = LogPipeline.request_id()
+        return response
+
+
+Metrics.collector(lambda: [('anex_log_dropped_total', 'counter', 'Log records dropped because the log queue was full',
+                            DroppingQueueHandler.dropped)])
@@ -0,0 +1,250 @@
+from threading import Lock, current_thread, local
+from flask import g, has_request_context, request
+from sqlalchemy import event
+import bisect
+import functools
+import os
+import time
+
+METRICS_ENABLED = os.getenv('ANEX_METRICS', '1') == '1'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)   # seconds
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+# name -> (help, buckets); every histogram has to be declared here
+HISTOGRAMS = {
+    'anex_request_duration_seconds': ('Request latency by endpoint and method', LATENCY_BUCKETS),
+    'anex_request_sql_statements': ('SQL statements issued per request', COUNT_BUCKETS),
+    'anex_request_sql_seconds': ('Time spent in SQL statements per request', LATENCY_BUCKETS),
+    'anex_crypto_seconds': ('Time spent encrypting and decrypting, by operation', LATENCY_BUCKETS),
+    'anex_password_hash_seconds': ('Password hash and compare time, including pool queueing', LATENCY_BUCKETS),
+}
+
+# name -> help
+COUNTERS = {
+    'anex_requests_total': 'Requests by endpoint and status code',
+    'anex_sql_statements_total': 'SQL statements executed, including background threads',
+    'anex_sql_seconds_total': 'Time spent in SQL statements, including background threads',
+    'anex_crypto_bytes_total': 'Bytes encrypted and decrypted, by operation',
+}
+
+
+# counters and histograms are aggregated per thread: every thread only ever writes to its own store, so
+# recording takes no lock. A scrape sums the stores of all threads. The stores of threads that have ended
+# are folded into one retired store, so short-lived threads do not pile up. All of it is per process: with
+# several worker processes, each one's /metrics only covers the requests it served itself.
+class Metrics:
+    __local = local()
+    __stores = []               # (thread, store) for every live thread that recorded something
+    __retired = ({}, {})        # what ended threads recorded
+    __stores_lock = Lock()
+    __collectors = []
+
+    @staticmethod
+    def observe(name, labels, value):
+        """
+        Records a value in a histogram.
+
+        :param name: The `name` parameter is a histogram declared in `HISTOGRAMS`
+        :param labels: The `labels` parameter is a tuple of (label, value) pairs
+        :param value: The `value` parameter is the observed value
+        """
+        if METRICS_ENABLED is False:
+            return
+
+        histograms = Metrics.__store()[0]
+        series = histograms.get((name, labels))
+        if series is None:
+            series = histograms[(name, labels)] = [[0] * (len(HISTOGRAMS[name][1]) + 1), 0.0, 0]
+
+        series[0][bisect.bisect_left(HISTOGRAMS[name][1], value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @staticmethod
+    def inc(name, labels, amount=1):
+        """
+        Adds to a counter.
+
+        :param name: The `name` parameter is a counter declared in `COUNTERS`
+        :param labels: The `labels` parameter is a tuple of (label, value) pairs
+        :param amount: The `amount` parameter is added to the counter, defaults to 1 (optional)
+        """
+        if METRICS_ENABLED is False:
+            return
+
+        counters = Metrics.__store()[1]
+        counters[(name, labels)] = counters.get((name, labels), 0) + amount
+
+    @staticmethod
+    def timed(name, op, bytes_counter=None):
+        """
+        Decorates a function so each call is recorded in a histogram, labelled with `op`. With
+        `bytes_counter`, the length of the first argument is also added to that counter.
+
+        :param name: The `name` parameter is a histogram declared in `HISTOGRAMS`
+        :param op: The `op` parameter is the operation label value
+        :param bytes_counter: The `bytes_counter` parameter is a counter declared in `COUNTERS` (optional)
+        :return: the decorator.
+        """
+        labels = (('op', op),)
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    Metrics.observe(name, labels, time.perf_counter() - started)
+                    if bytes_counter is not None and args:
+                        Metrics.inc(bytes_counter, labels, len(args[0]))
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def collector(fn):
+        """
+        Registers a function whose values are added to every scrape, e.g. the counters another subsystem
+        keeps itself.
+
+        :param fn: The `fn` parameter returns a list of (name, type, help, value) tuples, where type is
+        'counter' or 'gauge'
+        """
+        Metrics.__collectors.append(fn)
+
+    @staticmethod
+    def init_app(app):
+        """
+        Records the latency, status and SQL usage of every request to the application, and counts every SQL
+        statement run on its engine.
+
+        :param app: The `app` parameter is the Flask application
+        """
+        if METRICS_ENABLED is False:
+            return
+
+        from exts import db
+
+        @app.before_request
+        def start_request():
+            g.metrics_started = time.perf_counter()
+            Metrics.__local.sql = [0, 0.0]
+
+        @app.after_request
+        def record_status(response):
+            g.metrics_status = response.status_code
+            return response
+
+        @app.teardown_request
+        def finish_request(exc):
+            started = g.pop('metrics_started', None)
+            sql = getattr(Metrics.__local, 'sql', None)
+            Metrics.__local.sql = None
+            if started is None:
+                return
+
+            endpoint = request.endpoint or 'none'
+            Metrics.observe('anex_request_duration_seconds', (('endpoint', endpoint), ('method', request.method)),
+                            time.perf_counter() - started)
+            Metrics.inc('anex_requests_total', (('endpoint', endpoint), ('status', str(g.pop('metrics_status', 500)))))
+            if sql is not None:
+                Metrics.observe('anex_request_sql_statements', (('endpoint', endpoint),), sql[0])
+                Metrics.observe('anex_request_sql_seconds', (('endpoint', endpoint),), sql[1])
+
+        with app.app_context():
+            engine = db.engine
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_statement(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def finish_statement(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+            Metrics.inc('anex_sql_statements_total', ())
+            Metrics.inc('anex_sql_seconds_total', (), elapsed)
+
+            sql = getattr(Metrics.__local, 'sql', None)
+            if sql is not None and has_request_context():
+                sql[0] += 1
+                sql[1] += elapsed
+
+    @staticmethod
+    def render():
+        """
+        Renders every metric of this process in the Prometheus text exposition format (version 0.0.4).
+        :return: the exposition text.
+        """
+        histograms = {}
+        counters = {}
+        with Metrics.__stores_lock:
+            Metrics.__retire_ended()
+            Metrics.__merge(Metrics.__retired, (histograms, counters))
+            stores = [store for _, store in Metrics.__stores]
+
+        for store in stores:
+            Metrics.__merge(store, (histograms, counters))
+
+        lines = []
+        for name, (help_text, bounds) in HISTOGRAMS.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+            for (series_name, labels), (buckets, total, count) in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(bounds + ('+Inf',), buckets):
+                    cumulative += bucket
+                    lines.append(f'{name}_bucket{Metrics.__labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{Metrics.__labels(labels)} {total}')
+                lines.append(f'{name}_count{Metrics.__labels(labels)} {count}')
+
+        for name, help_text in COUNTERS.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (series_name, labels), value in sorted(counters.items()):
+                if series_name == name:
+                    lines.append(f'{name}{Metrics.__labels(labels)} {value}')
+
+        for collector in Metrics.__collectors:
+            for name, kind, help_text, value in collector():
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}']
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __labels(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+    @staticmethod
+    def __merge(source, target):
+        # list() copies, as the source may be a live thread's store that is written to meanwhile
+        histograms, counters = target
+        for key, (buckets, total, count) in list(source[0].items()):
+            merged = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+            merged[1] += total
+            merged[2] += count
+        for key, value in list(source[1].items()):
+            counters[key] = counters.get(key, 0) + value
+
+    @staticmethod
+    def __retire_ended():
+        # called with the stores lock held; an ended thread cannot write to its store any more
+        ended = [store for thread, store in Metrics.__stores if not thread.is_alive()]
+        if ended:
+            Metrics.__stores = [(thread, store) for thread, store in Metrics.__stores if thread.is_alive()]
+            for store in ended:
+                Metrics.__merge(store, Metrics.__retired)
+
+    @staticmethod
+    def __store():
+        store = getattr(Metrics.__local, 'store', None)
+        if store is None:
+            store = Metrics.__local.store = ({}, {})
+            with Metrics.__stores_lock:
+                Metrics.__retire_ended()     # also bounded by the live threads when nothing scrapes
+                Metrics.__stores.append((current_thread(), store))
+        return store
@@ -0,0 +1,204 @@
+from datetime import datetime
+from sqlalchemy import bindparam, event, func, inspect, select, text, update
+from models import db
+from models import Data, License, SchemaVersion, Session, User
+from errors import LogLevel, log
+import re
+import secrets
+import sys
+import uuid
+
+
+def add_column(connection, column):
+    """
+    Adds a mapped column to its table if the table does not have it yet.
+
+    :param connection: The `connection` parameter is the connection the migration runs on
+    :param column: The `column` parameter is the model column, e.g. `Data.__table__.c.codec`
+    """
+    table = column.table
+    if column.name in {c['name'] for c in inspect(connection).get_columns(table.name)}:
+        return
+
+    preparer = connection.dialect.identifier_preparer
+    ddl = (f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} "
+           f"{column.type.compile(dialect=connection.dialect)}")
+    if column.server_default is not None:
+        ddl += f" DEFAULT '{column.server_default.arg}'"
+    if column.nullable is False:
+        ddl += " NOT NULL"
+    connection.execute(text(ddl))
+
+
+def add_index(connection, table, name):
+    """
+    Creates an index declared on a model if the database does not have it yet.
+
+    :param connection: The `connection` parameter is the connection the migration runs on
+    :param table: The `table` parameter is the model's table, e.g. `User.__table__`
+    :param name: The `name` parameter is the index name
+    """
+    next(index for index in table.indexes if index.name == name).create(connection, checkfirst=True)
+
+
+def migrate_data_storage(connection):
+    # codec (compression), userBlob (AES-GCM envelope) and etag columns of user data
+    for column in ('codec', 'userBlob', 'etag'):
+        add_column(connection, Data.__table__.c[column])
+
+
+def migrate_sweeper_indexes(connection):
+    add_index(connection, Session.__table__, 'idx_session_expires')
+    add_index(connection, License.__table__, 'idx_license_status_expires')
+
+
+def migrate_lookup_indexes(connection):
+    duplicates = connection.execute(
+        select(User.username).group_by(User.username).having(func.count() > 1)
+    ).scalars().all()
+    if duplicates:
+        raise RuntimeError(f"Cannot make usernames unique, duplicated: {', '.join(duplicates)}")
+
+    add_index(connection, User.__table__, 'uq_user_username')
+    add_index(connection, Session.__table__, 'idx_session_user')
+
+
+def migrate_keyed_etags(connection):
+    # etags were an unkeyed sha256 of the plaintext, which lets anyone reading the database confirm a guessed
+    # document; they are replaced by random version tokens, without decrypting anything, and every new
+    # version gets a keyed etag (Security.document_etag)
+    data = Data.__table__
+    ids = connection.execute(select(data.c.data_id).where(data.c.etag.is_not(None))).scalars().all()
+    for start in range(0, len(ids), 1000):
+        connection.execute(update(data).where(data.c.data_id == bindparam('b_id')).values(etag=bindparam('b_etag')),
+                           [{'b_id': data_id, 'b_etag': secrets.token_hex(32)} for data_id in ids[start:start + 1000]])
+
+
+# (version, description, migration); append only, never renumber or edit an applied migration
+MIGRATIONS = [
+    (1, 'Data codec, binary envelope and etag columns', migrate_data_storage),
+    (2, 'Session and license expiry indexes', migrate_sweeper_indexes),
+    (3, 'Unique username and session user indexes', migrate_lookup_indexes),
+    (4, 'Replace unkeyed document etags', migrate_keyed_etags),
+]
+
+
+class Migrations:
+    @staticmethod
+    def current_version():
+        """
+        Returns the schema version of the database. Must be called inside an application context.
+        :return: the highest applied migration version, 0 if none has been applied.
+        """
+        return db.session.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+    @staticmethod
+    def run():
+        """
+        Applies every migration newer than the database's schema version, each in its own transaction
+        together with the record of its version. Migrations only add what is missing, so they are also safe
+        on databases that `db.create_all()` has just created. Must be called inside an application context,
+        after `db.create_all()`.
+        :return: the list of versions applied.
+        """
+        current = Migrations.current_version()
+        db.session.commit()
+
+        applied = []
+        for version, description, migration in MIGRATIONS:
+            if version <= current:
+                continue
+
+            with db.engine.begin() as connection:
+                migration(connection)
+                connection.execute(SchemaVersion.__table__.insert().values(
+                    version=version, description=description, applied=datetime.now()))
+
+            log(f"Applied schema migration {version}: {description}", LogLevel.INFO)
+            applied.append(version)
+        return applied
+
+
+class QueryPlan:
+    @staticmethod
+    def lookups():
+        """
+        Returns the lookups whose queries are checked, each with sample arguments.
+        :return: a list of (name, function, arguments) tuples.
+        """
+        from user import UserLookup
+        from session import SessionLookup
+        from license import LicenseLookUp
+        from data import DataLookup
+
+        key = uuid.uuid4()
+        return [
+            ('UserLookup.id', UserLookup.id, (str(key),)),
+            ('UserLookup.username', UserLookup.username, ('anexplancheck',)),
+            ('UserLookup.email', UserLookup.email, ('plan@check.anex',)),
+            ('UserLookup.login', UserLookup.login, ('anexplancheck',)),
+            ('UserLookup.taken', UserLookup.taken, ({'anexplancheck'}, {'plan@check.anex'})),
+            ('SessionLookup.record_by_skey', SessionLookup.record_by_skey, (key,)),
+            ('SessionLookup.record_by_user_id', SessionLookup.record_by_user_id, (key,)),
+            ('LicenseLookUp.by_license_key', LicenseLookUp.by_license_key, (key,)),
+            ('LicenseLookUp.by_license_keys', LicenseLookUp.by_license_keys, ({str(key)},)),
+            ('DataLookup.latest', DataLookup.latest, (key,)),
+            ('DataLookup.latest_etag', DataLookup.latest_etag, (key,)),
+        ]
+
+    @staticmethod
+    def plans():
+        """
+        Runs every lookup, captures the SQL it issues, and runs `EXPLAIN QUERY PLAN` on each statement.
+        SQLite only. Must be called inside an application context.
+        :return: a list of (lookup name, statement, plan detail) tuples, one per plan row.
+        """
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        plans = []
+        for name, lookup, args in QueryPlan.lookups():
+            statements.clear()
+            event.listen(db.engine, 'before_cursor_execute', capture)
+            try:
+                lookup(*args)
+            except Exception:
+                pass    # lookups may fail on the made up arguments, the SQL they issued is still checked
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', capture)
+                db.session.rollback()
+
+            for statement, parameters in list(statements):
+                plan = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)
+                plans.extend((name, statement, row[-1]) for row in plan)
+        return plans
+
+    @staticmethod
+    def check():
+        """
+        Checks the lookups' query plans for full table scans. SQLite only. Must be called inside an
+        application context.
+        :return: a list of (lookup name, statement, plan detail) tuples for every full table scan found.
+        """
+        return [(name, statement, detail) for name, statement, detail in QueryPlan.plans()
+                if re.match(r'^SCAN (TABLE )?\S+$', detail)]
+
+
+if __name__ == '__main__':
+    # python migrations.py                 apply pending migrations
+    # python migrations.py --check-plans   also fail (exit 1) if a lookup query does a full table scan
+    from app import create_app
+    app = create_app()      # applies the migrations
+
+    with app.app_context():
+        print('Schema version:', Migrations.current_version())
+
+        if '--check-plans' in sys.argv:
+            full_scans = QueryPlan.check()
+            for lookup_name, sql, detail in full_scans:
+                print(f'FULL SCAN in {lookup_name}: {detail}\n    {sql}')
+            print('Query plans:', 'FAIL' if full_scans else 'OK')
+            sys.exit(1 if full_scans else 0)
@@ -31,6 +31,10 @@ class User(db.Model):
     created = db.Column(DateTime(timezone=True), server_default=func.now())
     updated = db.Column(DateTime(timezone=True), onupdate=func.now())
 
+    __table_args__ = (
+        db.Index('uq_user_username', 'username', unique=True),
+    )
+
 
 @dataclass
 class Session(db.Model):
@@ -52,17 +56,28 @@ class Session(db.Model):
 
     user = db.relationship('User', backref=db.backref('ses_user', lazy=True))
 
+    __table_args__ = (
+        db.Index('idx_session_expires', 'expires'),
+        db.Index('idx_session_user', 'user_id'),
+    )
+
 
 @dataclass
 class Data(db.Model):
     id: int
     userData: str
+    userBlob: bytes
+    codec: str
+    etag: str
     user_id: uuid
     created: DateTime
     updated: DateTime
 
     id = db.Column('data_id', db.Integer, primary_key=True, autoincrement=True)
-    userData = db.Column(db.String, unique=False, nullable=True)
+    userData = db.Column(db.String, unique=False, nullable=True)        # legacy Fernet token
+    userBlob = db.Column(db.LargeBinary, unique=False, nullable=True)   # AES-GCM envelope
+    codec = db.Column(db.String(16), nullable=False, default='identity', server_default='identity')
+    etag = db.Column(db.String(64), unique=False, nullable=True)       # keyed HMAC-SHA256 of the document
     user_id = db.Column(db.Text(length=36), db.ForeignKey('user.user_id'), unique=False)
     created = db.Column(DateTime(timezone=True), server_default=func.now())
     updated = db.Column(DateTime(timezone=True), onupdate=func.now())
@@ -92,6 +107,10 @@ class License(db.Model):
     created = db.Column(DateTime(timezone=True), server_default=func.now())
     updated = db.Column(DateTime(timezone=True), onupdate=func.now())
 
+    __table_args__ = (
+        db.Index('idx_license_status_expires', 'status', 'expires'),
+    )
+
 
 @dataclass
 class Admin(db.Model):
@@ -104,3 +123,52 @@ class Admin(db.Model):
     status = db.Column(db.String, unique=False, nullable=False)
     created = db.Column(DateTime(timezone=True), server_default=func.now())
     updated = db.Column(DateTime(timezone=True), onupdate=func.now())
+
+
+@dataclass
+class Lockout(db.Model):
+    id: str
+    until: DateTime
+
+    id = db.Column('lockout_key', db.String, primary_key=True)   # "user:<username>" or "addr:<address>"
+    until = db.Column(DateTime(timezone=True), nullable=False)
+
+
+@dataclass
+class Revocation(db.Model):
+    user_id: uuid
+    revoked_before: int
+    until: DateTime
+
+    user_id = db.Column(db.Text(length=36), primary_key=True)
+    revoked_before = db.Column(db.BigInteger, nullable=False)      # ms, tokens issued up to here are revoked
+    until = db.Column(DateTime(timezone=True), nullable=False)     # every revoked token has expired by then
+
+
+@dataclass
+class RotationCheckpoint(db.Model):
+    key_id: str
+    last_data_id: int
+    rows_done: int
+    bytes_done: int
+    admins_done: bool
+    finished: DateTime
+
+    key_id = db.Column(db.String(8), primary_key=True)     # hex id of the master key rows are moved to
+    last_data_id = db.Column(db.Integer, nullable=False, default=0)
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    bytes_done = db.Column(db.BigInteger, nullable=False, default=0)
+    admins_done = db.Column(db.Boolean, nullable=False, default=False)
+    updated = db.Column(DateTime(timezone=True), onupdate=func.now())
+    finished = db.Column(DateTime(timezone=True), nullable=True)
+
+
+@dataclass
+class SchemaVersion(db.Model):
+    version: int
+    description: str
+    applied: DateTime
+
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String, nullable=False)
+    applied = db.Column(DateTime(timezone=True), nullable=False)
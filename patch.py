@@ -0,0 +1,172 @@
+import copy
+
+
+class PatchError(ValueError):
+    pass
+
+
+class JsonPatch:
+    @staticmethod
+    def apply(document, operations):
+        """
+        Applies an RFC 6902 JSON Patch to a document. The operations are applied to a copy, so the
+        document is left untouched if any of them fails.
+
+        :param document: The `document` parameter is the parsed JSON document
+        :param operations: The `operations` parameter is the list of patch operations
+        :return: the patched document.
+        """
+        if not isinstance(operations, list):
+            raise PatchError("JSON Patch must be a list of operations")
+
+        document = copy.deepcopy(document)
+        for operation in operations:
+            if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+                raise PatchError("Operation requires 'op' and 'path'")
+
+            op = operation['op']
+            path = JsonPatch.__pointer(operation, 'path')
+
+            if op == 'add':
+                document = JsonPatch.__add(document, path, JsonPatch.__value(operation))
+            elif op == 'remove':
+                document, _ = JsonPatch.__remove(document, path)
+            elif op == 'replace':
+                document, _ = JsonPatch.__remove(document, path)
+                document = JsonPatch.__add(document, path, JsonPatch.__value(operation))
+            elif op == 'move':
+                from_path = JsonPatch.__from(operation)
+                if path.startswith(from_path + '/'):
+                    raise PatchError("Cannot move a value into one of its children")
+                document, value = JsonPatch.__remove(document, from_path)
+                document = JsonPatch.__add(document, path, value)
+            elif op == 'copy':
+                value = JsonPatch.__get(document, JsonPatch.__from(operation))
+                document = JsonPatch.__add(document, path, copy.deepcopy(value))
+            elif op == 'test':
+                if not JsonPatch.__equal(JsonPatch.__get(document, path), JsonPatch.__value(operation)):
+                    raise PatchError(f"Test failed at '{path}'")
+            else:
+                raise PatchError(f"Unknown operation '{op}'")
+
+        return document
+
+    @staticmethod
+    def merge(document, patch):
+        """
+        Applies an RFC 7396 JSON Merge Patch to a document.
+
+        :param document: The `document` parameter is the parsed JSON document
+        :param patch: The `patch` parameter is the merge patch; `null` members remove keys
+        :return: the patched document.
+        """
+        if not isinstance(patch, dict):
+            return copy.deepcopy(patch)
+
+        result = dict(document) if isinstance(document, dict) else {}
+        for key, value in patch.items():
+            if value is None:
+                result.pop(key, None)
+            else:
+                result[key] = JsonPatch.merge(result.get(key), value)
+        return result
+
+    @staticmethod
+    def __value(operation):
+        if 'value' not in operation:
+            raise PatchError(f"Operation '{operation['op']}' requires 'value'")
+        return operation['value']
+
+    @staticmethod
+    def __from(operation):
+        if 'from' not in operation:
+            raise PatchError(f"Operation '{operation['op']}' requires 'from'")
+        return JsonPatch.__pointer(operation, 'from')
+
+    @staticmethod
+    def __pointer(operation, member):
+        if not isinstance(operation[member], str):
+            raise PatchError(f"Operation '{member}' must be a JSON pointer string")
+        return operation[member]
+
+    @staticmethod
+    def __equal(a, b):
+        # compared by type as well as value, all the way down: 1 does not match 1.0 or true
+        if type(a) is not type(b):
+            return False
+        if isinstance(a, dict):
+            return a.keys() == b.keys() and all(JsonPatch.__equal(a[key], b[key]) for key in a)
+        if isinstance(a, list):
+            return len(a) == len(b) and all(JsonPatch.__equal(x, y) for x, y in zip(a, b))
+        return a == b
+
+    @staticmethod
+    def __tokens(path):
+        # RFC 6901 JSON Pointer
+        if path == '':
+            return []
+        if not isinstance(path, str) or not path.startswith('/'):
+            raise PatchError(f"Invalid JSON pointer '{path}'")
+        return [token.replace('~1', '/').replace('~0', '~') for token in path[1:].split('/')]
+
+    @staticmethod
+    def __index(container, token, allow_end=False):
+        if allow_end and token == '-':
+            return len(container)
+        if not (token.isascii() and token.isdigit()) or (len(token) > 1 and token[0] == '0'):
+            raise PatchError(f"Invalid array index '{token}'")
+
+        index = int(token)
+        if index > len(container) or (index == len(container) and not allow_end):
+            raise PatchError(f"Array index '{token}' out of range")
+        return index
+
+    @staticmethod
+    def __get(document, path):
+        return JsonPatch.__walk(document, JsonPatch.__tokens(path), path)
+
+    @staticmethod
+    def __walk(document, tokens, path):
+        for token in tokens:
+            if isinstance(document, dict):
+                if token not in document:
+                    raise PatchError(f"Path '{path}' does not exist")
+                document = document[token]
+            elif isinstance(document, list):
+                document = document[JsonPatch.__index(document, token)]
+            else:
+                raise PatchError(f"Path '{path}' does not exist")
+        return document
+
+    @staticmethod
+    def __parent(document, path):
+        tokens = JsonPatch.__tokens(path)
+        return JsonPatch.__walk(document, tokens[:-1], path), tokens[-1]
+
+    @staticmethod
+    def __add(document, path, value):
+        if path == '':
+            return value
+
+        parent, token = JsonPatch.__parent(document, path)
+        if isinstance(parent, dict):
+            parent[token] = value
+        elif isinstance(parent, list):
+            parent.insert(JsonPatch.__index(parent, token, allow_end=True), value)
+        else:
+            raise PatchError(f"Path '{path}' does not exist")
+        return document
+
+    @staticmethod
+    def __remove(document, path):
+        if path == '':
+            return None, document
+
+        parent, token = JsonPatch.__parent(document, path)
+        if isinstance(parent, dict):
+            if token not in parent:
+                raise PatchError(f"Path '{path}' does not exist")
+            return document, parent.pop(token)
+        if isinstance(parent, list):
+            return document, parent.pop(JsonPatch.__index(parent, token))
+        raise PatchError(f"Path '{path}' does not exist")
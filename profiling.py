@@ -0,0 +1,182 @@
+from collections import Counter
+from datetime import datetime
+from threading import Condition, Lock, Thread, get_ident
+from flask import g, request
+from admin import AdminKeyCache
+from errors import LogLevel, log
+from logs import LogPipeline
+from validation import Validate
+import atexit
+import cProfile
+import os
+import pstats
+import random
+import re
+import sys
+import time
+
+PROFILE_ENABLED = os.getenv('ANEX_PROFILE', '0') == '1'          # hooks are only installed when enabled
+PROFILE_MODE = os.getenv('ANEX_PROFILE_MODE', 'sample')          # 'sample' or 'cprofile'
+PROFILE_RATE = float(os.getenv('ANEX_PROFILE_RATE', 0))          # share of requests profiled at random
+PROFILE_DIR = os.getenv('ANEX_PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL = float(os.getenv('ANEX_PROFILE_INTERVAL', 5))  # milliseconds between samples
+PROFILE_HEADER = 'X-Anex-Profile'                                # carrying an admin key, profiles the request
+AGGREGATE_WRITE_INTERVAL = 10                                    # seconds
+UNSAFE_NAME_CHARS = re.compile(r'[^A-Za-z0-9_-]')                 # replaced in profile file names
+
+
+class StackSampler:
+    __active = {}       # thread id -> Counter of collapsed stacks
+    __condition = Condition()
+    __thread = None
+
+    @staticmethod
+    def start():
+        """
+        Starts sampling the calling thread's stack every `PROFILE_INTERVAL` milliseconds.
+        """
+        with StackSampler.__condition:
+            StackSampler.__active[get_ident()] = Counter()
+            if StackSampler.__thread is None:
+                StackSampler.__thread = Thread(target=StackSampler.__sample_loop, name='anex-profiler', daemon=True)
+                StackSampler.__thread.start()
+            StackSampler.__condition.notify()
+
+    @staticmethod
+    def stop():
+        """
+        Stops sampling the calling thread.
+        :return: a Counter of collapsed stacks ("outer;inner;innermost") to the number of samples.
+        """
+        with StackSampler.__condition:
+            return StackSampler.__active.pop(get_ident(), Counter())
+
+    @staticmethod
+    def __sample_loop():
+        # sleeps until a request is being sampled, so an idle profiler costs nothing
+        while True:
+            with StackSampler.__condition:
+                while not StackSampler.__active:
+                    StackSampler.__condition.wait()
+            time.sleep(PROFILE_INTERVAL / 1000)
+
+            frames = sys._current_frames()
+            with StackSampler.__condition:
+                for thread_id, stacks in StackSampler.__active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[StackSampler.__collapse(frame)] += 1
+
+    @staticmethod
+    def __collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+class Profiler:
+    __aggregate = Counter()     # sample mode: collapsed stack -> samples, over every profiled request
+    __aggregate_stats = None    # cprofile mode: merged pstats.Stats
+    __lock = Lock()
+    __written = 0
+
+    @staticmethod
+    def init(blueprint):
+        """
+        Installs the profiling hooks on a blueprint, when `ANEX_PROFILE=1`. A request is profiled when it
+        carries a valid admin key in the `X-Anex-Profile` header, or at random for `ANEX_PROFILE_RATE` of
+        requests. Each profiled request is written to `ANEX_PROFILE_DIR`, and all of them are aggregated in
+        `aggregate.folded` (sample mode, collapsed stacks for flame graph tools) or `aggregate.prof`
+        (cprofile mode). Must be called before the blueprint is registered.
+
+        :param blueprint: The `blueprint` parameter is the blueprint whose requests may be profiled
+        """
+        if PROFILE_ENABLED is False:
+            return
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        blueprint.before_request(Profiler.start)
+        blueprint.teardown_request(Profiler.finish)
+        atexit.register(Profiler.write_aggregate)
+
+    @staticmethod
+    def wanted():
+        """
+        Decides whether the current request is profiled.
+        :return: True if the request carries an admin key in `X-Anex-Profile` or is picked at random.
+        """
+        key = request.headers.get(PROFILE_HEADER)
+        if key is not None and Validate.uuid_form(key.lower()) and AdminKeyCache.contains(key):
+            return True
+        return PROFILE_RATE > 0 and random.random() < PROFILE_RATE
+
+    @staticmethod
+    def start():
+        if not Profiler.wanted():
+            return
+
+        g.profile_started = time.perf_counter()
+        if PROFILE_MODE == 'cprofile':
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+        else:
+            StackSampler.start()
+
+    @staticmethod
+    def finish(exc):
+        started = g.pop('profile_started', None)
+        if started is None:
+            return
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        # the request id can come from the client's X-Request-ID, it must not be able to leave PROFILE_DIR
+        request_id = UNSAFE_NAME_CHARS.sub('_', LogPipeline.request_id())
+        name = f"{datetime.now():%Y%m%d-%H%M%S}-{request.endpoint or 'none'}-{request_id}-{elapsed_ms:.0f}ms"
+
+        try:
+            if PROFILE_MODE == 'cprofile':
+                profile = g.pop('profile')
+                profile.disable()
+                profile.dump_stats(os.path.join(PROFILE_DIR, name + '.prof'))
+                with Profiler.__lock:
+                    if Profiler.__aggregate_stats is None:
+                        Profiler.__aggregate_stats = pstats.Stats(profile)
+                    else:
+                        Profiler.__aggregate_stats.add(profile)
+            else:
+                stacks = StackSampler.stop()
+                Profiler.__write_folded(os.path.join(PROFILE_DIR, name + '.folded'), stacks)
+                with Profiler.__lock:
+                    Profiler.__aggregate.update(stacks)
+
+        except OSError as e:
+            log("Failed to write request profile: ", LogLevel.ERROR, str(e))
+            return
+
+        if time.monotonic() - Profiler.__written > AGGREGATE_WRITE_INTERVAL:
+            Profiler.write_aggregate()
+
+    @staticmethod
+    def write_aggregate():
+        """
+        Writes the aggregate of every request profiled so far to `ANEX_PROFILE_DIR`.
+        """
+        with Profiler.__lock:
+            Profiler.__written = time.monotonic()
+            try:
+                if Profiler.__aggregate_stats is not None:
+                    Profiler.__aggregate_stats.dump_stats(os.path.join(PROFILE_DIR, 'aggregate.prof'))
+                if Profiler.__aggregate:
+                    Profiler.__write_folded(os.path.join(PROFILE_DIR, 'aggregate.folded'), Profiler.__aggregate)
+
+            except OSError as e:
+                log("Failed to write aggregate profile: ", LogLevel.ERROR, str(e))
+
+    @staticmethod
+    def __write_folded(path, stacks):
+        with open(path + '.tmp', 'w') as folded:
+            folded.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,222 @@
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from sqlalchemy import delete
+from models import db
+from models import Lockout
+from errors import LogLevel, log
+import atexit
+import os
+import time
+
+RATE_LIMIT_SHARDS = int(os.getenv('ANEX_RATE_LIMIT_SHARDS', 64))
+RATE_LIMIT_SHARD_SIZE = int(os.getenv('ANEX_RATE_LIMIT_SHARD_SIZE', 4096))   # buckets before idle ones are pruned
+RATE_LIMIT_PRUNE_INTERVAL = int(os.getenv('ANEX_RATE_LIMIT_PRUNE_INTERVAL', 60))  # seconds between idle prunes
+USERNAME_BURST = int(os.getenv('ANEX_LOGIN_USERNAME_BURST', 5))              # unsuccessful logins before lockout
+USERNAME_RATE = float(os.getenv('ANEX_LOGIN_USERNAME_RATE', 1 / 60))         # logins regained per second
+ADDRESS_BURST = int(os.getenv('ANEX_LOGIN_ADDRESS_BURST', 30))               # login requests before lockout
+ADDRESS_RATE = float(os.getenv('ANEX_LOGIN_ADDRESS_RATE', 1))                # login requests regained per second
+LOCKOUT_PERIOD = int(os.getenv('ANEX_LOGIN_LOCKOUT', 60))                    # seconds
+LOCKOUT_PERSIST = os.getenv('ANEX_LOCKOUT_PERSIST', '0') == '1'
+LOCKOUT_FLUSH_INTERVAL = int(os.getenv('ANEX_LOCKOUT_FLUSH_INTERVAL', 10))   # seconds
+
+
+class TokenBucketLimiter:
+    def __init__(self, capacity, refill_rate, lockout, shards=RATE_LIMIT_SHARDS):
+        """
+        Initialises a token bucket limiter whose buckets are spread over lock-striped shards, so concurrent
+        requests for different keys rarely contend. Buckets live in this process's memory; a shard drops the
+        buckets that have refilled when it is full, and at most every `RATE_LIMIT_PRUNE_INTERVAL` seconds.
+
+        :param capacity: The `capacity` parameter is the number of tokens a full bucket holds
+        :param refill_rate: The `refill_rate` parameter is the number of tokens regained per second
+        :param lockout: The `lockout` parameter is the number of seconds a key is locked out once its bucket
+        runs dry
+        :param shards: The `shards` parameter is the number of independently locked shards
+        """
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.lockout = lockout
+        self.__shards = [(Lock(), {}, [time.time()]) for _ in range(shards)]     # lock, buckets, [pruned at]
+
+    def retry_after(self, key):
+        """
+        Checks a key without consuming a token.
+
+        :param key: The `key` parameter is the key being limited
+        :return: the number of seconds until the key may try again, 0 if it may try now.
+        """
+        lock, buckets, _ = self.__shard(key)
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                return 0
+            return self.__retry_after(bucket, time.time())
+
+    def consume(self, key):
+        """
+        Takes a token for a key, locking the key out when its bucket runs dry.
+
+        :param key: The `key` parameter is the key being limited
+        :return: the number of seconds until the key may try again, 0 if the token was granted.
+        """
+        lock, buckets, pruned = self.__shard(key)
+        now = time.time()
+        with lock:
+            if len(buckets) >= RATE_LIMIT_SHARD_SIZE or now - pruned[0] >= RATE_LIMIT_PRUNE_INTERVAL:
+                self.__prune(buckets, now)
+                pruned[0] = now
+
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = [float(self.capacity), now, 0.0]
+
+            retry_after = self.__retry_after(bucket, now)
+            if retry_after > 0:
+                return retry_after
+
+            bucket[0] -= 1
+            if bucket[0] < 1:
+                bucket[2] = now + self.lockout
+            return 0
+
+    def reset(self, key):
+        """
+        Forgets a key, restoring its full allowance.
+
+        :param key: The `key` parameter is the key being limited
+        """
+        lock, buckets, _ = self.__shard(key)
+        with lock:
+            buckets.pop(key, None)
+
+    def lock(self, key, until):
+        """
+        Locks a key out until a given time, e.g. to restore a persisted lockout.
+
+        :param key: The `key` parameter is the key being limited
+        :param until: The `until` parameter is the unix time the lockout ends
+        """
+        lock, buckets, _ = self.__shard(key)
+        with lock:
+            buckets[key] = [0.0, time.time(), until]
+
+    def lockouts(self):
+        """
+        Returns every key that is currently locked out.
+
+        :return: a dictionary of key to the unix time its lockout ends.
+        """
+        now = time.time()
+        locked = {}
+        for lock, buckets, _ in self.__shards:
+            with lock:
+                locked.update({key: bucket[2] for key, bucket in buckets.items() if bucket[2] > now})
+        return locked
+
+    def __shard(self, key):
+        return self.__shards[hash(key) % len(self.__shards)]
+
+    def __retry_after(self, bucket, now):
+        if bucket[2] > now:
+            return bucket[2] - now
+
+        bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.refill_rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return (1 - bucket[0]) / self.refill_rate
+        return 0
+
+    def __prune(self, buckets, now):
+        # buckets that have refilled carry no state worth keeping
+        for key in [key for key, bucket in buckets.items()
+                    if bucket[2] <= now and bucket[0] + (now - bucket[1]) * self.refill_rate >= self.capacity]:
+            del buckets[key]
+
+
+class LoginLimiter:
+    # the limits are kept per worker process: with N workers, a client can make up to N times the
+    # configured attempts (lockouts are only shared through the `Lockout` table, when persisted)
+    usernames = TokenBucketLimiter(USERNAME_BURST, USERNAME_RATE, LOCKOUT_PERIOD)
+    addresses = TokenBucketLimiter(ADDRESS_BURST, ADDRESS_RATE, LOCKOUT_PERIOD)
+    __stop = Event()
+    __thread = None
+
+    @staticmethod
+    def admit(username, address):
+        """
+        Decides whether a login attempt may go ahead, before any database query or password hash. Every
+        attempt uses up some of the client address's allowance, and reserves one of the username's, which
+        is given back by `succeeded`. Reserving up front means concurrent guesses against one username are
+        counted before any of them is checked, not only once they have failed.
+
+        :param username: The `username` parameter is the username being logged in to
+        :param address: The `address` parameter is the client's address
+        :return: the number of seconds until the client may try again, 0 if the attempt may go ahead.
+        """
+        retry_after = LoginLimiter.addresses.consume(address)
+        if retry_after > 0:
+            return retry_after
+        return LoginLimiter.usernames.consume(username)
+
+    @staticmethod
+    def succeeded(username):
+        """
+        Gives back the token reserved by `admit` and clears the failed login count of a username after a
+        successful login.
+
+        :param username: The `username` parameter is the username that logged in
+        """
+        LoginLimiter.usernames.reset(username)
+
+    @staticmethod
+    def init(app):
+        """
+        When `ANEX_LOCKOUT_PERSIST=1`, restores the lockouts saved in the `Lockout` table and starts the
+        background thread that periodically saves them, so lockouts survive a restart.
+
+        :param app: The `app` parameter is the Flask application, whose context the flush runs in
+        """
+        if LOCKOUT_PERSIST is False or LoginLimiter.__thread is not None:
+            return
+
+        with app.app_context():
+            LoginLimiter.restore()
+
+        def flush_loop():
+            while not LoginLimiter.__stop.wait(LOCKOUT_FLUSH_INTERVAL):
+                with app.app_context():
+                    LoginLimiter.flush()
+
+        LoginLimiter.__thread = Thread(target=flush_loop, name='anex-lockout-flush', daemon=True)
+        LoginLimiter.__thread.start()
+        atexit.register(LoginLimiter.__stop.set)
+
+    @staticmethod
+    def restore():
+        """
+        Loads the unexpired lockouts from the `Lockout` table. Must be called inside an application context.
+        """
+        now = datetime.now()
+        for lockout in Lockout.query.filter(Lockout.until > now).all():
+            kind, key = lockout.id.split(':', 1)
+            limiter = LoginLimiter.usernames if kind == 'user' else LoginLimiter.addresses
+            limiter.lock(key, time.time() + (lockout.until - now).total_seconds())
+
+    @staticmethod
+    def flush():
+        """
+        Saves the current lockouts to the `Lockout` table and removes expired ones, in one transaction.
+        Must be called inside an application context.
+        """
+        lockouts = {f'user:{key}': until for key, until in LoginLimiter.usernames.lockouts().items()}
+        lockouts.update({f'addr:{key}': until for key, until in LoginLimiter.addresses.lockouts().items()})
+
+        try:
+            db.session.execute(delete(Lockout).where(Lockout.until <= datetime.now()))
+            for key, until in lockouts.items():
+                db.session.merge(Lockout(id=key, until=datetime.fromtimestamp(until)))
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            log("Failed to flush login lockouts: ", LogLevel.ERROR, str(e))
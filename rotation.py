@@ -0,0 +1,245 @@
+from datetime import datetime
+from threading import Event, Lock, Thread
+from sqlalchemy import and_, bindparam, func, or_, select, update
+from models import db
+from models import Admin, Data, RotationCheckpoint
+from admin import AdminKeyCache
+from security import Security, aes_key_id, master_keys
+from metrics import Metrics
+from errors import LogLevel, log
+import atexit
+import os
+import time
+
+ROTATE_ENABLED = os.getenv('ANEX_KEY_ROTATE', '1') == '1'                       # runs while previous keys are set
+ROTATE_BATCH_ROWS = int(os.getenv('ANEX_KEY_ROTATE_BATCH', 500))                 # rows per transaction
+ROTATE_BATCH_BYTES = int(os.getenv('ANEX_KEY_ROTATE_BATCH_BYTES', 64 * 1024 * 1024))  # envelope bytes per batch
+ROTATE_PAUSE = float(os.getenv('ANEX_KEY_ROTATE_PAUSE', 0.05))                   # seconds between batches
+ROTATE_RATE = int(os.getenv('ANEX_KEY_ROTATE_RATE', 0))                          # bytes per second, 0 is unlimited
+
+
+class KeyRotation:
+    __stats = {
+        'rows_rotated': 0,
+        'bytes_rotated': 0,
+        'last_data_id': 0,
+        'running': 0,
+    }
+    __lock = Lock()
+    __stop = Event()
+    __thread = None
+
+    @staticmethod
+    def init(app):
+        """
+        When previous master keys are configured (`ANEX_PREVIOUS_MASTER_KEYS`), starts the background thread
+        that re-encrypts the `Admin` rows, every `Data` envelope and every legacy Fernet `Data` row not yet
+        migrated under the current key. Progress is
+        checkpointed in the `RotationCheckpoint` table, so a restart resumes where it stopped. Once it has
+        finished, the previous keys can be removed. Disabled by setting `ANEX_KEY_ROTATE=0`.
+
+        :param app: The `app` parameter is the Flask application, whose context the rotation runs in
+        """
+        if ROTATE_ENABLED is False or len(master_keys) < 2 or KeyRotation.__thread is not None:
+            return
+
+        def rotate_loop():
+            with app.app_context():
+                KeyRotation.run()
+
+        KeyRotation.__thread = Thread(target=rotate_loop, name='anex-key-rotation', daemon=True)
+        KeyRotation.__thread.start()
+        atexit.register(KeyRotation.__stop.set)
+
+    @staticmethod
+    def run():
+        """
+        Rotates every row not yet under the current key, batch by batch, until done or stopped. Must be
+        called inside an application context.
+        :return: True if the rotation finished.
+        """
+        checkpoint = KeyRotation.checkpoint()
+        if checkpoint.finished is not None:
+            return True
+
+        with KeyRotation.__lock:
+            KeyRotation.__stats['running'] = 1
+            KeyRotation.__stats['last_data_id'] = checkpoint.last_data_id
+
+        try:
+            if checkpoint.admins_done is False:
+                KeyRotation.rotate_admins()
+
+            while not KeyRotation.__stop.is_set():
+                started = time.monotonic()
+                rows, size = KeyRotation.run_batch()
+                if rows == 0:
+                    break
+
+                # throttle: a fixed pause, stretched to keep under ANEX_KEY_ROTATE_RATE bytes per second
+                pause = ROTATE_PAUSE
+                if ROTATE_RATE > 0:
+                    pause = max(pause, size / ROTATE_RATE - (time.monotonic() - started))
+                KeyRotation.__stop.wait(pause)
+
+        except Exception as e:
+            db.session.rollback()
+            log("Key rotation failed, it resumes from the last checkpoint on restart: ", LogLevel.ERROR, str(e))
+            return False
+
+        finally:
+            with KeyRotation.__lock:
+                KeyRotation.__stats['running'] = 0
+
+        if KeyRotation.__stop.is_set():
+            return False
+
+        checkpoint = KeyRotation.checkpoint()
+        checkpoint.finished = datetime.now()
+        db.session.commit()
+        log(f"Key rotation finished after {checkpoint.rows_done} rows, previous master keys can be removed",
+            LogLevel.INFO)
+        return True
+
+    @staticmethod
+    def checkpoint():
+        """
+        Returns the rotation checkpoint for the current key, creating it if this is the first run.
+        :return: a `RotationCheckpoint` row.
+        """
+        checkpoint = db.session.get(RotationCheckpoint, aes_key_id.hex())
+        if checkpoint is None:
+            checkpoint = RotationCheckpoint(key_id=aes_key_id.hex(), last_data_id=0, rows_done=0, bytes_done=0,
+                                            admins_done=False)
+            db.session.add(checkpoint)
+            db.session.commit()
+        return checkpoint
+
+    @staticmethod
+    def rotate_admins():
+        """
+        Re-encrypts the admin keys not yet under the current key. There are only a handful, so this is one
+        transaction.
+        """
+        for admin_row in Admin.query.all():
+            if Security.fernet_current_key(admin_row.id) is False:
+                db.session.execute(update(Admin).where(Admin.id == admin_row.id)
+                                   .values(id=Security.fernet_rotate(admin_row.id))
+                                   .execution_options(synchronize_session=False))
+
+        KeyRotation.checkpoint().admins_done = True
+        db.session.commit()
+        db.session.expire_all()
+        AdminKeyCache.invalidate()
+
+    @staticmethod
+    def run_batch():
+        """
+        Re-encrypts the next batch of `Data` rows after the checkpoint that are not under the current key:
+        at most `ROTATE_BATCH_ROWS` rows and, past the first row, `ROTATE_BATCH_BYTES` bytes. Envelopes are
+        found from the key id in their header; legacy Fernet rows carry no key id, so every one is a
+        candidate and those the current key already decrypts are skipped. They are rotated here rather than
+        left to `DataMigrate`, which may be disabled or not yet done, so no row still needs a previous key
+        once the walk ends. Payloads are decrypted and encrypted outside any transaction, and the new
+        values are written together with the checkpoint in one short transaction.
+        :return: a tuple of the number of rows and bytes rotated.
+        """
+        checkpoint = KeyRotation.checkpoint()
+        candidates = db.session.execute(
+            select(Data.id, func.coalesce(func.length(Data.userBlob), func.length(Data.userData)).label('size'))
+            .where(Data.id > checkpoint.last_data_id)
+            .where(or_(and_(Data.userBlob.is_not(None),
+                            func.substr(Data.userBlob, 2, len(aes_key_id)) != aes_key_id),
+                       and_(Data.userBlob.is_(None), Data.userData.is_not(None))))
+            .order_by(Data.id)
+            .limit(ROTATE_BATCH_ROWS)
+        ).all()
+        db.session.commit()
+
+        ids = []
+        size = 0
+        for candidate in candidates:
+            if ids and size + candidate.size > ROTATE_BATCH_BYTES:
+                break
+            ids.append(candidate.id)
+            size += candidate.size
+
+        if not ids:
+            return 0, 0
+
+        rows = db.session.execute(
+            select(Data.id, Data.user_id, Data.userBlob, Data.userData).where(Data.id.in_(ids))
+        ).all()
+        db.session.commit()
+
+        rotated = [{
+            'b_id': row.id,
+            'b_blob': Security.aes_rotate(row.userBlob, str(row.user_id).encode('utf-8')),
+        } for row in rows if row.userBlob is not None and Security.aes_current_key(row.userBlob) is False]
+
+        legacy = [{
+            'b_id': row.id,
+            'b_data': KeyRotation.rotate_token(row.userData),
+        } for row in rows if row.userBlob is None and row.userData is not None
+            and Security.fernet_current_key(row.userData) is False]
+
+        data_table = Data.__table__
+        if rotated:
+            # rows pruned in the meantime simply match nothing
+            db.session.execute(update(data_table)
+                               .where(data_table.c.data_id == bindparam('b_id'))
+                               .values(userBlob=bindparam('b_blob')), rotated)
+        if legacy:
+            # rows DataMigrate converted in the meantime are already under the current key
+            db.session.execute(update(data_table)
+                               .where(data_table.c.data_id == bindparam('b_id'))
+                               .where(data_table.c.userBlob.is_(None))
+                               .values(userData=bindparam('b_data')), legacy)
+
+        checkpoint = KeyRotation.checkpoint()
+        checkpoint.last_data_id = ids[-1]
+        checkpoint.rows_done += len(rotated) + len(legacy)
+        checkpoint.bytes_done += size
+        db.session.commit()
+
+        with KeyRotation.__lock:
+            KeyRotation.__stats['rows_rotated'] += len(rotated) + len(legacy)
+            KeyRotation.__stats['bytes_rotated'] += size
+            KeyRotation.__stats['last_data_id'] = ids[-1]
+        return len(ids), size
+
+    @staticmethod
+    def rotate_token(token):
+        """
+        Re-encrypts a legacy Fernet `userData` token with the current master key, keeping the column's type.
+
+        :param token: The `token` parameter is the stored token, as text or bytes
+        :return: the new token, of the same type.
+        """
+        rotated = Security.fernet_rotate(token)
+        return rotated.decode('utf-8') if isinstance(token, str) else rotated
+
+    @staticmethod
+    def metrics():
+        """
+        Returns the rotation's progress in this process.
+        :return: a dictionary with the rows and bytes rotated, the checkpoint's data id, and whether the
+        rotation is running.
+        """
+        with KeyRotation.__lock:
+            return dict(KeyRotation.__stats)
+
+
+def rotation_metrics():
+    stats = KeyRotation.metrics()
+    return [
+        ('anex_key_rotation_rows_total', 'counter', 'Data rows re-encrypted under the current key',
+         stats['rows_rotated']),
+        ('anex_key_rotation_bytes_total', 'counter', 'Envelope bytes re-encrypted under the current key',
+         stats['bytes_rotated']),
+        ('anex_key_rotation_checkpoint', 'gauge', 'Data id the rotation has reached', stats['last_data_id']),
+        ('anex_key_rotation_running', 'gauge', 'Whether the key rotation is running', stats['running']),
+    ]
+
+
+Metrics.collector(rotation_metrics)
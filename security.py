@@ -1,11 +1,71 @@
 from werkzeug.security import check_password_hash
-from cryptography.fernet import Fernet
-# from Cryptodome.Cipher import AES
-# from Cryptodome.Util.Padding import pad, unpad
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from metrics import Metrics
+import base64
+import hashlib
+import hmac
 import os
 import uuid
 
-f = Fernet(os.getenv('ANEX_MASTER_KEY'))
+AES_ENVELOPE_VERSION = 1
+AES_KEY_ID_SIZE = 4
+AES_NONCE_SIZE = 12
+AES_HEADER_SIZE = 1 + AES_KEY_ID_SIZE
+
+
+def derive_aes_key(master_key):
+    """
+    Derives the AES-256-GCM data key from a Fernet master key, so no second secret has to be managed.
+
+    :param master_key: The `master_key` parameter is the url-safe base64 Fernet key
+    :return: the 32 byte AES key.
+    """
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'anex-data-aes-gcm')
+    return hkdf.derive(base64.urlsafe_b64decode(master_key))
+
+
+def derive_token_key(master_key):
+    """
+    Derives the HMAC-SHA256 key that signs session tokens from a Fernet master key.
+
+    :param master_key: The `master_key` parameter is the url-safe base64 Fernet key
+    :return: the 32 byte HMAC key.
+    """
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'anex-session-token-hmac')
+    return hkdf.derive(base64.urlsafe_b64decode(master_key))
+
+
+def derive_etag_key(master_key):
+    """
+    Derives the HMAC-SHA256 key that user data etags are computed with from a Fernet master key.
+
+    :param master_key: The `master_key` parameter is the url-safe base64 Fernet key
+    :return: the 32 byte HMAC key.
+    """
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'anex-data-etag')
+    return hkdf.derive(base64.urlsafe_b64decode(master_key))
+
+
+# keyring: the current master key encrypts, previous keys (comma separated) are only used to decrypt, until
+# the rotation worker (see rotation.py) has moved every row to the current key
+master_keys = [os.getenv('ANEX_MASTER_KEY')] + [key.strip() for key in
+                                                os.getenv('ANEX_PREVIOUS_MASTER_KEYS', '').split(',') if key.strip()]
+
+fernet_current = Fernet(master_keys[0])
+f = MultiFernet([Fernet(key) for key in master_keys])
+
+aes_keys = [derive_aes_key(key) for key in master_keys]
+aes_ciphers = {hashlib.sha256(key).digest()[:AES_KEY_ID_SIZE]: AESGCM(key) for key in reversed(aes_keys)}
+aes_key_id = hashlib.sha256(aes_keys[0]).digest()[:AES_KEY_ID_SIZE]
+aes = aes_ciphers[aes_key_id]
+
+token_keys = [derive_token_key(key) for key in master_keys]
+token_key = token_keys[0]
+
+etag_key = derive_etag_key(master_keys[0])
 
 
 class Security:
@@ -18,7 +78,8 @@ class Security:
         :param data: The `data` parameter is the string that you want to encrypt using the Fernet encryption
         algorithm
         """
-        return f.encrypt(data.encode('utf-8'))
+        # timed on the encoded bytes, so the bytes counter counts bytes rather than characters
+        return Security.fernet_encrypt_bytes(data.encode('utf-8'))
 
     @staticmethod
     def fernet_decrypt(data):
@@ -29,7 +90,69 @@ class Security:
         :param data: The `data` parameter is the encrypted data that you want to decrypt
         :return: the decrypted data as a string.
         """
-        return f.decrypt(data).decode('utf-8')
+        return Security.fernet_decrypt_bytes(data).decode('utf-8')
+
+    @staticmethod
+    def token_sign(payload):
+        """
+        Signs a session token payload with HMAC-SHA256.
+
+        :param payload: The `payload` parameter is the token bytes being signed
+        :return: the 32 byte signature.
+        """
+        return hmac.new(token_key, payload, hashlib.sha256).digest()
+
+    @staticmethod
+    def document_etag(user_id, document):
+        """
+        Computes the etag of a user's document: a keyed HMAC rather than a plain hash, as it is stored in
+        clear next to the encrypted document and must not let anyone reading the database confirm guesses
+        of its content. The user id is included, so equal documents of different users have different etags.
+
+        :param user_id: The `user_id` parameter is the id of the user the document belongs to
+        :param document: The `document` parameter is the document bytes
+        :return: the etag, 64 hex characters.
+        """
+        mac = hmac.new(etag_key, str(user_id).encode('utf-8') + b'\0', hashlib.sha256)
+        mac.update(document)
+        return mac.hexdigest()
+
+    @staticmethod
+    def token_verify(payload, signature):
+        """
+        Checks a session token signature in constant time.
+
+        :param payload: The `payload` parameter is the signed token bytes
+        :param signature: The `signature` parameter is the signature sent with the token
+        :return: True if the signature is valid, False otherwise.
+        """
+        # tokens signed with a previous master key stay valid until they expire
+        valid = False
+        for key in token_keys:
+            valid |= hmac.compare_digest(hmac.new(key, payload, hashlib.sha256).digest(), signature)
+        return valid
+
+    @staticmethod
+    @Metrics.timed('anex_crypto_seconds', 'fernet_encrypt', 'anex_crypto_bytes_total')
+    def fernet_encrypt_bytes(data):
+        """
+        Encrypts raw bytes using the Fernet encryption algorithm, without any text encoding.
+
+        :param data: The `data` parameter is the bytes that you want to encrypt
+        :return: the Fernet token.
+        """
+        return f.encrypt(data)
+
+    @staticmethod
+    @Metrics.timed('anex_crypto_seconds', 'fernet_decrypt', 'anex_crypto_bytes_total')
+    def fernet_decrypt_bytes(data):
+        """
+        Decrypts a Fernet token and returns the raw bytes.
+
+        :param data: The `data` parameter is the encrypted token that you want to decrypt
+        :return: the decrypted bytes.
+        """
+        return f.decrypt(data)
 
     @staticmethod
     def fernet_uuid_encrypt(data):
@@ -53,14 +176,87 @@ class Security:
         """
         return uuid.UUID(bytes=f.decrypt(data))
 
-    # @staticmethod
-    # def aes_encrypt(date):
-    #     uuid_bytes = pad(date.encode(), AES.block_size)
-    #     return cipher.encrypt(uuid_bytes)
-    #
-    # @staticmethod
-    # def aes_decrypt(data):
-    #     return cipher.decrypt(data).rstrip()
+    @staticmethod
+    @Metrics.timed('anex_crypto_seconds', 'aes_encrypt', 'anex_crypto_bytes_total')
+    def aes_encrypt(data, associated=b''):
+        """
+        Encrypts bytes with AES-256-GCM into a versioned binary envelope:
+        version (1 byte) | key id (4 bytes) | nonce (12 bytes) | ciphertext and tag.
+
+        :param data: The `data` parameter is the bytes that you want to encrypt
+        :param associated: The `associated` parameter is optional data (e.g. the owning user id) that is
+        authenticated but not stored; the same value must be given to decrypt
+        :return: the envelope as bytes.
+        """
+        header = bytes([AES_ENVELOPE_VERSION]) + aes_key_id
+        nonce = os.urandom(AES_NONCE_SIZE)
+        return header + nonce + aes.encrypt(nonce, data, header + associated)
+
+    @staticmethod
+    @Metrics.timed('anex_crypto_seconds', 'aes_decrypt', 'anex_crypto_bytes_total')
+    def aes_decrypt(data, associated=b''):
+        """
+        Decrypts a binary envelope produced by `aes_encrypt`.
+
+        :param data: The `data` parameter is the envelope bytes
+        :param associated: The `associated` parameter is the associated data given when encrypting
+        :return: the decrypted bytes.
+        """
+        header = bytes(data[:AES_HEADER_SIZE])
+        if header[:1] != bytes([AES_ENVELOPE_VERSION]):
+            raise ValueError("Unsupported envelope version")
+
+        cipher = aes_ciphers.get(header[1:])
+        if cipher is None:
+            raise ValueError("Envelope was encrypted with an unknown key")
+
+        nonce = bytes(data[AES_HEADER_SIZE:AES_HEADER_SIZE + AES_NONCE_SIZE])
+        return cipher.decrypt(nonce, bytes(data[AES_HEADER_SIZE + AES_NONCE_SIZE:]), header + associated)
+
+    @staticmethod
+    def aes_current_key(data):
+        """
+        Checks whether an envelope is encrypted with the current master key, from its header alone.
+
+        :param data: The `data` parameter is the envelope bytes
+        :return: True if the envelope's key id is the current key's.
+        """
+        return bytes(data[1:AES_HEADER_SIZE]) == aes_key_id
+
+    @staticmethod
+    def aes_rotate(data, associated=b''):
+        """
+        Re-encrypts an envelope with the current master key.
+
+        :param data: The `data` parameter is the envelope bytes, encrypted with any key of the keyring
+        :param associated: The `associated` parameter is the associated data given when encrypting
+        :return: the new envelope bytes.
+        """
+        return Security.aes_encrypt(Security.aes_decrypt(data, associated), associated)
+
+    @staticmethod
+    def fernet_current_key(token):
+        """
+        Checks whether a Fernet token is encrypted with the current master key.
+
+        :param token: The `token` parameter is the Fernet token
+        :return: True if the current key decrypts the token.
+        """
+        try:
+            fernet_current.decrypt(token)
+        except InvalidToken:
+            return False
+        return True
+
+    @staticmethod
+    def fernet_rotate(token):
+        """
+        Re-encrypts a Fernet token with the current master key.
+
+        :param token: The `token` parameter is the Fernet token, encrypted with any key of the keyring
+        :return: the new token.
+        """
+        return f.rotate(token)
 
     class User:
         @staticmethod
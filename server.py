@@ -0,0 +1,466 @@
+# Multi-process launcher: a supervisor process binds the listening socket and forks worker processes that
+# each run a waitress server on it, so Python-level work is spread over every core. Unix only.
+#     python server.py                          ANEX_WORKERS workers (default: one per core)
+#     python server.py --workers 8 --port 8080
+#     kill -HUP <supervisor pid>                graceful rolling restart of the workers
+#     kill -TERM <supervisor pid>               graceful shutdown
+# By default the app is created once in the supervisor and inherited by the workers (--preload), and a SIGHUP
+# is refused: workers forked from the supervisor would only restart the code it already loaded, so deploy
+# new code by restarting the supervisor. With --no-preload every worker imports and creates the app itself,
+# and a SIGHUP rolls the workers over onto the new code.
+# Each worker logs to its own rotated file (anex.log -> anex.1.log, anex.2.log, ...), keeps its own caches
+# and login rate limits, and reports a heartbeat that the supervisor writes to ANEX_WORKER_STATUS.
+# Draining and the heartbeat use waitress internals that its public API (create_server, run, close) does not
+# cover: the server's active_channels and each channel's requests/request/will_close, trigger.pull_trigger,
+# and the task_dispatcher's add_task/shutdown and task interface. waitress is pinned in requirements.txt for
+# this reason; check these when upgrading it.
+from waitress import create_server
+from datetime import datetime
+from threading import Event, Lock, Thread
+from errors import LogLevel, log
+from logs import LOG_FILE, LogPipeline
+import argparse
+import atexit
+import json
+import os
+import resource
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+
+SERVER_HOST = os.getenv('ANEX_HOST', 'localhost')                           # serve on localhost only by default
+SERVER_PORT = int(os.getenv('ANEX_PORT', 8000))
+SERVER_WORKERS = int(os.getenv('ANEX_WORKERS', os.cpu_count() or 1))
+SERVER_THREADS = int(os.getenv('ANEX_THREADS', 4))                          # waitress threads per worker
+SERVER_BACKLOG = int(os.getenv('ANEX_BACKLOG', 1024))
+SERVER_PRELOAD = os.getenv('ANEX_PRELOAD', '1') == '1'                      # create the app before forking
+HEARTBEAT_INTERVAL = float(os.getenv('ANEX_HEARTBEAT_INTERVAL', 2))         # seconds between worker heartbeats
+HEARTBEAT_TIMEOUT = float(os.getenv('ANEX_HEARTBEAT_TIMEOUT', 30))          # silent workers are killed after this
+GRACEFUL_TIMEOUT = float(os.getenv('ANEX_GRACEFUL_TIMEOUT', 30))            # seconds to finish in-flight requests
+WORKER_STATUS = os.getenv('ANEX_WORKER_STATUS', 'workers.json')             # per-worker health, each second
+RESPAWN_DELAY = 1                                                           # seconds between restarts of a slot
+
+
+def worker_log_file(slot):
+    """
+    Names a worker's log file, so each process rotates its own file.
+
+    :param slot: The `slot` parameter is the worker's slot number, from 1
+    :return: the log file path, e.g. `anex.2.log` for `anex.log`.
+    """
+    root, extension = os.path.splitext(LOG_FILE)
+    return f"{root}.{slot}{extension}"
+
+
+class HeartbeatTask:
+    def __init__(self, worker, server):
+        """
+        Wraps a heartbeat as a waitress task, so it is sent by one of the threads that serve requests: a
+        worker whose threads are all stuck stops sending heartbeats, and the supervisor restarts it.
+
+        :param worker: The `worker` parameter is the worker that reports its health
+        :param server: The `server` parameter is the worker's waitress server
+        """
+        self.worker = worker
+        self.server = server
+
+    def service(self):
+        self.worker.heartbeat(self.server)
+
+    def cancel(self):
+        self.worker.heartbeat_queued = False    # dropped by the dispatcher's shutdown
+
+    def defer(self):
+        pass
+
+
+class Worker:
+    def __init__(self, app, sock, slot, heartbeat_fd):
+        """
+        Initialises a worker process, after it has been forked from the supervisor.
+
+        :param app: The `app` parameter is the Flask application, or None to create it in the worker
+        :param sock: The `sock` parameter is the listening socket shared by every worker
+        :param slot: The `slot` parameter is the worker's slot number, from 1; slot 1 runs the database-wide
+        background jobs
+        :param heartbeat_fd: The `heartbeat_fd` parameter is the pipe the heartbeats are written to
+        """
+        self.app = app
+        self.sock = sock
+        self.slot = slot
+        self.heartbeat_fd = heartbeat_fd
+        self.stopping = False
+        self.requests = 0
+        self.heartbeat_queued = False
+        self.__lock = Lock()
+        self.__wake = Event()
+
+    def run(self):
+        """
+        Serves requests until the supervisor asks the worker to stop or goes away, then lets the in-flight
+        requests finish for up to `GRACEFUL_TIMEOUT` seconds.
+        :return: the process exit code.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)    # the supervisor decides when workers stop
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        LogPipeline.init(worker_log_file(self.slot))
+
+        from app import create_app, start_background
+        from exts import db
+
+        if self.app is None:
+            self.app = create_app(background=False)
+        with self.app.app_context():
+            db.engine.dispose(close=False)  # never share the supervisor's connections
+        start_background(self.app, singletons=self.slot == 1)
+
+        server = create_server(self.count_request, sockets=[self.sock], threads=SERVER_THREADS)
+        serving = Thread(target=server.run, name='anex-worker-server', daemon=True)
+        serving.start()
+        supervisor = os.getppid()
+        log(f"Worker {self.slot} serving (pid {os.getpid()})", LogLevel.INFO)
+
+        deadline = None
+        next_heartbeat = 0
+        while serving.is_alive():
+            now = time.monotonic()
+            if now >= next_heartbeat and not self.heartbeat_queued:
+                # queued behind the requests, at most one at a time so a stuck worker does not pile them up
+                self.heartbeat_queued = True
+                server.task_dispatcher.add_task(HeartbeatTask(self, server))
+                next_heartbeat = now + HEARTBEAT_INTERVAL
+
+            if os.getppid() != supervisor:
+                self.stopping = True
+
+            if self.stopping:
+                if deadline is None:
+                    deadline = now + GRACEFUL_TIMEOUT
+                    server.trigger.pull_trigger(lambda: self.drain(server))
+                if now >= deadline:
+                    break
+
+            self.__wake.wait(1)
+
+        server.task_dispatcher.shutdown()
+        log(f"Worker {self.slot} stopped after {self.requests} requests", LogLevel.INFO)
+        return 0
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        self.__wake.set()
+
+    def count_request(self, environ, start_response):
+        with self.__lock:
+            self.requests += 1
+
+        if self.stopping:
+            # draining: the connection is closed once this response is sent, rather than kept alive
+            def closing_start_response(status, headers, exc_info=None):
+                headers = [(name, value) for name, value in headers if name.lower() != 'connection']
+                return start_response(status, headers + [('Connection', 'close')], exc_info)
+            return self.app(environ, closing_start_response)
+        return self.app(environ, start_response)
+
+    @staticmethod
+    def drain(server):
+        """
+        Stops accepting connections and closes the idle ones, on the server's own thread. Only this process's
+        copy of the listening socket is closed, the other workers keep accepting on theirs. Connections
+        with a request in flight close after their response, and the server's loop returns once the last
+        one has.
+        """
+        for channel in list(server.active_channels.values()):
+            if not channel.requests and channel.request is None:
+                channel.will_close = True   # idle keep-alive connection, as waitress's maintenance does
+        server.close()
+
+    def heartbeat(self, server):
+        """
+        Reports the worker's health to the supervisor: one JSON line on the heartbeat pipe. Runs on a
+        waitress thread, see `HeartbeatTask`.
+        """
+        self.heartbeat_queued = False
+        status = {
+            'pid': os.getpid(),
+            'requests': self.requests,
+            'connections': len(server.active_channels),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'stopping': self.stopping,
+        }
+        try:
+            os.write(self.heartbeat_fd, (json.dumps(status) + '\n').encode('utf-8'))
+        except BlockingIOError:
+            pass    # the supervisor is behind, the next heartbeat carries the same information
+        except OSError:
+            self.stopping = True    # the supervisor is gone
+            self.__wake.set()
+
+
+class WorkerState:
+    def __init__(self, pid, slot, generation, heartbeat_fd):
+        self.pid = pid
+        self.slot = slot
+        self.generation = generation
+        self.heartbeat_fd = heartbeat_fd
+        self.buffer = b''
+        self.started = time.monotonic()
+        self.last_heartbeat = None
+        self.terminated = None
+        self.status = {}
+
+    def describe(self):
+        return {
+            'slot': self.slot,
+            'pid': self.pid,
+            'generation': self.generation,
+            'state': 'stopping' if self.terminated is not None else 'ready' if self.last_heartbeat else 'starting',
+            'uptime_seconds': round(time.monotonic() - self.started, 1),
+            'heartbeat_age_seconds': None if self.last_heartbeat is None else
+            round(time.monotonic() - self.last_heartbeat, 1),
+            **{key: value for key, value in self.status.items() if key != 'pid'},
+        }
+
+
+class Supervisor:
+    def __init__(self, host, port, workers, preload):
+        """
+        Initialises the supervisor: binds the listening socket and, with `preload`, creates the app (tables,
+        migrations and the first boot admin key included) once, before any worker is forked.
+
+        :param host: The `host` parameter is the address to listen on
+        :param port: The `port` parameter is the port to listen on
+        :param workers: The `workers` parameter is the number of worker processes
+        :param preload: The `preload` parameter creates the app in the supervisor when True, otherwise in
+        every worker
+        """
+        self.workers = workers
+        self.sock = socket.create_server((host, port), backlog=SERVER_BACKLOG)
+        self.sock.setblocking(False)
+        self.preload = preload
+        self.app = None
+        self.generation = 1
+        self.running = {}       # pid -> WorkerState
+        self.respawned = {}     # slot -> monotonic time of the last start
+        self.reload = False
+        self.shutdown = False
+
+        if preload is True:
+            from app import create_app
+            from exts import db
+            self.app = create_app(background=False)
+            with self.app.app_context():
+                db.engine.dispose()     # workers open their own connections
+
+    def run(self):
+        """
+        Starts the workers and supervises them until SIGTERM or SIGINT: restarts workers that exit or stop
+        sending heartbeats, rolls the workers over on SIGHUP (with `--no-preload` only, see `request_reload`),
+        and keeps `WORKER_STATUS` up to date.
+        """
+        signal.signal(signal.SIGTERM, self.request_shutdown)
+        signal.signal(signal.SIGINT, self.request_shutdown)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        log(f"Supervisor {os.getpid()} listening on {self.sock.getsockname()[:2]} with {self.workers} workers",
+            LogLevel.INFO)
+
+        while not self.shutdown:
+            if self.reload:
+                self.reload = False
+                if self.preload is True:
+                    log("SIGHUP ignored: preloaded workers would restart on the code already loaded, restart "
+                        "the supervisor or run it with --no-preload to reload", LogLevel.WARNING)
+                else:
+                    self.generation += 1
+                    log(f"Reloading workers, generation {self.generation}", LogLevel.INFO)
+
+            self.reap()
+            self.maintain()
+            self.read_heartbeats(1.0)
+            self.check_heartbeats()
+            self.write_status()
+
+        self.stop_all()
+
+    def request_shutdown(self, signum, frame):
+        self.shutdown = True
+
+    def request_reload(self, signum, frame):
+        self.reload = True
+
+    def slots(self, generation):
+        return {state.slot: state for state in self.running.values()
+                if state.generation == generation and state.terminated is None}
+
+    def maintain(self):
+        """
+        Starts a worker for every empty slot. During a reload the slots are replaced one at a time: a new
+        worker is started, and its predecessor is stopped once the new one has sent its first heartbeat.
+        """
+        current = self.slots(self.generation)
+        replacing = False   # a new worker is starting while its predecessor still serves
+        for slot in range(1, self.workers + 1):
+            worker = current.get(slot)
+            predecessors = [state for state in self.running.values() if state.slot == slot and
+                            state.generation < self.generation and state.terminated is None]
+
+            if worker is None:
+                if predecessors and replacing:
+                    continue    # one slot is replaced at a time
+                if time.monotonic() - self.respawned.get(slot, 0) >= RESPAWN_DELAY:
+                    self.spawn(slot)
+                replacing = replacing or bool(predecessors)
+            elif worker.last_heartbeat is None:
+                replacing = replacing or bool(predecessors)
+            else:
+                for old in predecessors:
+                    self.terminate(old)
+
+        for state in list(self.running.values()):   # slots dropped by a smaller worker count
+            if state.slot > self.workers and state.terminated is None:
+                self.terminate(state)
+
+    def spawn(self, slot):
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        self.respawned[slot] = time.monotonic()
+
+        LogPipeline.stop()      # no thread may hold the log queue's lock across the fork
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for state in self.running.values():
+                os.close(state.heartbeat_fd)
+            code = 1
+            try:
+                code = Worker(self.app, self.sock, slot, write_fd).run()
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                atexit._run_exitfuncs()     # flushes the worker's buffers and logs, os._exit skips them
+                os._exit(code)
+
+        LogPipeline.init()
+        os.close(write_fd)
+        self.running[pid] = WorkerState(pid, slot, self.generation, read_fd)
+        log(f"Started worker {slot} (pid {pid}, generation {self.generation})", LogLevel.INFO)
+
+    def terminate(self, state, kill=False):
+        state.terminated = state.terminated or time.monotonic()
+        try:
+            os.kill(state.pid, signal.SIGKILL if kill else signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        while self.running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            state = self.running.pop(pid, None)
+            if state is None:
+                continue
+            os.close(state.heartbeat_fd)
+            if state.terminated is None:
+                log(f"Worker {state.slot} (pid {pid}) exited unexpectedly with status "
+                    f"{os.waitstatus_to_exitcode(status)}, restarting", LogLevel.ERROR)
+
+    def read_heartbeats(self, timeout):
+        fds = {state.heartbeat_fd: state for state in self.running.values()}
+        if not fds:
+            time.sleep(timeout)
+            return
+
+        readable, _, _ = select.select(list(fds), [], [], timeout)
+        for fd in readable:
+            state = fds[fd]
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            *lines, state.buffer = (state.buffer + data).split(b'\n')
+            for line in lines:
+                state.status = json.loads(line)
+                state.last_heartbeat = time.monotonic()
+
+    def check_heartbeats(self):
+        """
+        Kills workers that have sent no heartbeat for `HEARTBEAT_TIMEOUT` seconds (or that did not start in
+        that time), and stopping workers that overran `GRACEFUL_TIMEOUT`. They are restarted once reaped.
+        """
+        now = time.monotonic()
+        for state in self.running.values():
+            if state.terminated is not None:
+                if now - state.terminated > GRACEFUL_TIMEOUT + HEARTBEAT_TIMEOUT:
+                    self.terminate(state, kill=True)
+                continue
+
+            if now - (state.last_heartbeat or state.started) > HEARTBEAT_TIMEOUT:
+                log(f"Worker {state.slot} (pid {state.pid}) missed its heartbeat, killing it", LogLevel.ERROR)
+                self.terminate(state, kill=True)
+                state.terminated = now - GRACEFUL_TIMEOUT - HEARTBEAT_TIMEOUT   # not waited for again
+
+    def write_status(self):
+        status = {
+            'supervisor': os.getpid(),
+            'generation': self.generation,
+            'updated': datetime.now().isoformat(timespec='seconds'),
+            'workers': sorted((state.describe() for state in self.running.values()),
+                              key=lambda worker: (worker['slot'], worker['generation'])),
+        }
+        try:
+            with open(WORKER_STATUS + '.tmp', 'w') as status_file:
+                json.dump(status, status_file, indent=1)
+            os.replace(WORKER_STATUS + '.tmp', WORKER_STATUS)
+        except OSError as e:
+            log("Failed to write worker status: ", LogLevel.ERROR, str(e))
+
+    def stop_all(self):
+        """
+        Asks every worker to finish its in-flight requests and exit, and kills those still running after
+        `GRACEFUL_TIMEOUT` seconds.
+        """
+        log("Stopping workers", LogLevel.INFO)
+        for state in self.running.values():
+            self.terminate(state)
+
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while self.running and time.monotonic() < deadline:
+            self.read_heartbeats(0.2)
+            self.reap()
+
+        for state in self.running.values():
+            self.terminate(state, kill=True)
+        while self.running:
+            self.reap()
+            time.sleep(0.05)
+
+        self.sock.close()
+        self.write_status()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve Anex with several worker processes.')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS)
+    parser.add_argument('--preload', action=argparse.BooleanOptionalAction, default=SERVER_PRELOAD,
+                        help='create the app once before forking the workers')
+    args = parser.parse_args()
+
+    LogPipeline.init()      # the supervisor's own log, workers switch to theirs after the fork
+    Supervisor(args.host, args.port, max(1, args.workers), args.preload).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,345 @@
 from datetime import datetime, timedelta
-from models import Session
+from collections import namedtuple
+from threading import Event, Lock, Thread
+from sqlalchemy import delete, update
+from models import Revocation, Session, User
 from models import db
-from errors import Err, LogLevel
+from errors import Err, LogLevel, log
+from cache import LRUCache
+from security import Security
+from validation import Validate
+from user import LoginAttemptBuffer
+import atexit
+import base64
 import definitions
+import struct
+import time
 import uuid
+import os
+
+SESSION_CACHE_SIZE = int(os.getenv('ANEX_SESSION_CACHE_SIZE', 4096))  # entries
+SESSION_CACHE_TTL = int(os.getenv('ANEX_SESSION_CACHE_TTL', 60))      # seconds
+SESSION_TOKENS = os.getenv('ANEX_SESSION_TOKENS', '0') == '1'         # issue signed tokens instead of session rows
+SESSION_TOKEN_LIFETIME = int(os.getenv('ANEX_SESSION_TOKEN_LIFETIME', 720))             # minutes, caps every token
+REVOCATION_FLUSH_INTERVAL = int(os.getenv('ANEX_REVOCATION_FLUSH_INTERVAL', 10))       # seconds
+
+TOKEN_VERSION = 1
+TOKEN_PAYLOAD = struct.Struct('>B16s16sQI')     # version, user id, license id, issued (unix ms), expires (unix s)
+TOKEN_SIGNATURE_SIZE = 32
+
+SessionRecord = namedtuple('SessionRecord', ['id', 'user_id', 'status', 'created', 'updated', 'can_expire', 'expires',
+                                             'read_at'])
+SessionClaims = namedtuple('SessionClaims', ['user_id', 'license_id', 'issued', 'expires'])
+
+
+class SessionCache:
+    __user_keys = {}
+    __lock = Lock()
+
+    @staticmethod
+    def __unindex(key, record):
+        with SessionCache.__lock:
+            keys = SessionCache.__user_keys.get(str(record.user_id))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del SessionCache.__user_keys[str(record.user_id)]
+
+    # lapsed and LRU-evicted sessions are dropped from the user index as well
+    __cache = LRUCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL, on_evict=__unindex.__func__)
+
+    @staticmethod
+    def get(key):
+        """
+        Retrieves a validated session from the in-process cache. Entries read before the user's sessions
+        were last revoked, in this process or another (see `RevocationList`), are dropped.
+
+        :param key: The `key` parameter is the session key the record was cached under
+        :return: a `SessionRecord`, or None if the session is not cached, its cache entry has lapsed or it
+        is stale.
+        """
+        record = SessionCache.__cache.get(str(key))
+        if record is not None and record.read_at <= RevocationList.revoked_before(record.user_id):
+            SessionCache.evict(key)
+            return None
+        return record
+
+    @staticmethod
+    def put(ses_row, read_at):
+        """
+        Caches an active session row as a detached `SessionRecord`. Inactive sessions are never cached, and
+        the cache entry never outlives the session's own expiry time. A row read before the user's sessions
+        were last revoked is not cached either, so a request that raced a logout cannot put the old session
+        back after it was evicted.
+
+        :param ses_row: The `ses_row` parameter is a `Session` row read from the database
+        :param read_at: The `read_at` parameter is the time the read started, in unix milliseconds
+        :return: the `SessionRecord`.
+        """
+        record = SessionRecord(
+            id=ses_row.id,
+            user_id=ses_row.user_id,
+            status=ses_row.status,
+            created=ses_row.created,
+            updated=ses_row.updated,
+            can_expire=ses_row.can_expire,
+            expires=ses_row.expires,
+            read_at=read_at,
+        )
+
+        if record.status != definitions.STATUS_ACTIVE:
+            return record
+
+        if read_at <= RevocationList.revoked_before(record.user_id):
+            return record
+
+        ttl = SESSION_CACHE_TTL
+        if record.can_expire is True:
+            ttl = min(ttl, (record.expires - datetime.now()).total_seconds())
+
+        SessionCache.__cache.set(str(record.id), record, ttl)
+        with SessionCache.__lock:
+            SessionCache.__user_keys.setdefault(str(record.user_id), set()).add(str(record.id))
+
+        return record
+
+    @staticmethod
+    def evict(key):
+        """
+        Removes a single session from the cache.
+
+        :param key: The `key` parameter is the session key to evict
+        """
+        record = SessionCache.__cache.pop(str(key))
+        if record is not None:
+            SessionCache.__unindex(str(key), record)
+
+    @staticmethod
+    def evict_user(user_id):
+        """
+        Removes every cached session belonging to a user, e.g. when the user logs in again and the
+        session is rotated.
+
+        :param user_id: The `user_id` parameter is the id of the user whose sessions are evicted
+        """
+        with SessionCache.__lock:
+            keys = SessionCache.__user_keys.pop(str(user_id), set())
+
+        for key in keys:
+            SessionCache.__cache.pop(key)
+
+    @staticmethod
+    def clear():
+        """
+        Empties the session cache.
+        """
+        with SessionCache.__lock:
+            SessionCache.__user_keys.clear()
+        SessionCache.__cache.clear()
+
+
+class RevocationList:
+    __revoked = {}      # user id -> (revoked before in unix ms, unix time every revoked token has expired by)
+    __unsaved = set()
+    __lock = Lock()
+    __stop = Event()
+    __thread = None
+
+    @staticmethod
+    def revoke(user_id, keep=SESSION_TOKEN_LIFETIME * 60):
+        """
+        Revokes every session token issued to a user so far, and every cached session row read so far. The
+        entry is kept for `keep` seconds: `SESSION_TOKEN_LIFETIME` for tokens, after which the tokens it
+        covers have expired anyway, or `SESSION_CACHE_TTL` for cached sessions. The list only holds recently
+        revoked users.
+
+        :param user_id: The `user_id` parameter is the id of the user whose tokens or sessions are revoked
+        :param keep: The `keep` parameter is the number of seconds the revocation is kept (optional)
+        """
+        now = time.time()
+        with RevocationList.__lock:
+            entry = RevocationList.__revoked.get(str(user_id))
+            until = now + keep if entry is None else max(entry[1], now + keep)
+            RevocationList.__revoked[str(user_id)] = (int(now * 1000), until)
+            RevocationList.__unsaved.add(str(user_id))
+
+    @staticmethod
+    def revoked_before(user_id):
+        """
+        Returns the time up to which a user's tokens are revoked.
+
+        :param user_id: The `user_id` parameter is the id of the user
+        :return: the revocation time in unix milliseconds, 0 if none of the user's tokens are revoked.
+        """
+        entry = RevocationList.__revoked.get(str(user_id))
+        return 0 if entry is None else entry[0]
+
+    @staticmethod
+    def init(app):
+        """
+        Loads the persisted revocations and starts the background thread that saves new ones to the
+        `Revocation` table every `REVOCATION_FLUSH_INTERVAL` seconds and picks up those made by other
+        processes. In token mode they revoke tokens; in session mode they drop the sessions other worker
+        processes still cache, within two flush intervals rather than the `SESSION_CACHE_TTL`.
+
+        :param app: The `app` parameter is the Flask application, whose context the flush runs in
+        """
+        if RevocationList.__thread is not None:
+            return
+
+        with app.app_context():
+            RevocationList.restore()
+
+        def flush_loop():
+            while not RevocationList.__stop.wait(REVOCATION_FLUSH_INTERVAL):
+                with app.app_context():
+                    RevocationList.flush()
+
+        def flush_on_exit():
+            RevocationList.__stop.set()
+            with app.app_context():
+                RevocationList.flush()
+
+        RevocationList.__thread = Thread(target=flush_loop, name='anex-revocation-flush', daemon=True)
+        RevocationList.__thread.start()
+        atexit.register(flush_on_exit)
+
+    @staticmethod
+    def restore():
+        """
+        Merges the unexpired revocations in the `Revocation` table into the list. Must be called inside an
+        application context.
+        """
+        rows = Revocation.query.filter(Revocation.until > datetime.now()).all()
+        with RevocationList.__lock:
+            for row in rows:
+                entry = RevocationList.__revoked.get(row.user_id)
+                if entry is None or entry[0] < row.revoked_before:
+                    RevocationList.__revoked[row.user_id] = (row.revoked_before, row.until.timestamp())
+
+    @staticmethod
+    def flush():
+        """
+        Saves the revocations made since the last flush, drops expired ones from the list and the table, then
+        reloads the table. Must be called inside an application context.
+        """
+        now = time.time()
+        with RevocationList.__lock:
+            unsaved = {user_id: RevocationList.__revoked[user_id] for user_id in RevocationList.__unsaved
+                       if user_id in RevocationList.__revoked}
+            RevocationList.__unsaved.clear()
+            for user_id in [user_id for user_id, entry in RevocationList.__revoked.items() if entry[1] <= now]:
+                del RevocationList.__revoked[user_id]
+
+        try:
+            db.session.execute(delete(Revocation).where(Revocation.until <= datetime.now()))
+            for user_id, (revoked_before, until) in unsaved.items():
+                row = db.session.get(Revocation, user_id)
+                if row is None:
+                    db.session.add(Revocation(user_id=user_id, revoked_before=revoked_before,
+                                              until=datetime.fromtimestamp(until)))
+                elif row.revoked_before < revoked_before:       # never overwrite a later revocation
+                    row.revoked_before = revoked_before
+                    row.until = datetime.fromtimestamp(until)
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            log("Failed to flush session revocations: ", LogLevel.ERROR, str(e))
+            with RevocationList.__lock:
+                RevocationList.__unsaved.update(unsaved)
+            return
+
+        RevocationList.restore()
+
+
+class SessionToken:
+    @staticmethod
+    def issue(user_id, license_id, expires):
+        """
+        Issues a stateless session token: the user id, license id, issue and expiry times, signed with
+        HMAC-SHA256, url-safe base64 encoded.
+
+        :param user_id: The `user_id` parameter is the id of the user the token authenticates
+        :param license_id: The `license_id` parameter is the id of the user's license
+        :param expires: The `expires` parameter is the datetime the token expires at
+        :return: the token string.
+        """
+        # always issued after the user's last revocation, even within the same millisecond
+        issued = max(int(time.time() * 1000), RevocationList.revoked_before(user_id) + 1)
+        payload = TOKEN_PAYLOAD.pack(TOKEN_VERSION, uuid.UUID(str(user_id)).bytes, uuid.UUID(str(license_id)).bytes,
+                                     issued, int(expires.timestamp()))
+        return base64.urlsafe_b64encode(payload + Security.token_sign(payload)).rstrip(b'=').decode('ascii')
+
+    @staticmethod
+    def verify(token):
+        """
+        Checks a session token's signature, expiry and revocation, without touching the database.
+
+        :param token: The `token` parameter is the token string
+        :return: the token's `SessionClaims`, or None if the token is not valid.
+        """
+        try:
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        except ValueError:
+            return None
+
+        if len(raw) != TOKEN_PAYLOAD.size + TOKEN_SIGNATURE_SIZE:
+            return None
+
+        payload, signature = raw[:TOKEN_PAYLOAD.size], raw[TOKEN_PAYLOAD.size:]
+        if Security.token_verify(payload, signature) is False:
+            return None
+
+        version, user_id, license_id, issued, expires = TOKEN_PAYLOAD.unpack(payload)
+        if version != TOKEN_VERSION or expires <= time.time():
+            return None
+
+        claims = SessionClaims(str(uuid.UUID(bytes=user_id)), str(uuid.UUID(bytes=license_id)), issued, expires)
+        if issued <= RevocationList.revoked_before(claims.user_id):
+            return None
+        return claims
+
+
+class SessionAuth:
+    @staticmethod
+    def token_claims(skey):
+        """
+        Checks the form of a session key sent to an endpoint: a session UUID, or in token mode a session token.
+
+        :param skey: The `skey` parameter is the session key from the request path
+        :return: the verified `SessionClaims` if `skey` is a token, None if it is a session UUID to be
+        looked up.
+        """
+        if Validate.uuid_form(str(skey).lower()):
+            return None
+
+        if SESSION_TOKENS is False:
+            Err.client_return(Err.ERROR_MESSAGES['UUID_FORM'], LogLevel.INFO)
+
+        claims = SessionToken.verify(str(skey))
+        if claims is None:
+            Err.client_return(Err.ERROR_MESSAGES['INVALID_SESSION'], LogLevel.WARNING)
+        return claims
+
+    @staticmethod
+    def user_id(skey):
+        """
+        Authenticates a session key and returns its user. Tokens are checked with pure CPU work; session
+        UUIDs are looked up (from the session cache when hot) and checked for expiry. The user id comes from
+        the session record, whose foreign key guarantees the user exists, so the user row is not read.
+
+        :param skey: The `skey` parameter is the session key from the request path
+        :return: the id of the session's user.
+        """
+        claims = SessionAuth.token_claims(skey)
+        if claims is not None:
+            return claims.user_id
+
+        user_session = SessionEntity(str(skey).lower())
+        if user_session.expired() is True:
+            Err.client_return(Err.ERROR_MESSAGES['INVALID_SESSION'], LogLevel.WARNING)
+        return user_session.user_id
 
 
 class SessionLookup:
@@ -16,9 +352,17 @@ class SessionLookup:
         to filter the query by the `id` column. The `id` column is expected to be a string, so the `key`
         parameter should also be a string
         :return: The function `record_by_skey` is returning the first record from the `Session` table that
-        matches the given `key`.
+        matches the given `key`, served from the session cache when the session is hot.
         """
-        return Session.query.filter_by(id=str(key)).first()
+        record = SessionCache.get(key)
+        if record is not None:
+            return record
+
+        read_at = int(time.time() * 1000)
+        ses_row = Session.query.filter_by(id=str(key)).first()
+        if ses_row is None:
+            return None
+        return SessionCache.put(ses_row, read_at)
 
     @staticmethod
     def record_by_user_id(key):
@@ -36,18 +380,29 @@ class SessionLookup:
 
 class SessionManage:
     @staticmethod
-    def create(user_id, expiration_minutes=720):
+    def create(user_id, expiration_minutes=720, user_license=None, commit=True):
         """
         Creates a session with a unique ID, user ID, expiration time, and adds it to the
-        database.
+        database. In token mode (`ANEX_SESSION_TOKENS=1`) a signed `SessionToken` is issued instead, expiring
+        no later than the user's license, and nothing is written.
 
         :param user_id: The `user_id` parameter is the unique identifier of the user for whom the session is
         being created. It is used to associate the session with a specific user in the database
         :param expiration_minutes: The `expiration_minutes` parameter is an optional parameter that
         specifies the number of minutes after which the session will expire. By default, it is set to 720
         minutes (12 hours), defaults to 720 (optional)
-        :return: the value of the variable "key".
+        :param user_license: The `user_license` parameter is the user's `LicenseEntity` or `LoginLicense`,
+        embedded in the token in token mode (optional)
+        :param commit: The `commit` parameter commits the new session when True; False leaves it in the
+        current transaction (optional)
+        :return: the value of the variable "key", or the token in token mode.
         """
+        if SESSION_TOKENS is True and user_license is not None:
+            expires = datetime.now() + timedelta(minutes=min(expiration_minutes, SESSION_TOKEN_LIFETIME))
+            if user_license.can_expire is True:
+                expires = min(expires, user_license.expires)
+            return SessionToken.issue(user_id, user_license.id, expires)
+
         key = uuid.uuid4()
 
         try:
@@ -63,7 +418,48 @@ class SessionManage:
         except Exception as e:
             return Err.database_return(e)
 
-        db.session.commit()
+        if commit is True:
+            db.session.commit()
+        return key
+
+    @staticmethod
+    def rotate(user_id, attempt, user_license=None, expiration_minutes=720):
+        """
+        Rotates a user's sessions at login in a single write transaction: the user's sessions are deleted,
+        the new one is created, and the login attempt is written to the user row. In token mode the user's
+        earlier tokens are revoked and the new token needs no row.
+
+        :param user_id: The `user_id` parameter is the id of the user logging in
+        :param attempt: The `attempt` parameter is the tuple of attempt time and reset flag returned by
+        `LoginAttemptBuffer.attempt`
+        :param user_license: The `user_license` parameter is the user's `LoginLicense`, embedded in the token
+        in token mode (optional)
+        :param expiration_minutes: The `expiration_minutes` parameter is the session lifetime in minutes,
+        defaults to 720 (optional)
+        :return: the new session key, or the token in token mode.
+        """
+        attempt_time, reset = attempt
+        user_values = {'last_login_attempt': attempt_time}
+        if reset is True:
+            user_values['login_attempts'] = 0
+
+        if SESSION_TOKENS is True:
+            RevocationList.revoke(user_id)
+
+        try:
+            db.session.execute(delete(Session).where(Session.user_id == user_id))
+            key = SessionManage.create(user_id, expiration_minutes, user_license, commit=False)
+            db.session.execute(update(User).where(User.id == user_id).values(**user_values))
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            log("Failed to rotate session at login: ", LogLevel.ERROR, str(e))
+            return Err.database_return()
+
+        # the attempt is written, and cached sessions must not outlive the deleted rows
+        LoginAttemptBuffer.discard(user_id)
+        SessionManage.revoke_cached(user_id)
         return key
 
     @staticmethod
@@ -74,8 +470,24 @@ class SessionManage:
         :param user_id: The user_id parameter is the unique identifier of the user whose data needs to be
         deleted from the database
         """
+        if SESSION_TOKENS is True:
+            RevocationList.revoke(user_id)
         Session.query.filter_by(user_id=user_id).delete()
         db.session.commit()
+        SessionManage.revoke_cached(user_id)
+
+    @staticmethod
+    def revoke_cached(user_id):
+        """
+        Drops a user's cached sessions after their rows were deleted, in this process straight away and in
+        the other worker processes through the `RevocationList`. Called after the commit, so any session read
+        started later sees the rows gone, and any read started earlier is refused by the cache.
+
+        :param user_id: The `user_id` parameter is the id of the user whose sessions were deleted
+        """
+        if SESSION_TOKENS is False:
+            RevocationList.revoke(user_id, SESSION_CACHE_TTL)
+        SessionCache.evict_user(user_id)
 
 
 class SessionEntity:
@@ -87,7 +499,7 @@ class SessionEntity:
         :param key: The `key` parameter is used to identify a session in the database. It is used to query
         the `Session` table and retrieve the corresponding session row
         """
-        ses_row = Session.query.filter_by(id=str(key)).first()
+        ses_row = SessionLookup.record_by_skey(key)
 
         if ses_row is None:
             Err.client_return(Err.ERROR_MESSAGES['INVALID_SESSION'], LogLevel.WARNING)
@@ -125,6 +537,7 @@ class SessionEntity:
         Retrieves session data from the database and updates the current session object
         with the retrieved data before committing the changes to the database.
         """
+        SessionCache.evict(self.id)
         ses_row = Session.query.filter_by(id=str(self.id)).first()
 
         if ses_row is None:
@@ -144,6 +557,7 @@ class SessionEntity:
         """
         Deletes a record from the database based on its ID.
         """
+        SessionCache.evict(self.id)
         Session.query.filter_by(id=self.id).delete()
         db.session.commit()
 
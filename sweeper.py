@@ -0,0 +1,128 @@
+from datetime import datetime
+from threading import Event, Lock, Thread
+from sqlalchemy import delete, or_, select, update
+from models import db
+from models import License, Session
+from errors import LogLevel, log
+from metrics import Metrics
+import atexit
+import definitions
+import os
+import time
+
+SWEEP_INTERVAL = int(os.getenv('ANEX_SWEEP_INTERVAL', 60))   # seconds between sweeps, 0 disables the sweeper
+SWEEP_BATCH = int(os.getenv('ANEX_SWEEP_BATCH', 1000))       # rows per statement and transaction
+SWEEP_PAUSE = float(os.getenv('ANEX_SWEEP_PAUSE', 0.01))     # seconds between batches, lets writers in
+
+
+class Sweeper:
+    __stats = {
+        'runs': 0,
+        'sessions_deleted': 0,
+        'licenses_expired': 0,
+        'last_run_seconds': 0.0,
+        'last_run_at': None,
+    }
+    __lock = Lock()
+    __stop = Event()
+    __thread = None
+
+    @staticmethod
+    def init(app):
+        """
+        Starts the background thread that removes dead sessions and expires licenses every `SWEEP_INTERVAL`
+        seconds.
+
+        :param app: The `app` parameter is the Flask application, whose context the sweep runs in
+        """
+        if SWEEP_INTERVAL <= 0 or Sweeper.__thread is not None:
+            return
+
+        def sweep_loop():
+            while not Sweeper.__stop.wait(SWEEP_INTERVAL):
+                with app.app_context():
+                    Sweeper.run()
+
+        Sweeper.__thread = Thread(target=sweep_loop, name='anex-sweeper', daemon=True)
+        Sweeper.__thread.start()
+        atexit.register(Sweeper.__stop.set)
+
+    @staticmethod
+    def run():
+        """
+        Runs one sweep: deletes expired and inactive sessions, and marks expired licenses inactive. Both are
+        set-based statements over at most `SWEEP_BATCH` rows each, committed batch by batch so no single
+        transaction holds the database for long. Must be called inside an application context.
+        :return: a tuple of the number of sessions deleted and licenses expired.
+        """
+        started = time.monotonic()
+        now = datetime.now()
+
+        dead_sessions = (select(Session.id)
+                         .where(or_(Session.status == definitions.STATUS_INACTIVE,
+                                    Session.can_expire.is_(True) & (Session.expires < now)))
+                         .limit(SWEEP_BATCH))
+        sessions_deleted = Sweeper.__in_batches(
+            delete(Session).where(Session.id.in_(dead_sessions)).execution_options(synchronize_session=False))
+
+        expired_licenses = (select(License.id)
+                            .where(License.can_expire.is_(True))
+                            .where(License.expires < now)
+                            .where(License.status != definitions.STATUS_INACTIVE)
+                            .limit(SWEEP_BATCH))
+        licenses_expired = Sweeper.__in_batches(
+            update(License).where(License.id.in_(expired_licenses))
+            .values(status=definitions.STATUS_INACTIVE).execution_options(synchronize_session=False))
+
+        with Sweeper.__lock:
+            Sweeper.__stats['runs'] += 1
+            Sweeper.__stats['sessions_deleted'] += sessions_deleted
+            Sweeper.__stats['licenses_expired'] += licenses_expired
+            Sweeper.__stats['last_run_seconds'] = time.monotonic() - started
+            Sweeper.__stats['last_run_at'] = now
+
+        if sessions_deleted or licenses_expired:
+            log(f"Sweeper removed {sessions_deleted} sessions and expired {licenses_expired} licenses", LogLevel.INFO)
+        return sessions_deleted, licenses_expired
+
+    @staticmethod
+    def metrics():
+        """
+        Returns the sweeper's counters.
+        :return: a dictionary with the number of runs, total sessions deleted, total licenses expired, and
+        the duration and start time of the last run.
+        """
+        with Sweeper.__lock:
+            return dict(Sweeper.__stats)
+
+    @staticmethod
+    def __in_batches(statement):
+        total = 0
+        while not Sweeper.__stop.is_set():
+            try:
+                count = db.session.execute(statement).rowcount
+                db.session.commit()
+
+            except Exception as e:
+                db.session.rollback()
+                log("Sweep failed: ", LogLevel.ERROR, str(e))
+                break
+
+            total += count
+            if count < SWEEP_BATCH:
+                break
+            time.sleep(SWEEP_PAUSE)
+        return total
+
+
+def sweeper_metrics():
+    stats = Sweeper.metrics()
+    return [
+        ('anex_sweeper_runs_total', 'counter', 'Sweeps run', stats['runs']),
+        ('anex_sweeper_sessions_deleted_total', 'counter', 'Dead sessions deleted', stats['sessions_deleted']),
+        ('anex_sweeper_licenses_expired_total', 'counter', 'Licenses marked expired', stats['licenses_expired']),
+        ('anex_sweeper_last_run_seconds', 'gauge', 'Duration of the last sweep', stats['last_run_seconds']),
+    ]
+
+
+Metrics.collector(sweeper_metrics)
@@ -0,0 +1,74 @@
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+from cryptography.fernet import Fernet
+
+# the server reads its settings at import time, so they are set before any of its modules is imported
+WORKDIR = tempfile.mkdtemp(prefix='anex-test-')
+os.environ['ANEX_MASTER_KEY'] = Fernet.generate_key().decode()
+os.environ['ANEX_DATABASE_URI'] = 'sqlite:///' + os.path.join(WORKDIR, 'anex.db')
+os.environ['ANEX_LOG_FILE'] = os.path.join(WORKDIR, 'anex.log')
+os.environ['ANEX_LOG_CONSOLE'] = '0'
+os.environ['ANEX_BOOTSTRAP_LOCK'] = os.path.join(WORKDIR, 'anex.bootstrap.lock')
+os.environ['ANEX_HASH_WORKERS'] = '0'      # hash on the request thread, no process pool
+os.environ['ANEX_LOGIN_ADDRESS_BURST'] = str(10 ** 6)
+os.environ['ANEX_LOGIN_USERNAME_BURST'] = str(10 ** 6)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+names = itertools.count()
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import create_app
+    application = create_app(background=False)
+    yield application
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture(scope='session')
+def admin_key(app):
+    from models import Admin
+    from security import Security
+    with app.app_context():
+        return Security.fernet_uuid_decrypt(Admin.query.first().id)
+
+
+@pytest.fixture(scope='session')
+def access_key(app):
+    from security import Security
+    return Security.Network.access_key
+
+
+@pytest.fixture
+def license_key(client, admin_key):
+    def create(days=30):
+        response = client.get(f'/api/license/{admin_key}/{days}')
+        assert response.status_code == 200
+        return response.data.decode().strip().strip('"')
+    return create
+
+
+@pytest.fixture
+def user(client, access_key, license_key):
+    """
+    Creates a user and logs it in.
+    :return: a (username, password, session key) tuple.
+    """
+    username, password = f'tester{next(names)}', 'secret123'
+    response = client.post(f'/api/create/user/{access_key}', json={
+        'email': f'{username}@test.anex', 'password': password, 'username': username, 'key': license_key()})
+    assert response.status_code == 200, response.data
+    response = client.post(f'/api/login/{access_key}', json={'username': username, 'password': password})
+    assert response.status_code == 200, response.data
+    return username, password, response.json['key']
@@ -0,0 +1,21 @@
+import uuid
+
+import definitions
+from admin import AdminKeyCache, AdminManage
+from exts import db
+from models import Admin
+from security import Security
+
+
+def test_only_active_admin_keys_match(app, client, admin_key):
+    assert client.get(f'/api/license/{admin_key}/30').status_code == 200
+    assert client.get(f'/api/license/{uuid.uuid4()}/30').status_code == 400
+
+    with app.app_context():
+        key = AdminManage.create()
+        assert AdminKeyCache.contains(key)      # the insert invalidated the cached digests
+
+        admin_row = next(row for row in Admin.query.all() if Security.fernet_uuid_decrypt(row.id) == key)
+        admin_row.status = definitions.STATUS_INACTIVE
+        db.session.commit()
+        assert not AdminKeyCache.contains(key)
@@ -0,0 +1,73 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+httpx = pytest.importorskip('httpx')
+pytest.importorskip('aiosqlite')
+pytest.importorskip('asgiref')
+
+
+@pytest.fixture(scope='module')
+def asgi_app(app):
+    from aio import AsyncDatabase
+    from asgi import AsgiApp
+    AsyncDatabase.init_app(app)
+    return AsgiApp(app)
+
+
+def fetch(asgi_app, method, path, **kwargs):
+    async def go():
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://anex') as asgi_client:
+            return await asgi_client.request(method, path, **kwargs)
+    return asyncio.run(go())
+
+
+def test_raw_load_decompresses_off_the_event_loop(asgi_app, client, user, monkeypatch):
+    import codec
+    _, _, skey = user
+    document = {'items': ['x' * 100] * 5000}
+    assert client.post(f'/api/save_user_data/{skey}', json=document).status_code == 200
+
+    threads = set()
+    decompress_chunks = codec.Codec.decompress_chunks
+
+    def recording(*args, **kwargs):
+        for chunk in decompress_chunks(*args, **kwargs):
+            threads.add(threading.get_ident())
+            yield chunk
+    monkeypatch.setattr(codec.Codec, 'decompress_chunks', staticmethod(recording))
+
+    response = fetch(asgi_app, 'GET', f'/api/load_user_data/{skey}?raw=1', headers={'Accept-Encoding': 'identity'})
+    assert response.status_code == 200
+    assert json.loads(response.content) == document
+    assert threads and threading.get_ident() not in threads
+
+
+def test_load_keeps_the_envelope_for_clients_accepting_deflate(asgi_app, client, user):
+    _, _, skey = user
+    assert client.post(f'/api/save_user_data/{skey}', json={'a': 1}).status_code == 200
+
+    response = fetch(asgi_app, 'GET', f'/api/load_user_data/{skey}', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.status_code == 200
+    assert json.loads(response.json()['userData']) == {'a': 1}
+
+
+@pytest.mark.parametrize('content_length', [b'abc', b'-1', b'1e3'])
+def test_malformed_content_length_is_a_bad_request(asgi_app, user, content_length):
+    # sent as raw ASGI messages, as HTTP clients always send the real length
+    _, _, skey = user
+    scope = {'type': 'http', 'method': 'POST', 'path': f'/api/save_user_data/{skey}', 'query_string': b'',
+             'headers': [(b'content-type', b'application/json'), (b'content-length', content_length)]}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'{"a": 1}', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    assert sent[0]['status'] == 400
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+import benchmark
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_hash_queue_fits_every_client(monkeypatch, tmp_path):
+    monkeypatch.delenv('ANEX_HASH_QUEUE_DEPTH', raising=False)
+    for name in ('ANEX_DATABASE_URI', 'ANEX_LOG_FILE', 'ANEX_BOOTSTRAP_LOCK', 'ANEX_LOG_CONSOLE',
+                 'ANEX_SWEEP_INTERVAL', 'ANEX_LOGIN_ADDRESS_BURST', 'ANEX_LOGIN_USERNAME_BURST'):
+        monkeypatch.setenv(name, os.environ.get(name, ''))     # restored after the test
+
+    benchmark.prepare_environment(str(tmp_path), 64)
+    assert int(os.environ['ANEX_HASH_QUEUE_DEPTH']) >= 64
+
+
+def test_percentile_and_regressions():
+    assert benchmark.percentile([1, 2, 3, 4], 50) == 2
+    assert benchmark.percentile([], 99) == 0.0
+
+    base = {'transport': 'waitress', 'endpoint': 'login', 'concurrency': 4, 'payload': 0,
+            'p50_ms': 10.0, 'p99_ms': 20.0, 'rps': 100.0, 'queries': 4.0}
+    slower = dict(base, p99_ms=30.0, queries=5.0)
+    assert benchmark.compare([base], {benchmark.result_key(base): base}, 0.2) == []
+    assert len(benchmark.compare([slower], {benchmark.result_key(base): base}, 0.2)) == 2
+
+
+def test_small_sweep_runs_and_cleans_up(tmp_path):
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'benchmark.py'), '--concurrency', '2', '--payloads', '1k',
+         '--requests', '3', '--transports', 'testclient,waitress'],
+        cwd=tmp_path, env={**os.environ, 'TMPDIR': str(tmp_path)}, capture_output=True, text=True, timeout=300)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'waitress   load_user_data' in result.stdout
+    assert os.listdir(tmp_path) == []
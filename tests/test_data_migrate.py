@@ -0,0 +1,45 @@
+from sqlalchemy import delete
+
+from data import DataCipher, DataMigrate
+from exts import db
+from models import Data, Session
+from security import Security
+
+
+def legacy_rows(user_id, payloads):
+    rows = [Data(user_id=user_id, userData=payload, codec=0) for payload in payloads]
+    db.session.add_all(rows)
+    db.session.commit()
+    return [row.id for row in rows]
+
+
+def test_a_corrupt_row_is_skipped_and_the_rows_after_it_converted(app, user):
+    _, _, skey = user
+    with app.app_context():
+        user_id = db.session.get(Session, skey).user_id
+        db.session.execute(delete(Data).where(Data.userBlob.is_(None)))
+        good = Security.fernet_encrypt_bytes(b'{"a": 1}')
+        ids = legacy_rows(user_id, [b'not a fernet token', good, good, b'gAAAAAbroken', good])
+
+        after, converted, skipped = 0, 0, 0
+        while True:
+            batch_converted, batch_skipped, after = DataMigrate.run_batch(batch_size=2, after=after)
+            if batch_converted + batch_skipped == 0:
+                break
+            converted += batch_converted
+            skipped += batch_skipped
+
+        assert (converted, skipped) == (3, 2)
+        rows = {row.id: row for row in Data.query.filter(Data.id.in_(ids))}
+        for row_id in (ids[1], ids[2], ids[4]):
+            assert rows[row_id].userData is None
+            assert DataCipher.payload(rows[row_id]) == b'{"a": 1}'
+        for row_id in (ids[0], ids[3]):
+            assert rows[row_id].userBlob is None    # left as it was, for an operator to look at
+
+
+def test_no_legacy_rows_left_ends_the_migration(app):
+    with app.app_context():
+        db.session.execute(delete(Data).where(Data.userBlob.is_(None)))
+        db.session.commit()
+        assert DataMigrate.run_batch()[:2] == (0, 0)
@@ -0,0 +1,41 @@
+import hashlib
+
+from data import DataLookup, DataManage
+from exts import db
+from migrations import migrate_keyed_etags
+from models import Data, Session
+from security import Security
+
+DOCUMENT = b'{"pin": 1234}'
+
+
+def user_id_of(skey):
+    return db.session.get(Session, skey).user_id
+
+
+def test_etag_is_keyed_and_bound_to_the_user(app, user):
+    _, _, skey = user
+    with app.app_context():
+        user_id = user_id_of(skey)
+        etag = DataManage.save_document(user_id, DOCUMENT)
+
+        assert etag != hashlib.sha256(DOCUMENT).hexdigest()
+        assert etag == Security.document_etag(user_id, DOCUMENT)
+        assert DataLookup.latest_etag(user_id) == (True, etag)
+        assert Security.document_etag('someone-else', DOCUMENT) != etag
+
+
+def test_migration_replaces_unkeyed_etags(app, user):
+    _, _, skey = user
+    with app.app_context():
+        user_id = user_id_of(skey)
+        unkeyed = hashlib.sha256(DOCUMENT).hexdigest()
+        row = Data(user_id=user_id, userData=Security.fernet_encrypt_bytes(DOCUMENT), codec=0, etag=unkeyed)
+        db.session.add(row)
+        db.session.commit()
+
+        with db.engine.begin() as connection:
+            migrate_keyed_etags(connection)
+
+        db.session.refresh(row)
+        assert row.etag != unkeyed and len(row.etag) == 64
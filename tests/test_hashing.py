@@ -0,0 +1,50 @@
+import time
+
+import pytest
+from werkzeug.exceptions import ServiceUnavailable
+
+import hashing
+from hashing import HashPool
+
+slots = HashPool._HashPool__slots
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(hashing, 'HASH_WORKERS', 1)
+    yield
+    HashPool.shutdown()
+
+
+def wait_for_free_slots(count, timeout=30):
+    deadline = time.monotonic() + timeout
+    while slots._value != count and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return slots._value
+
+
+def test_a_timed_out_hash_keeps_its_slot_until_the_worker_is_done(pool, monkeypatch):
+    free = slots._value
+    monkeypatch.setattr(hashing, 'HASH_TIMEOUT', 0.05)
+
+    with pytest.raises(ServiceUnavailable):
+        HashPool._HashPool__run(time.sleep, 1)
+
+    assert slots._value == free - 1
+    assert wait_for_free_slots(free) == free
+
+
+def test_import_hashes_take_slots(pool, monkeypatch):
+    free = slots._value
+    assert len(HashPool.generate_many(['one', 'two', 'three'])) == 3
+    assert wait_for_free_slots(free) == free
+
+    monkeypatch.setattr(hashing, 'HASH_TIMEOUT', 0.1)
+    for _ in range(free):
+        slots.acquire()
+    try:
+        with pytest.raises(TimeoutError, match='slot'):
+            HashPool.generate_many(['one'])
+    finally:
+        for _ in range(free):
+            slots.release()
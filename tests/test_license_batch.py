@@ -0,0 +1,40 @@
+import json
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import license
+
+
+@pytest.fixture
+def failing_second_chunk(monkeypatch):
+    inserts = []
+    real_insert = license.insert
+
+    def insert(table):
+        inserts.append(table)
+        if len(inserts) == 2:
+            raise OperationalError('INSERT', {}, Exception('disk full'))
+        return real_insert(table)
+    monkeypatch.setattr(license, 'insert', insert)
+    monkeypatch.setattr(license.LicenseManage.create_batch, '__defaults__', (2,))
+
+
+def test_batch_streams_every_license(client, admin_key):
+    response = client.get(f'/api/license/{admin_key}/30/3?format=ndjson')
+    records = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert response.status_code == 200
+    assert len(records) == 3 and all('key' in record for record in records)
+
+
+def test_failed_batch_ends_with_an_error_record(client, admin_key, failing_second_chunk):
+    response = client.get(f'/api/license/{admin_key}/30/5?format=ndjson')
+    records = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert response.status_code == 200
+    assert [record.get('key') is not None for record in records] == [True, True, False]
+    assert records[-1]['created'] == 2 and 'error' in records[-1]
+
+
+def test_failed_csv_batch_ends_with_an_error_row(client, admin_key, failing_second_chunk):
+    lines = client.get(f'/api/license/{admin_key}/30/5').data.decode().splitlines()
+    assert len(lines) == 4 and lines[-1].startswith('error,')
@@ -0,0 +1,20 @@
+import logging
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_the_server_modules_leaves_logging_alone():
+    # only create_app (or the server's supervisor) starts the log pipeline
+    code = 'import logging, errors, views; assert not logging.getLogger().handlers, logging.getLogger().handlers'
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, env={**os.environ, 'ANEX_LOG_CONSOLE': '0'})
+
+
+def test_records_are_tagged_on_the_thread_that_logs_them(app):
+    from logs import RequestFilter
+    record = logging.LogRecord('root', logging.INFO, __file__, 1, 'message', None, None)
+    with app.test_request_context('/api/login/x', headers={'X-Request-ID': 'req-42'}):
+        assert RequestFilter().filter(record)
+    assert record.request_id == 'req-42'
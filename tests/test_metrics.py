@@ -0,0 +1,25 @@
+import threading
+
+from metrics import Metrics
+
+STORES = '_Metrics__stores'
+
+
+def requests_counted(text, endpoint):
+    prefix = f'anex_requests_total{{endpoint="{endpoint}",status="200"}} '
+    return sum(int(line[len(prefix):]) for line in text.splitlines() if line.startswith(prefix))
+
+
+def test_ended_threads_are_folded_into_the_total():
+    before = requests_counted(Metrics.render(), 'metrics_test')
+
+    def record():
+        Metrics.inc('anex_requests_total', (('endpoint', 'metrics_test'), ('status', '200')))
+
+    for _ in range(20):
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+
+    assert requests_counted(Metrics.render(), 'metrics_test') == before + 20
+    assert all(thread.is_alive() for thread, _ in getattr(Metrics, STORES))
@@ -0,0 +1,58 @@
+import re
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, inspect
+
+from exts import db
+from migrations import MIGRATIONS, Migrations, QueryPlan, add_column
+
+# the index each hot lookup must use, by lookup name: (table, index name or None for the unique
+# constraint's automatic index, indexed column)
+EXPECTED_INDEXES = {
+    'UserLookup.id': [('user', None, 'user_id')],
+    'UserLookup.username': [('user', 'uq_user_username', 'username')],
+    'UserLookup.email': [('user', None, 'email')],
+    'UserLookup.login': [('user', 'uq_user_username', 'username'), ('license', None, 'license_id')],
+    'UserLookup.taken': [('user', 'uq_user_username', 'username'), ('user', None, 'email')],
+    'SessionLookup.record_by_skey': [('session', None, 'ses_key')],
+    'SessionLookup.record_by_user_id': [('session', 'idx_session_user', 'user_id')],
+    'LicenseLookUp.by_license_key': [('license', None, 'license_id')],
+    'LicenseLookUp.by_license_keys': [('license', None, 'license_id')],
+    'DataLookup.latest': [('data', 'idx_user', 'user_id')],
+    'DataLookup.latest_etag': [('data', 'idx_user', 'user_id')],
+}
+
+
+def test_migrations_are_applied(app):
+    with app.app_context():
+        assert Migrations.current_version() == max(version for version, _, _ in MIGRATIONS)
+
+
+def test_hot_lookups_use_their_index(app):
+    with app.app_context():
+        plans = QueryPlan.plans()
+
+    assert {name for name, _, _ in plans} == set(EXPECTED_INDEXES)
+    for name, expected in EXPECTED_INDEXES.items():
+        details = [detail for lookup, _, detail in plans if lookup == name]
+        assert len(details) == len(expected), details
+        for detail, (table, index, column) in zip(details, expected):
+            index = re.escape(index) if index else rf'sqlite_autoindex_{table}_\d+'
+            assert re.match(rf'^SEARCH {table} USING (COVERING )?INDEX {index} \({column}=\?\)', detail), detail
+
+    with app.app_context():
+        assert QueryPlan.check() == []
+
+
+@pytest.mark.parametrize('table_name, column_name', [('order', 'group'), ('anex test', 'new column')])
+def test_add_column_quotes_identifiers(app, table_name, column_name):
+    table = Table(table_name, MetaData(), Column('id', Integer, primary_key=True))
+    with app.app_context(), db.engine.begin() as connection:
+        table.create(connection)
+        column = Column(column_name, String(16), nullable=False, server_default='x')
+        table.append_column(column)
+        add_column(connection, column)
+        add_column(connection, column)      # a second run is a no-op
+
+        assert column_name in {c['name'] for c in inspect(connection).get_columns(table_name)}
+        table.drop(connection)
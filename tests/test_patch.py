@@ -0,0 +1,83 @@
+import pytest
+
+from patch import JsonPatch, PatchError
+
+JSON_PATCH = 'application/json-patch+json'
+
+
+def test_operations_apply_to_a_copy():
+    document = {'a': [1, 2], 'b': {'c': 'x'}}
+    patched = JsonPatch.apply(document, [
+        {'op': 'add', 'path': '/a/-', 'value': 3},
+        {'op': 'remove', 'path': '/a/0'},
+        {'op': 'replace', 'path': '/b/c', 'value': 'y'},
+        {'op': 'move', 'from': '/b/c', 'path': '/d'},
+        {'op': 'copy', 'from': '/a', 'path': '/e'},
+        {'op': 'test', 'path': '/e', 'value': [2, 3]},
+    ])
+    assert patched == {'a': [2, 3], 'b': {}, 'd': 'y', 'e': [2, 3]}
+    assert document == {'a': [1, 2], 'b': {'c': 'x'}}
+
+
+@pytest.mark.parametrize('operation', [
+    {'op': 'add', 'path': 5, 'value': 1},
+    {'op': 'move', 'path': 5, 'from': '/a'},
+    {'op': 'move', 'path': '/b', 'from': ['a']},
+    {'op': 'copy', 'path': '/b', 'from': None},
+    {'op': 'test', 'path': {'a': 1}, 'value': 1},
+    {'op': 'remove', 'path': '/a/²'},
+])
+def test_malformed_pointers_are_patch_errors(operation):
+    with pytest.raises(PatchError):
+        JsonPatch.apply({'a': [1]}, [operation])
+
+
+@pytest.mark.parametrize('current, expected', [
+    (1, True),
+    (1, 1.0),
+    (0, False),
+    ([1, {'b': True}], [1, {'b': 1}]),
+    ({'a': 1.0}, {'a': 1}),
+])
+def test_test_compares_types_all_the_way_down(current, expected):
+    with pytest.raises(PatchError):
+        JsonPatch.apply({'v': current}, [{'op': 'test', 'path': '/v', 'value': expected}])
+
+
+def test_merge_patch_removes_nulls():
+    assert JsonPatch.merge({'a': 1, 'b': {'c': 2, 'd': 3}}, {'a': None, 'b': {'d': 4}}) == {'b': {'c': 2, 'd': 4}}
+
+
+def test_non_string_pointer_is_a_bad_request(client, user):
+    _, _, skey = user
+    assert client.post(f'/api/save_user_data/{skey}', json={'a': 1}).status_code == 200
+
+    response = client.patch(f'/api/patch_user_data/{skey}', data='[{"op": "move", "path": 5, "from": "/a"}]',
+                            headers={'Content-Type': JSON_PATCH, 'If-Match': '*'})
+    assert response.status_code == 400
+
+
+def test_stale_if_match_is_refused(client, user):
+    _, _, skey = user
+    assert client.post(f'/api/save_user_data/{skey}', json={'a': 1}).status_code == 200
+    etag = client.get(f'/api/load_user_data/{skey}').headers['ETag']
+
+    patch = '[{"op": "replace", "path": "/a", "value": 2}]'
+    headers = {'Content-Type': JSON_PATCH, 'If-Match': etag}
+    assert client.patch(f'/api/patch_user_data/{skey}', data=patch, headers=headers).status_code == 200
+    assert client.patch(f'/api/patch_user_data/{skey}', data=patch, headers=headers).status_code == 412
+    assert client.get(f'/api/load_user_data/{skey}').json['userData'] == '{"a": 2}'
+
+
+def test_conditional_save_checks_the_version_in_its_transaction(app, user):
+    from data import DataLookup, DataManage
+    from exts import db
+    from models import Session
+    _, _, skey = user
+    with app.app_context():
+        user_id = db.session.get(Session, skey).user_id
+        etag = DataManage.save_document(user_id, b'{"a": 1}')
+
+        assert DataManage.save_document(user_id, b'{"a": 2}', if_etag='stale') is None
+        assert DataLookup.latest_etag(user_id) == (True, etag)
+        assert DataManage.save_document(user_id, b'{"a": 3}', if_etag=etag) is not None
@@ -0,0 +1,60 @@
+import pytest
+
+import ratelimit
+from ratelimit import LoginLimiter, TokenBucketLimiter
+
+
+@pytest.fixture
+def usernames(monkeypatch):
+    limiter = TokenBucketLimiter(2, 1 / 60, 60)
+    monkeypatch.setattr(LoginLimiter, 'usernames', limiter)
+    return limiter
+
+
+def login(client, access_key, username, password):
+    return client.post(f'/api/login/{access_key}', json={'username': username, 'password': password})
+
+
+def test_bucket_locks_out_when_dry_and_resets():
+    limiter = TokenBucketLimiter(2, 1 / 60, 60)
+    assert limiter.consume('a') == 0
+    assert limiter.consume('a') == 0
+    assert limiter.consume('a') > 0
+    assert 'a' in limiter.lockouts()
+
+    limiter.reset('a')
+    assert limiter.retry_after('a') == 0
+
+
+def test_attempts_reserve_a_username_token_before_they_are_checked(usernames):
+    # two logins in flight, neither has failed yet: a third one is already refused
+    assert LoginLimiter.admit('alice', '10.0.0.1') == 0
+    assert LoginLimiter.admit('alice', '10.0.0.2') == 0
+    assert LoginLimiter.admit('alice', '10.0.0.3') > 0
+    assert LoginLimiter.admit('bob', '10.0.0.3') == 0
+
+
+def test_wrong_passwords_lock_the_username_out(client, access_key, user, usernames):
+    username, password, _ = user
+    assert login(client, access_key, username, 'wrongpass1').status_code == 400
+    assert login(client, access_key, username, 'wrongpass1').status_code == 400
+
+    response = login(client, access_key, username, password)
+    assert response.status_code == 400 and b'Try again' in response.data
+
+
+def test_successful_logins_give_their_token_back(client, access_key, user, usernames):
+    username, password, _ = user
+    for _ in range(5):
+        assert login(client, access_key, username, password).status_code == 200
+
+
+def test_refilled_buckets_are_pruned_on_access(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'RATE_LIMIT_PRUNE_INTERVAL', 0)
+    limiter = TokenBucketLimiter(1, 10 ** 6, 0, shards=1)
+    limiter.consume('idle')
+    (_, buckets, _), = limiter._TokenBucketLimiter__shards
+    assert 'idle' in buckets
+
+    limiter.consume('other')
+    assert 'idle' not in buckets
@@ -0,0 +1,85 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+from cryptography.fernet import Fernet
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# every phase runs in its own process, as the master keys are read when security.py is imported
+PREAMBLE = """
+import json, sys
+sys.path.insert(0, {root!r})
+from app import create_app
+from exts import db
+from models import Admin, Data, User
+from security import Security
+app = create_app(background=False)
+ctx = app.app_context()
+ctx.push()
+"""
+
+WRITE = """
+import uuid, definitions
+from datetime import datetime
+from data import DataManage
+from hashing import generate_password_hash
+from models import License
+license_row = License(id=str(uuid.uuid4()), status=definitions.STATUS_ACTIVE, expires=datetime.now(),
+                      can_expire=False, claimed=True)
+user = User(license=license_row.id, username='rotator', password=generate_password_hash('secret123'),
+            login_attempts=0, email='rotator@test.anex', status=definitions.STATUS_ACTIVE)
+db.session.add_all([license_row, user])
+db.session.commit()
+user_id = user.id
+DataManage.save_document(user_id, b'{"v": 1}', keep=10)
+DataManage.save_document(user_id, b'{"v": 2}', keep=10)
+db.session.add(Data(user_id=user_id, userData=Security.fernet_encrypt('{"v": 0}'), codec='identity'))
+db.session.commit()
+"""
+
+ROTATE = """
+from rotation import KeyRotation
+print(json.dumps({'finished': KeyRotation.run(), 'again': KeyRotation.run()}))
+"""
+
+READ = """
+from data import DataCipher
+rows = Data.query.order_by(Data.id).all()
+print(json.dumps({
+    'documents': [DataCipher.decrypt(row).decode() for row in rows],
+    'current': [Security.aes_current_key(row.userBlob) if row.userBlob is not None
+                else Security.fernet_current_key(row.userData) for row in rows],
+    'admins': [Security.fernet_current_key(row.id) for row in Admin.query.all()],
+}))
+"""
+
+
+def run_phase(tmp_path, script, master_key, previous_keys=''):
+    env = {**os.environ, 'ANEX_MASTER_KEY': master_key, 'ANEX_PREVIOUS_MASTER_KEYS': previous_keys,
+           'ANEX_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'anex.db'), 'ANEX_LOG_FILE': str(tmp_path / 'anex.log'),
+           'ANEX_BOOTSTRAP_LOCK': str(tmp_path / 'anex.lock'), 'ANEX_KEY_ROTATE': '0', 'ANEX_DATA_MIGRATE': '0'}
+    code = textwrap.dedent(PREAMBLE).format(root=ROOT) + textwrap.dedent(script)
+    result = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, env=env, capture_output=True, text=True,
+                            timeout=120)
+    assert result.returncode == 0, result.stderr
+    lines = result.stdout.splitlines()
+    return json.loads(lines[-1]) if lines and lines[-1].startswith('{') else None
+
+
+def test_rotation_moves_every_row_to_the_new_key(tmp_path):
+    old_key, new_key = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+
+    run_phase(tmp_path, WRITE, old_key)
+    before = run_phase(tmp_path, READ, new_key, old_key)
+    assert before['current'] == [False, False, False] and before['admins'] == [False]
+
+    assert run_phase(tmp_path, ROTATE, new_key, old_key) == {'finished': True, 'again': True}
+
+    # the previous key is gone: everything must still decrypt
+    after = run_phase(tmp_path, READ, new_key)
+    assert after['documents'] == before['documents'] == ['{"v": 1}', '{"v": 2}', '{"v": 0}']
+    assert after['current'] == [True, True, True] and after['admins'] == [True]
+
@@ -0,0 +1,92 @@
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from waitress import create_server
+
+pytest.importorskip('fcntl')    # the multi-process server is Unix only
+
+from server import HeartbeatTask, Worker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_heartbeat(fd, timeout):
+    if not select.select([fd], [], [], timeout)[0]:
+        return None
+    return json.loads(os.read(fd, 65536).splitlines()[-1])
+
+
+def status_of(url):
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_a_worker_whose_threads_are_stuck_sends_no_heartbeat():
+    release = threading.Event()
+
+    def stuck_app(environ, start_response):
+        release.wait(10)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'done']
+
+    sock = socket.create_server(('127.0.0.1', 0))
+    read_fd, write_fd = os.pipe()
+    worker = Worker(stuck_app, sock, 1, write_fd)
+    server = create_server(worker.count_request, sockets=[sock], threads=1)
+    threading.Thread(target=server.run, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+        threading.Thread(target=lambda: urllib.request.urlopen(url, timeout=10).read(), daemon=True).start()
+        time.sleep(0.3)     # the only thread is now serving the stuck request
+
+        server.task_dispatcher.add_task(HeartbeatTask(worker, server))
+        assert read_heartbeat(read_fd, 0.5) is None
+
+        release.set()
+        heartbeat = read_heartbeat(read_fd, 5)
+        assert heartbeat is not None and heartbeat['requests'] == 1
+    finally:
+        release.set()
+        server.close()
+        server.task_dispatcher.shutdown()
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_server_serves_and_stops_gracefully(tmp_path):
+    with socket.create_server(('127.0.0.1', 0)) as probe:
+        port = probe.getsockname()[1]
+    env = {**os.environ, 'ANEX_WORKER_STATUS': str(tmp_path / 'workers.json'), 'ANEX_HEARTBEAT_INTERVAL': '0.2'}
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), '--host', '127.0.0.1',
+                                '--port', str(port), '--workers', '1'], cwd=tmp_path, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        status = None
+        while time.monotonic() < deadline:
+            try:
+                with open(tmp_path / 'workers.json') as status_file:
+                    status = json.load(status_file)
+                if status['workers'] and status['workers'][0]['state'] == 'ready':
+                    break
+            except (OSError, ValueError):
+                pass
+            time.sleep(0.2)
+        assert status and status['workers'][0]['state'] == 'ready', status
+        assert status_of(f'http://127.0.0.1:{port}/api/no-such-route') == 404
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(30) == 0
@@ -0,0 +1,56 @@
+import time
+from datetime import datetime, timedelta
+
+from exts import db
+from models import Revocation, Session
+from session import RevocationList, SessionCache, SessionLookup
+
+
+def save(client, skey):
+    return client.post(f'/api/save_user_data/{skey}', json={'value': 1}).status_code
+
+
+def test_login_rotation_drops_the_cached_session(client, access_key, user):
+    username, password, old_key = user
+    assert save(client, old_key) == 200     # cached now
+
+    response = client.post(f'/api/login/{access_key}', json={'username': username, 'password': password})
+    assert response.status_code == 200
+
+    assert save(client, old_key) == 400
+    assert save(client, response.json['key']) == 200
+
+
+def test_revocation_from_another_process_drops_the_cached_session(app, client, user):
+    _, _, skey = user
+    assert save(client, skey) == 200
+
+    with app.app_context():
+        user_id = db.session.get(Session, skey).user_id
+        # another worker logs the user out: its rows are gone, this process still caches the session
+        Session.query.filter_by(user_id=user_id).delete()
+        db.session.commit()
+        assert save(client, skey) == 200
+
+        db.session.add(Revocation(user_id=user_id, revoked_before=int(time.time() * 1000),
+                                  until=datetime.now() + timedelta(seconds=60)))
+        db.session.commit()
+        RevocationList.restore()    # what the flush thread does every REVOCATION_FLUSH_INTERVAL
+
+    assert save(client, skey) == 400
+
+
+def test_a_read_older_than_the_revocation_is_not_cached(app, user):
+    _, _, skey = user
+    with app.app_context():
+        SessionCache.evict(skey)
+        ses_row = db.session.get(Session, skey)
+        read_at = int(time.time() * 1000) - 1
+
+        RevocationList.revoke(ses_row.user_id, 60)      # a logout lands while the row is in flight
+        SessionCache.put(ses_row, read_at)
+
+        assert SessionCache.get(skey) is None
+        time.sleep(0.002)
+        assert SessionLookup.record_by_skey(skey) is not None   # read again, after the revocation
+        assert SessionCache.get(skey) is not None
@@ -1,11 +1,31 @@
 from models import db
-from models import User, Data
+from models import License, User
+from data import DataLookup, DataManage, ANY_VERSION
 from datetime import datetime, timedelta
+from collections import namedtuple
+from threading import Event, Lock, Thread
+from sqlalchemy import insert, select, update
+import atexit
+import csv
+import definitions
+import json
 import math
+import os
+import uuid
+from werkzeug.exceptions import HTTPException
 from werkzeug.security import check_password_hash
-from errors import Err, LogLevel
+from errors import Err, LogLevel, log
+from hashing import HashPool
+from license import LicenseLookUp
+from validation import Validate
 
 LAST_LOGIN_RESET_PERIOD = 10  # minutes
+LOGIN_FLUSH_INTERVAL = int(os.getenv('ANEX_LOGIN_FLUSH_INTERVAL', 5))  # seconds
+USER_IMPORT_CHUNK = int(os.getenv('ANEX_USER_IMPORT_CHUNK', 500))      # users checked, hashed and inserted together
+IMPORT_FIELDS = ('username', 'email', 'password', 'key')
+
+LoginUser = namedtuple('LoginUser', ['id', 'password', 'status', 'last_login_attempt'])
+LoginLicense = namedtuple('LoginLicense', ['id', 'status', 'claimed', 'can_expire', 'expires'])
 
 
 class UserLookup:
@@ -42,6 +62,35 @@ class UserLookup:
             return True, user
         return False, None
 
+    @staticmethod
+    def login(username):
+        """
+        Fetches a user and their license together in one joined query, for the login path. The read
+        transaction is ended straight away, so none is held while the password is hashed.
+
+        :param username: The parameter `username` is the username that is logging in
+        :return: a tuple. The first element is a boolean value indicating whether the user exists, the
+        second a tuple of a `LoginUser` and a `LoginLicense` (None if the license does not exist), or None
+        if the user doesn't exist.
+        """
+        row = db.session.execute(
+            select(User.id, User.password, User.status, User.last_login_attempt,
+                   License.id.label('license_id'), License.status.label('license_status'), License.claimed,
+                   License.can_expire, License.expires)
+            .outerjoin(License, License.id == User.license)
+            .where(User.username == username)
+        ).first()
+        db.session.commit()
+
+        if row is None:
+            return False, None
+
+        user = LoginUser(row.id, row.password, row.status, row.last_login_attempt)
+        if row.license_id is None:
+            return True, (user, None)
+        return True, (user, LoginLicense(row.license_id, row.license_status, row.claimed, row.can_expire,
+                                         row.expires))
+
     @staticmethod
     def email(email):
         """
@@ -59,6 +108,24 @@ class UserLookup:
             return True, user
         return False, None
 
+    @staticmethod
+    def taken(usernames, emails):
+        """
+        Finds which of many usernames and emails are already registered, with one query per column on its
+        unique index.
+
+        :param usernames: The `usernames` parameter is a collection of usernames to check
+        :param emails: The `emails` parameter is a collection of email addresses to check
+        :return: a tuple of the set of taken usernames and the set of taken emails.
+        """
+        taken_usernames = set()
+        taken_emails = set()
+        if usernames:
+            taken_usernames = set(db.session.scalars(select(User.username).where(User.username.in_(usernames))))
+        if emails:
+            taken_emails = set(db.session.scalars(select(User.email).where(User.email.in_(emails))))
+        return taken_usernames, taken_emails
+
 
 class UserManage:
     @staticmethod
@@ -97,21 +164,328 @@ class UserManage:
         return 1
 
 
+class UserImport:
+    @staticmethod
+    def read(stream, import_format):
+        """
+        Starts parsing a user import body line by line: NDJSON objects, or CSV with a header row. Each row
+        names a `username`, `email`, `password` and license `key`.
+
+        :param stream: The `stream` parameter is the binary body stream, e.g. `request.stream`
+        :param import_format: The `import_format` parameter is `csv` or `ndjson`
+        :raises ValueError: if a CSV header does not name every field
+        :return: a generator of (line number, row dictionary, error) tuples; the row is None when the line
+        could not be parsed, and the error is None when it could.
+        """
+        lines = (line.decode('utf-8', errors='replace') for line in stream)
+        if import_format == 'csv':
+            reader = csv.DictReader(lines)
+            if reader.fieldnames is None or not set(IMPORT_FIELDS) <= set(reader.fieldnames):
+                raise ValueError(f"CSV header must name the columns {', '.join(IMPORT_FIELDS)}")
+            return ((reader.line_num, row, None) for row in reader)
+        return UserImport.__ndjson_rows(lines)
+
+    @staticmethod
+    def __ndjson_rows(lines):
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, None, f"Invalid JSON: {e}"
+                continue
+            if isinstance(row, dict):
+                yield number, row, None
+            else:
+                yield number, None, Err.ERROR_MESSAGES['JSON_DATA_TYPE']
+
+    @staticmethod
+    def run(rows, chunk_size=USER_IMPORT_CHUNK):
+        """
+        Creates users from parsed import rows, `chunk_size` at a time (see `create_chunk`). Only one chunk
+        is held in memory at a time.
+
+        :param rows: The `rows` parameter is the generator returned by `read`
+        :param chunk_size: The `chunk_size` parameter is the number of rows per transaction
+        :return: a generator yielding, after each chunk, the list of per-row results: dictionaries with the
+        `line`, `username`, `status` (`created`, `rejected` if the row must be fixed, or `failed` if it can
+        be retried) and `error`.
+        """
+        counts = {'created': 0, 'rejected': 0, 'failed': 0}
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                results = UserImport.create_chunk(chunk)
+                chunk = []
+                for result in results:
+                    counts[result['status']] += 1
+                yield results
+
+        if chunk:
+            results = UserImport.create_chunk(chunk)
+            for result in results:
+                counts[result['status']] += 1
+            yield results
+
+        log(f"User import: {counts['created']} created, {counts['rejected']} rejected, {counts['failed']} failed",
+            LogLevel.INFO)
+
+    @staticmethod
+    def create_chunk(chunk):
+        """
+        Creates the users of one chunk of import rows. Rows are validated, then checked set-wise against the
+        registered usernames and emails, the claimable licenses and the rest of the chunk; the passwords
+        of the remaining rows are hashed in parallel on the `HashPool`, and the users are inserted and
+        their licenses claimed in one transaction.
+
+        :param chunk: The `chunk` parameter is a list of (line number, row dictionary, error) tuples
+        :return: the list of per-row results, in the order of the chunk.
+        """
+        results = []
+        candidates = []
+        for line, row, error in chunk:
+            username = row.get('username') if row is not None else None
+            result = {'line': line, 'username': username, 'status': 'rejected', 'error': error}
+            results.append(result)
+            if error is None:
+                result['error'] = UserImport.invalid(row)
+                if result['error'] is None:
+                    candidates.append((result, row))
+
+        taken_usernames, taken_emails = UserLookup.taken({row['username'] for _, row in candidates},
+                                                         {row['email'] for _, row in candidates})
+        licenses = LicenseLookUp.by_license_keys({row['key'] for _, row in candidates})
+
+        accepted = []
+        usernames, emails, keys = set(), set(), set()
+        for result, row in candidates:
+            if row['username'] in taken_usernames or row['username'] in usernames:
+                result['error'] = Err.ERROR_MESSAGES['USERNAME_NOT_UNIQUE']
+            elif row['email'] in taken_emails or row['email'] in emails:
+                result['error'] = Err.ERROR_MESSAGES['EMAIL_NOT_UNIQUE']
+            elif row['key'] in keys or LicenseLookUp.claimable(licenses.get(row['key'])) is False:
+                result['error'] = Err.ERROR_MESSAGES['INVALID_LICENSE']
+            else:
+                accepted.append((result, row))
+                usernames.add(row['username'])
+                emails.add(row['email'])
+                keys.add(row['key'])
+        db.session.commit()     # ends the read transaction, it is not held while the passwords are hashed
+
+        if not accepted:
+            return results
+
+        try:
+            hashes = HashPool.generate_many([row['password'] for _, row in accepted])
+        except Exception as e:
+            log("User import could not hash passwords: ", LogLevel.WARNING, repr(e))
+            return UserImport.__failed(results, accepted, Err.ERROR_MESSAGES['SERVER_BUSY'])
+
+        users = [{
+            'id': str(uuid.uuid4()),
+            'license': row['key'],
+            'username': row['username'],
+            'password': hashed_password,
+            'login_attempts': 0,
+            'email': row['email'],
+            'status': definitions.STATUS_ACTIVE,
+        } for (_, row), hashed_password in zip(accepted, hashes)]
+
+        try:
+            # claim only licenses still unclaimed, a concurrent sign-up may have taken one since the check
+            claimed = db.session.execute(update(License)
+                                         .where(License.id.in_(keys))
+                                         .where(License.claimed.is_(False))
+                                         .values(claimed=True)
+                                         .execution_options(synchronize_session=False)).rowcount
+            if claimed != len(keys):
+                raise ValueError(f"{len(keys) - claimed} licenses were claimed concurrently")
+            db.session.execute(insert(User), users)
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            log("User import chunk rolled back: ", LogLevel.WARNING, str(e))
+            return UserImport.__failed(results, accepted, Err.ERROR_MESSAGES['IMPORT_CONFLICT'])
+
+        for result, _ in accepted:
+            result['status'] = 'created'
+        return results
+
+    @staticmethod
+    def invalid(row):
+        """
+        Validates the fields of an import row, the same way `create_user` does.
+
+        :param row: The `row` parameter is the row dictionary
+        :return: the error message, or None if the row is valid.
+        """
+        for field in IMPORT_FIELDS:
+            if not isinstance(row.get(field), str):
+                return f"{Err.ERROR_MESSAGES['JSON_KEY_MISSING']}: {field}"
+
+        try:
+            Validate.username(row['username'])
+            Validate.email(row['email'])
+            Validate.password(row['password'])
+        except HTTPException as e:
+            return e.description
+
+        if not Validate.uuid_form(row['key']):
+            return Err.ERROR_MESSAGES['UUID_FORM']
+        return None
+
+    @staticmethod
+    def __failed(results, accepted, error):
+        for result, _ in accepted:
+            result['status'] = 'failed'
+            result['error'] = error
+        return results
+
+
+class LoginAttemptBuffer:
+    __pending = {}
+    __lock = Lock()
+    __stop = Event()
+    __thread = None
+
+    @staticmethod
+    def init(app):
+        """
+        Starts the background thread that periodically writes buffered login bookkeeping to the database,
+        and makes sure anything still buffered is written on shutdown.
+
+        :param app: The `app` parameter is the Flask application, whose context the flush runs in
+        """
+        if LoginAttemptBuffer.__thread is not None:
+            return
+
+        def flush_loop():
+            while not LoginAttemptBuffer.__stop.wait(LOGIN_FLUSH_INTERVAL):
+                with app.app_context():
+                    LoginAttemptBuffer.flush()
+
+        def flush_on_exit():
+            LoginAttemptBuffer.__stop.set()
+            with app.app_context():
+                LoginAttemptBuffer.flush()
+
+        LoginAttemptBuffer.__thread = Thread(target=flush_loop, name='anex-login-flush', daemon=True)
+        LoginAttemptBuffer.__thread.start()
+        atexit.register(flush_on_exit)
+
+    @staticmethod
+    def record(user_id, attempt_time, reset):
+        """
+        Buffers a login attempt for a user instead of writing it straight away.
+
+        :param user_id: The `user_id` parameter is the id of the user the attempt belongs to
+        :param attempt_time: The `attempt_time` parameter is the time of the login attempt
+        :param reset: The `reset` parameter is True if the user's failed login count should be cleared
+        """
+        with LoginAttemptBuffer.__lock:
+            pending = LoginAttemptBuffer.__pending.get(user_id)
+            if pending is not None:
+                reset = reset or pending[1]
+            LoginAttemptBuffer.__pending[user_id] = (attempt_time, reset)
+
+    @staticmethod
+    def attempt(user_id, last_login_attempt):
+        """
+        Buffers a login attempt happening now. The failed login count is reset when the previous attempt
+        is more than `LAST_LOGIN_RESET_PERIOD` minutes old.
+
+        :param user_id: The `user_id` parameter is the id of the user logging in
+        :param last_login_attempt: The `last_login_attempt` parameter is the previous attempt stored in the
+        user row, used when none is buffered
+        :return: a tuple of the attempt time and True if the failed login count is reset.
+        """
+        last_login_elapse = 255
+        last_login_attempt = LoginAttemptBuffer.last_attempt(user_id) or last_login_attempt
+
+        if last_login_attempt is not None:
+            last_login_elapse = datetime.now() - last_login_attempt
+            last_login_elapse = math.ceil(last_login_elapse.total_seconds() / 60)
+
+        attempt_time = datetime.now()
+        reset = last_login_elapse > LAST_LOGIN_RESET_PERIOD
+        LoginAttemptBuffer.record(user_id, attempt_time, reset)
+        return attempt_time, reset
+
+    @staticmethod
+    def last_attempt(user_id):
+        """
+        Returns the most recent buffered login attempt for a user.
+
+        :param user_id: The `user_id` parameter is the id of the user
+        :return: the time of the buffered attempt, or None if nothing is waiting to be written.
+        """
+        with LoginAttemptBuffer.__lock:
+            pending = LoginAttemptBuffer.__pending.get(user_id)
+        return pending[0] if pending is not None else None
+
+    @staticmethod
+    def discard(user_id):
+        """
+        Drops the buffered attempt for a user, used once the user row has been written directly.
+
+        :param user_id: The `user_id` parameter is the id of the user
+        """
+        with LoginAttemptBuffer.__lock:
+            LoginAttemptBuffer.__pending.pop(user_id, None)
+
+    @staticmethod
+    def flush():
+        """
+        Writes every buffered login attempt to the `User` table as bulk UPDATEs in a single transaction.
+        Must be called inside an application context.
+        """
+        with LoginAttemptBuffer.__lock:
+            pending = LoginAttemptBuffer.__pending
+            LoginAttemptBuffer.__pending = {}
+
+        if not pending:
+            return
+
+        stamps = [{'id': user_id, 'last_login_attempt': attempt_time}
+                  for user_id, (attempt_time, reset) in pending.items() if reset is False]
+        resets = [{'id': user_id, 'last_login_attempt': attempt_time, 'login_attempts': 0}
+                  for user_id, (attempt_time, reset) in pending.items() if reset is True]
+
+        try:
+            if stamps:
+                db.session.execute(update(User), stamps)
+            if resets:
+                db.session.execute(update(User), resets)
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            log("Failed to flush login attempts: ", LogLevel.ERROR, str(e))
+
+            # put the attempts back unless a newer one has been buffered in the meantime
+            with LoginAttemptBuffer.__lock:
+                for user_id, entry in pending.items():
+                    LoginAttemptBuffer.__pending.setdefault(user_id, entry)
+
+
 class UserEntity:
-    def __init__(self, id):
+    def __init__(self, id, read_only=False):
         """
         Initialises a user object with data retrieved from a database query.
 
         :param id: The `id` parameter is the unique identifier (user id) of the user. It is used to query the database
         and retrieve the user's information
+        :param read_only: The `read_only` parameter skips the login attempt bookkeeping, for endpoints that
+        only need to read the user (e.g. the user data endpoints), defaults to False (optional)
         """
         user_row = User.query.filter_by(id=id).first()
 
         if user_row is None:
             Err.client_return(Err.ERROR_MESSAGES['USER_ID_NOT_FOUND'], LogLevel.ERROR)
 
-        self.__set_manage_last_login(user_row)
-
         self.id = user_row.id
         self.license = user_row.license
         self.password = user_row.password
@@ -122,6 +496,9 @@ class UserEntity:
         self.email = user_row.email
         self.status = user_row.status
 
+        if read_only is False:
+            self.__set_manage_last_login()
+
     @property
     def data(self):
         """
@@ -129,56 +506,45 @@ class UserEntity:
         :return: The code is returning the most recent data entry for a specific user, based on their user
         ID.
         """
-        return Data.query.filter_by(user_id=self.id).order_by(Data.created.desc()).first()
+        return DataLookup.latest(self.id)
 
     @data.setter
     def data(self, bulk_data):
         """
-        Saves bulk data for a user, deletes older entries if there are more than one,
-        and prints the count of data entries for the user.
+        Saves bulk data for a user and deletes entries older than the last `DATA_RETENTION` versions, as
+        files can be large.
 
         :param bulk_data: The parameter `bulk_data` is a variable that represents a large amount of data
         that needs to be stored in the database
         """
-        try:
-            data = Data(
-                user_id=str(self.id),
-                userData=bulk_data,
-            )
-            db.session.add(data)
-
-        except Exception as e:
-             Err.database_return(e)
-
-        # Delete older entries, as files can be large
-        if Data.query.filter_by(user_id=self.id).count() > 1:
-            previous_save = Data.query.filter_by(user_id=self.id).order_by(Data.created.desc()).first()
-            old_data = Data.query.filter_by(user_id=self.id).filter(Data.id != previous_save.id).all()
-
-            for data in old_data:
-                db.session.delete(data)
+        DataManage.save(self.id, bulk_data)
 
-        db.session.commit()
-
-    def __set_manage_last_login(self, user_row):
+    def save_document(self, document, if_etag=ANY_VERSION):
         """
-        Sets the last login attempt time and manages the login attempts for a user.
+        Compresses, encrypts and saves a document for the user.
 
-        :param user_row: The `user_row` parameter is an object that represents a user in the database. It
-        likely contains information such as the user's login attempts, last login attempt time, and other
-        relevant data
+        :param document: The `document` parameter is the document bytes that need to be stored
+        :param if_etag: The `if_etag` parameter makes the save conditional on the current version (optional)
+        :return: the etag of the saved document, or None if `if_etag` did not match.
         """
-        last_login_elapse = 255
+        return DataManage.save_document(self.id, document, if_etag=if_etag)
 
-        if user_row.last_login_attempt is not None:
-            last_login_elapse = datetime.now() - user_row.last_login_attempt
-            last_login_elapse = math.ceil(last_login_elapse.total_seconds() / 60)
-
-        if last_login_elapse > LAST_LOGIN_RESET_PERIOD:
-            user_row.login_attempts = 0
+    @property
+    def document(self):
+        """
+        Returns the user's current document, served from the document cache when possible.
+        :return: a tuple of the document's etag and its bytes, or (None, None) if nothing is saved.
+        """
+        return DataLookup.document(self.id)
 
-        user_row.last_login_attempt = datetime.now()
-        db.session.commit()
+    def __set_manage_last_login(self):
+        """
+        Sets the last login attempt time and manages the login attempts for a user. The attempt is
+        buffered in `LoginAttemptBuffer` and written in the next periodic flush, rather than committed here.
+        """
+        self.last_login_attempt, reset = LoginAttemptBuffer.attempt(self.id, self.last_login_attempt)
+        if reset is True:
+            self.login_attempts = 0
 
     def update(self):
         """
@@ -191,8 +557,6 @@ class UserEntity:
         if user_row is None:
             Err.client_return(Err.ERROR_MESSAGES['INVALID_USERNAME_PASSWORD'], LogLevel.INFO)
 
-        self.__set_manage_last_login(user_row)
-
         self.id = user_row.id
         self.license = user_row.license
         self.password = user_row.password
@@ -203,6 +567,8 @@ class UserEntity:
         self.email = user_row.email
         self.status = user_row.status
 
+        self.__set_manage_last_login()
+
     def match_password(self, password):
         """
         Checks if a given password matches the hashed password stored in the
@@ -242,7 +608,11 @@ class UserEntity:
         """
         user = User.query.filter_by(id=self.id).first()
 
+        # the row is written now, so any buffered attempt for this user is superseded
+        LoginAttemptBuffer.discard(self.id)
+
         user.login_attempts = self.login_attempts
+        user.last_login_attempt = self.last_login_attempt
         user.login_timeout = self.timeout_stamp
         user.email = self.email
         user.status = self.status
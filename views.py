@@ -1,16 +1,26 @@
-from flask import request
+from flask import request, Response, stream_with_context
 import definitions
 import uuid
 from validation import Validate
-from werkzeug.security import generate_password_hash
-from session import SessionEntity, SessionLookup, SessionManage
-from user import UserEntity, UserLookup, UserManage
+from session import SessionAuth, SessionManage
+from user import LoginAttemptBuffer, UserImport, UserLookup, UserManage
 from security import Security
 import json
 from errors import Err, LogLevel
 from flask import Blueprint
-from license import LicenseEntity, LicenseManage
+from license import LicenseLookUp, LicenseManage
 from admin import AdminLookup
+from codec import Codec
+from data import DataCipher, DataLookup, DataManage
+from werkzeug.http import quote_etag
+from patch import JsonPatch, PatchError
+from jsonstream import JsonDocument, JsonStreamError
+from hashing import HashPool
+from ratelimit import LoginLimiter
+from metrics import Metrics
+import math
+import csv
+import io
 
 main = Blueprint('main', __name__)
 
@@ -48,16 +58,17 @@ def create_user(ikey):
     if UserLookup.email(user_email)[0] is True:
         Err.client_return(Err.ERROR_MESSAGES['EMAIL_NOT_UNIQUE'], LogLevel.INFO)
 
-    user_license = LicenseEntity(license_key)
-
-    if user_license.expired is True or user_license.claimed is True or user_license.status != definitions.STATUS_ACTIVE:
+    if LicenseLookUp.claimable(LicenseLookUp.by_license_key(license_key)) is False:
         Err.client_return(Err.ERROR_MESSAGES['INVALID_LICENSE'], LogLevel.INFO)
 
-    user_license.claimed = True
-    user_license.commit()
+    # hashed before the license is claimed, a busy hashing pool must not leave it claimed without a user
+    hashed_password = HashPool.generate(password)
+
+    if LicenseManage.claim(license_key) is False:
+        Err.client_return(Err.ERROR_MESSAGES['INVALID_LICENSE'], LogLevel.INFO)
 
-    hashed_password = generate_password_hash(password)
     gen_user_id = str(uuid.uuid4())
+    # commits the claim and the new user together
     UserManage.create(gen_user_id, user_name, user_email, hashed_password, definitions.STATUS_ACTIVE, license_key)
 
     return {"message": "User Successfully Created"}, 200
@@ -68,6 +79,9 @@ def login(ikey):
     """
     Handles the login process for a user, including validating the username and
     password, checking the user's account status and license, and creating a session key for the user.
+    Attempts are rate limited per username and client address by `LoginLimiter` before the database is
+    queried or the password hashed. The user and license are read in one joined query, and the login
+    attempt and session rotation are written in one transaction.
 
     :param ikey: The parameter `ikey` is as simple access key used provided by the app. It is compared with
     the `access_key` stored in the `Security.Network` class to ensure that the request is coming from a
@@ -84,42 +98,30 @@ def login(ikey):
     Validate.username(username)
     Validate.password(password)
 
-    user_found, user_record = UserLookup.username(username)
+    retry_after = LoginLimiter.admit(username, request.remote_addr)
+    if retry_after > 0:
+        Err.client_return(Err.ERROR_MESSAGES['LOGIN_ATTEMPTS'], LogLevel.INFO,
+                          f"\nTry again in {math.ceil(retry_after / 60)} minutes")
+
+    user_found, user_rows = UserLookup.login(username)
     if user_found is False:
         Err.client_return(Err.ERROR_MESSAGES['INVALID_USERNAME_PASSWORD'], LogLevel.INFO)
 
-    user_rec = UserEntity(user_record.id)
-
-    if user_rec.login_attempts > 4:
-        if user_rec.login_timeout <= 0:
-            user_rec.login_attempts = 0
-            user_rec.commit()
-        else:
-            Err.client_return(Err.ERROR_MESSAGES['LOGIN_ATTEMPTS'], LogLevel.INFO,
-                              f"\nTry again in {user_rec.login_timeout} minutes")
-
-    if Security.User.hash_password_compare(user_rec.password, password) is False:
-        user_rec.login_attempts += 1
-
-        if user_rec.login_attempts > 4:
-            user_rec.login_timeout = 1
+    user_row, license_row = user_rows
+    attempt = LoginAttemptBuffer.attempt(user_row.id, user_row.last_login_attempt)
 
-        user_rec.commit()
+    if HashPool.compare(user_row.password, password) is False:
         Err.client_return(Err.ERROR_MESSAGES['INVALID_USERNAME_PASSWORD'], LogLevel.INFO)
 
-    user_rec.login_attempts = 0       # if login is successful, reset failed login count
-    if user_rec.status != definitions.STATUS_ACTIVE:
+    LoginLimiter.succeeded(username)       # if login is successful, reset failed login count
+    if user_row.status != definitions.STATUS_ACTIVE:
         Err.client_return(Err.ERROR_MESSAGES['INVALID_ACCOUNT_STATE'], LogLevel.INFO)
 
-    user_license = LicenseEntity(user_rec.license)
-    if user_license.expired is True or user_license.claimed is False or user_license.status != definitions.STATUS_ACTIVE:
+    if LicenseLookUp.usable(license_row) is False:
         Err.client_return(Err.ERROR_MESSAGES['INVALID_LICENSE'], LogLevel.INFO)
 
-    session_row = SessionLookup.record_by_user_id(user_rec.id)
-    if session_row is not None:
-        SessionManage.delete(user_rec.id)
-
-    key = SessionManage.create(user_rec.id)
+    # rotate: drop the user's sessions (revoking their tokens), create the new one and record the attempt
+    key = SessionManage.rotate(user_row.id, attempt, user_license=license_row)
     return {"key": str(key)}, 200
 
 
@@ -144,49 +146,237 @@ def create_license(admin_key, duration):
     return LicenseManage.create(str(uuid.uuid4()), duration)
 
 
-@main.route('/api/save_user_data/<uuid:skey>', methods=['POST'])
+@main.route('/api/license/<uuid:admin_key>/<int:duration>/<int:count>', methods=['GET'])
+def create_license_batch(admin_key, duration, count):
+    """
+    Creates `count` licenses using an admin key and a duration, and streams the keys back as they are
+    committed, as CSV (default) or NDJSON (`?format=ndjson`).
+
+    :param admin_key: The admin_key parameter is the admin key UUID. It is used to
+    validate the admin user and ensure that they have the necessary permissions to create licenses
+    :param duration: The duration parameter is the number of days for which the licenses will be valid,
+    or 0 for licenses that do not expire
+    :param count: The count parameter is the number of licenses to create
+    :return: a streamed response with one line per created license. If the batch fails part way, the
+    stream ends with an error record (`{"error": ..., "created": n}`, or an `error` row in CSV) instead of
+    the remaining licenses.
+    """
+    if not Validate.uuid_form(admin_key):
+        Err.client_return(Err.ERROR_MESSAGES['UUID_FORM'], LogLevel.INFO)
+
+    if AdminLookup.match_key(admin_key) is False:
+        Err.client_return(Err.ERROR_MESSAGES['ADMIN_ID'], LogLevel.INFO)
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        Err.client_return(Err.ERROR_MESSAGES['EXPORT_FORMAT'], LogLevel.INFO)
+
+    def generate():
+        if export_format == 'csv':
+            yield 'license_key,expires,can_expire\n'
+
+        created = 0
+        try:
+            for chunk in LicenseManage.create_batch(count, duration):
+                created += len(chunk)
+                if export_format == 'csv':
+                    yield ''.join(f"{lic['id']},{lic['expires'].isoformat()},{lic['can_expire']}\n"
+                                  for lic in chunk)
+                else:
+                    yield ''.join(json.dumps({'key': lic['id'], 'expires': lic['expires'].isoformat(),
+                                              'can_expire': lic['can_expire']}) + '\n' for lic in chunk)
+
+        except Exception:
+            # the 200 is already sent, so the failure is reported in the body rather than as a short list
+            message = f"License batch failed after {created} of {count} licenses"
+            if export_format == 'csv':
+                yield f"error,{message},\n"
+            else:
+                yield json.dumps({'error': message, 'created': created}) + '\n'
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+@main.route('/api/import/users/<uuid:admin_key>', methods=['POST'])
+def import_users(admin_key):
+    """
+    Creates users in bulk from a CSV (header `username,email,password,key`) or NDJSON body, each claiming
+    its license key. The body is read and imported in chunks, and a result line is streamed back for every
+    row as its chunk is committed, in the same format as the body (`?format=csv|ndjson`, by default taken
+    from the content type).
+
+    :param admin_key: The admin_key parameter is the admin key UUID, required to import users
+    :return: a streamed response with one line per imported row: its line number, username, status
+    (`created`, `rejected` or `failed`) and error.
+    """
+    if not Validate.uuid_form(admin_key):
+        Err.client_return(Err.ERROR_MESSAGES['UUID_FORM'], LogLevel.INFO)
+
+    if AdminLookup.match_key(admin_key) is False:
+        Err.client_return(Err.ERROR_MESSAGES['ADMIN_ID'], LogLevel.INFO)
+
+    import_format = request.args.get('format', 'csv' if request.mimetype == 'text/csv' else 'ndjson')
+    if import_format not in ('csv', 'ndjson'):
+        Err.client_return(Err.ERROR_MESSAGES['IMPORT_FORMAT'], LogLevel.INFO)
+
+    try:
+        rows = UserImport.read(request.stream, import_format)
+    except ValueError:
+        Err.client_return(Err.ERROR_MESSAGES['IMPORT_HEADER'], LogLevel.INFO)
+
+    def generate():
+        if import_format == 'csv':
+            yield 'line,username,status,error\r\n'
+
+        for results in UserImport.run(rows):
+            if import_format == 'csv':
+                output = io.StringIO()
+                csv.writer(output).writerows((result['line'], result['username'], result['status'],
+                                              result['error'] or '') for result in results)
+                yield output.getvalue()
+            else:
+                yield ''.join(json.dumps(result) + '\n' for result in results)
+
+    mimetype = 'text/csv' if import_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+@main.route('/api/metrics/<uuid:admin_key>', methods=['GET'])
+def metrics(admin_key):
+    """
+    Exposes the server's metrics (request latency, SQL, encryption and password hashing) for Prometheus.
+    Metrics are kept per process: behind the multi-process server a scrape reaches one worker and only
+    covers the requests that worker served.
+
+    :param admin_key: The admin_key parameter is the admin key UUID, required to read the metrics
+    :return: the metrics in the Prometheus text exposition format.
+    """
+    if AdminLookup.match_key(admin_key) is False:
+        Err.client_return(Err.ERROR_MESSAGES['ADMIN_ID'], LogLevel.INFO)
+
+    return Response(Metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@main.route('/api/save_user_data/<skey>', methods=['POST'])
 def save_user_data(skey):
     """
-    Saves user data after validating the session key and encrypting the data.
+    Saves user data after validating the session key, then compresses and encrypts the data. With
+    `?raw=1`, the body is read as a stream and checked by a streaming JSON validator, and its original
+    bytes are stored without being parsed into objects and serialised again.
 
-    :param skey: The parameter "skey" is a session key that is used to identify and authenticate the
-    user session
+    :param skey: The parameter "skey" is a session key (or session token) that is used to identify and
+    authenticate the user session
     :return: a dictionary with the key "message" and the value "User Authenticated, saving data", along
     with the HTTP status code 200.
     """
-    Validate.uuid_form(skey)
-    user_session = SessionEntity(skey)
-    if user_session.expired() is True:
-        Err.client_return(Err.ERROR_MESSAGES['INVALID_SESSION'], LogLevel.WARNING)
-
-    json_dump = json.dumps(request.json)
-    user_entity = UserEntity(user_session.user_id)
-
-    user_entity.data = Security.fernet_encrypt(json_dump)
+    user_id = SessionAuth.user_id(skey)
+
+    if request.args.get('raw') == '1':
+        if request.is_json is False:
+            Err.client_return(Err.ERROR_MESSAGES['MISSING_JSON_DATA'], LogLevel.INFO)
+        try:
+            document = JsonDocument.read(request.stream)
+        except JsonStreamError as e:
+            Err.client_return(Err.ERROR_MESSAGES['JSON_INVALID'], LogLevel.INFO, f": {e}")
+    else:
+        document = json.dumps(request.json).encode('utf-8')
+
+    DataManage.save_document(user_id, document)
     return {"message": "User Authenticated, saving data"}, 200
 
 
-@main.route('/api/load_user_data/<uuid:skey>', methods=['GET'])
+@main.route('/api/load_user_data/<skey>', methods=['GET'])
 def load_user_data(skey):
     """
-    Loads and decrypts user data based on a session key.
-
-    :param skey: The parameter `skey` is a session key that is used to identify and authenticate a user
-    session
+    Loads and decrypts user data based on a session key. With `?raw=1`, the document itself is the
+    `application/json` body rather than a string inside a wrapping object: if the client accepts the
+    content coding the data was stored with (`Accept-Encoding`), the stored compressed bytes are sent with
+    a matching `Content-Encoding`, without being inflated on the server, otherwise they are decompressed
+    and streamed in chunks. Responses carry a weak `ETag`; when `If-None-Match` matches it, 304 is
+    returned without reading or decrypting the data.
+
+    :param skey: The parameter `skey` is a session key (or session token) that is used to identify and
+    authenticate a user session
     :return: a dictionary with the key "userData" and the decrypted user data as the value. The HTTP
     status code 200 is also being returned.
     """
-    Validate.uuid_form(skey)
-    user_session = SessionEntity(skey)
-    if user_session.expired() is True:
-        Err.client_return(Err.ERROR_MESSAGES['INVALID_SESSION'], LogLevel.WARNING)
+    user_id = SessionAuth.user_id(skey)
 
-    user_entity = UserEntity(user_session.user_id)
-    user_data_rec = user_entity.data
+    data_found, etag = DataLookup.latest_etag(user_id)
+    if data_found is False:
+        return {'message': 'No data found for user'}, 404
+
+    raw = request.args.get('raw') == '1'
+    headers = {'Vary': 'Accept-Encoding'} if raw else {}
+    if etag is not None:
+        headers['ETag'] = quote_etag(etag, weak=True)
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
 
+    user_data_rec = DataLookup.latest(user_id)
     if user_data_rec is None:
         return {'message': 'No data found for user'}, 404
 
-    decrypted_data = Security.fernet_decrypt(user_data_rec.userData)
+    if user_data_rec.etag is not None:
+        headers['ETag'] = quote_etag(user_data_rec.etag, weak=True)
+
+    payload = DataCipher.payload(user_data_rec)
+
+    if raw is True:
+        # the passthrough is only for raw mode, the default response wraps the document in an object
+        encoding = Codec.http_encoding(user_data_rec.codec)
+        if encoding is not None and request.accept_encodings.quality(encoding) > 0:
+            headers['Content-Encoding'] = encoding
+            return Response(payload, mimetype='application/json', headers=headers)
+
+        return Response(Codec.decompress_chunks(payload, user_data_rec.codec), mimetype='application/json',
+                        headers=headers)
+
+    decrypted_data = Codec.decompress(payload, user_data_rec.codec).decode('utf-8')
+
+    return {"userData": str(decrypted_data)}, 200, headers
+
+
+@main.route('/api/patch_user_data/<skey>', methods=['PATCH'])
+def patch_user_data(skey):
+    """
+    Applies a delta to the user's saved data, either an RFC 6902 JSON Patch
+    (`application/json-patch+json`) or an RFC 7396 merge patch (`application/merge-patch+json`). The
+    patch is applied to the current document and must name the version it was made against in
+    `If-Match` (the ETag from load_user_data, or `*`).
+
+    :param skey: The parameter `skey` is a session key (or session token) that is used to identify and
+    authenticate the user session
+    :return: a dictionary with the key "message" and the HTTP status code 200, with the new version in
+    the `ETag` header. 412 is returned if the data has changed since the given version.
+    """
+    user_id = SessionAuth.user_id(skey)
+
+    if request.mimetype not in ('application/json-patch+json', 'application/merge-patch+json'):
+        Err.client_return(Err.ERROR_MESSAGES['PATCH_TYPE'], LogLevel.INFO)
+
+    if not request.if_match:
+        return {'message': 'If-Match header with the data version is required'}, 428
+
+    etag, document = DataLookup.document(user_id)
+    if document is None:
+        return {'message': 'No data found for user'}, 404
+
+    if not request.if_match.star_tag and (etag is None or not request.if_match.contains_weak(etag)):
+        return {'message': 'Data has changed since the given version'}, 412
+
+    try:
+        if request.mimetype == 'application/merge-patch+json':
+            patched = JsonPatch.merge(json.loads(document), request.json)
+        else:
+            patched = JsonPatch.apply(json.loads(document), request.json)
+
+    except PatchError as e:
+        Err.client_return(Err.ERROR_MESSAGES['PATCH_INVALID'], LogLevel.INFO, f": {e}")
+
+    new_etag = DataManage.save_document(user_id, json.dumps(patched).encode('utf-8'), if_etag=etag)
+    if new_etag is None:
+        return {'message': 'Data has changed since the given version'}, 412
 
-    return {"userData": str(decrypted_data)}, 200
+    return {"message": "User Authenticated, data patched"}, 200, {'ETag': quote_etag(new_etag, weak=True)}